@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable, Optional
+
+
+# Motor de alertas de stock por eventos: cada escritura compara el stock anterior y el nuevo
+# y solo emite cuando cambia el nivel (O(1) por escritura, sin recorrer `inventory`).
+# La histéresis evita alertas intermitentes cuando el stock oscila cerca del umbral.
+
+OK = "ok"
+LOW_STOCK = "low_stock"
+OUT_OF_STOCK = "out_of_stock"
+
+SEVERITY = {OK: 0, LOW_STOCK: 1, OUT_OF_STOCK: 2}
+
+
+def stock_level(stock: int, min_threshold: int) -> str:
+    # Mismo criterio que el CASE de get_inventory
+    if stock <= 0:
+        return OUT_OF_STOCK
+    if stock <= min_threshold:
+        return LOW_STOCK
+    return OK
+
+
+class StockAlertEngine:
+    def __init__(self, hysteresis_ratio: float = 0.1, max_recent: int = 500, queue_size: int = 1000):
+        self.hysteresis_ratio = hysteresis_ratio
+        self.queue_size = queue_size
+        # (pharmacy_id, medication_code) -> último nivel emitido; solo se guardan los distintos de OK
+        self._levels: dict[tuple[int, str], str] = {}
+        self.recent: deque = deque(maxlen=max_recent)
+        self._callbacks: list[Callable[[dict], None]] = []
+        self._queues: list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self._lock = threading.Lock()
+
+    def _next_level(self, current: str, stock: int, min_threshold: int) -> str:
+        raw = stock_level(stock, min_threshold)
+        if SEVERITY[raw] >= SEVERITY[current]:
+            return raw
+        # Recuperación: salir de low_stock exige superar el umbral con margen
+        if current in (LOW_STOCK, OUT_OF_STOCK) and raw == OK:
+            recovery = min_threshold + max(1, int(min_threshold * self.hysteresis_ratio))
+            if stock < recovery:
+                return LOW_STOCK
+        return raw
+
+    def evaluate(
+        self,
+        pharmacy_id: int,
+        medication_code: str,
+        previous_stock: Optional[int],
+        current_stock: int,
+        min_threshold: int,
+    ) -> Optional[dict]:
+        key = (pharmacy_id, medication_code)
+        with self._lock:
+            current = self._levels.get(key)
+            if current is None:
+                current = stock_level(previous_stock, min_threshold) if previous_stock is not None else OK
+            level = self._next_level(current, current_stock, min_threshold)
+            if level == OK:
+                self._levels.pop(key, None)
+            else:
+                self._levels[key] = level
+            if level == current:
+                return None
+            event = {
+                "type": "recovered" if level == OK else level,
+                "pharmacy_id": pharmacy_id,
+                "medication_code": medication_code,
+                "previous_stock": previous_stock,
+                "current_stock": current_stock,
+                "min_threshold": min_threshold,
+                "at": datetime.now().isoformat(),
+            }
+            self.recent.append(event)
+            callbacks = list(self._callbacks)
+            queues = list(self._queues)
+
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"⚠️ Error en suscriptor de alertas: {e}")
+        for loop, queue in queues:
+            # evaluate puede llamarse desde el threadpool (importaciones)
+            loop.call_soon_threadsafe(self._offer, queue, event)
+        return event
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict) -> None:
+        if queue.full():
+            # Suscriptor lento: se descarta el evento más antiguo
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    def load(self, rows: list[tuple]) -> None:
+        """Carga inicial (sin emitir eventos) de filas (pharmacy_id, code, stock, min_threshold)."""
+        with self._lock:
+            for pharmacy_id, medication_code, stock, min_threshold in rows:
+                level = stock_level(stock, min_threshold)
+                if level != OK:
+                    self._levels[(pharmacy_id, medication_code)] = level
+
+    def subscribe(self, callback: Callable[[dict], None]) -> None:
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def subscribe_queue(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._queues.append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe_queue(self, queue: asyncio.Queue) -> None:
+        with self._lock:
+            self._queues = [(loop, q) for loop, q in self._queues if q is not queue]
+
+    def active_alerts(self, pharmacy_id: Optional[int] = None) -> list[dict]:
+        with self._lock:
+            return [
+                {"pharmacy_id": pid, "medication_code": code, "level": level}
+                for (pid, code), level in self._levels.items()
+                if pharmacy_id is None or pid == pharmacy_id
+            ]
+
+    def recent_events(self, pharmacy_id: Optional[int] = None) -> list[dict]:
+        """Eventos recientes, del más nuevo al más antiguo."""
+        with self._lock:
+            events = list(self.recent)
+        return [e for e in reversed(events) if pharmacy_id is None or e["pharmacy_id"] == pharmacy_id]
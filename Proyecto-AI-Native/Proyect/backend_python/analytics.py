@@ -0,0 +1,376 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+
+# Instantáneas columnares para análisis, fuera de la base de producción.
+# Los turnos de cada día y el inventario al cierre se escriben como un .npy por columna en
+# particiones por fecha:
+#
+#   analytics/turns/date=YYYY-MM-DD/{id,pharmacy_id,...}.npy + _meta.json
+#   analytics/inventory/date=YYYY-MM-DD/...
+#
+# Los timestamps son datetime64[s] (NULL = NaT) y los textos repetidos (estado, tipo de turno,
+# código de medicamento) se codifican como enteros con su diccionario en _meta.json. Las
+# consultas abren las columnas con np.load(mmap_mode="r") y agregan con numpy partición por
+# partición, así los análisis pesados no tocan farmacia.db ni sus shards.
+#
+# La exportación lee la base en lotes (fetchmany) y escribe la partición en un directorio
+# temporal que reemplaza al anterior al terminar: una partición se ve completa o no se ve.
+
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")
+FETCH_SIZE = 10_000
+
+TURN_SNAPSHOT_COLUMNS = (
+    "id", "pharmacy_id", "turn_number", "status", "request_type",
+    "requested_at", "called_at", "attended_at", "cancelled_at",
+)
+INVENTORY_SNAPSHOT_COLUMNS = (
+    "pharmacy_id", "medication_code", "current_stock", "reserved_stock", "min_threshold", "last_updated",
+)
+
+TURN_STATUS_VALUES = ["pending", "called", "attended", "cancelled"]
+REQUEST_TYPE_VALUES = ["digital", "physical", "scheduled"]
+
+PARTITION_PREFIX = "date="
+META_FILE = "_meta.json"
+
+
+def _timestamps(values: list) -> np.ndarray:
+    # "YYYY-MM-DD HH:MM:SS[.ffffff]" o ISO con T; None -> NaT
+    return np.array(values, dtype="datetime64[us]").astype("datetime64[s]")
+
+
+def _encode(values: list, dictionary: list[str]) -> np.ndarray:
+    """Códigos int8/int32 de una columna de texto; los valores nuevos se agregan al diccionario."""
+    index = {value: position for position, value in enumerate(dictionary)}
+    codes = []
+    for value in values:
+        if value not in index:
+            index[value] = len(dictionary)
+            dictionary.append(value)
+        codes.append(index[value])
+    return np.array(codes, dtype=np.int8 if len(dictionary) < 128 else np.int32)
+
+
+class ColumnarStore:
+    def __init__(self, root: str = ANALYTICS_DIR):
+        self.root = root
+
+    def partition_path(self, table: str, day: date) -> str:
+        return os.path.join(self.root, table, f"{PARTITION_PREFIX}{day.isoformat()}")
+
+    def partitions(self, table: str, start: Optional[date] = None, end: Optional[date] = None) -> list[date]:
+        directory = os.path.join(self.root, table)
+        if not os.path.isdir(directory):
+            return []
+        days = []
+        for name in os.listdir(directory):
+            if not name.startswith(PARTITION_PREFIX) or not os.path.exists(os.path.join(directory, name, META_FILE)):
+                continue
+            day = date.fromisoformat(name[len(PARTITION_PREFIX):])
+            if (start is None or day >= start) and (end is None or day <= end):
+                days.append(day)
+        return sorted(days)
+
+    # --- Escritura ----------------------------------------------------------------
+
+    def write_partition(self, table: str, day: date, columns: dict[str, np.ndarray], meta: dict) -> dict:
+        final_path = self.partition_path(table, day)
+        temp_path = final_path + ".tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for name, values in columns.items():
+            np.save(os.path.join(temp_path, f"{name}.npy"), values)
+        rows = len(next(iter(columns.values()))) if columns else 0
+        meta = {
+            **meta,
+            "table": table,
+            "date": day.isoformat(),
+            "rows": rows,
+            "columns": {name: str(values.dtype) for name, values in columns.items()},
+            "written_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(os.path.join(temp_path, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        # Reemplazo de la partición anterior (si la había) por la nueva
+        old_path = final_path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(final_path):
+            os.replace(final_path, old_path)
+        os.replace(temp_path, final_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return {"table": table, "date": day.isoformat(), "rows": rows}
+
+    @staticmethod
+    def _fetch(sources: Iterable[tuple[str, str, tuple]]) -> Iterator[list[tuple]]:
+        for db_path, sql, params in sources:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                cursor = conn.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                conn.close()
+
+    def export_turns(self, day: date, sources: Iterable[tuple[str, str, tuple]]) -> dict:
+        """Partición de turnos de `day`; cada fuente es (db, sql, params) con TURN_SNAPSHOT_COLUMNS."""
+        statuses = list(TURN_STATUS_VALUES)
+        request_types = list(REQUEST_TYPE_VALUES)
+        chunks: dict[str, list[np.ndarray]] = {name: [] for name in TURN_SNAPSHOT_COLUMNS}
+        for rows in self._fetch(sources):
+            values = list(zip(*rows))
+            chunks["id"].append(np.array(values[0], dtype=np.int64))
+            chunks["pharmacy_id"].append(np.array(values[1], dtype=np.int32))
+            chunks["turn_number"].append(np.array(values[2], dtype=np.int32))
+            chunks["status"].append(_encode(values[3], statuses))
+            chunks["request_type"].append(_encode(values[4], request_types))
+            for position, name in enumerate(TURN_SNAPSHOT_COLUMNS[5:], start=5):
+                chunks[name].append(_timestamps(values[position]))
+        columns = {
+            name: np.concatenate(parts) if parts else np.array([], dtype=self._empty_dtype(name))
+            for name, parts in chunks.items()
+        }
+        # Los diccionarios pudieron crecer a mitad de la exportación: un solo ancho para todo
+        for name, dictionary in (("status", statuses), ("request_type", request_types)):
+            columns[name] = columns[name].astype(np.int8 if len(dictionary) < 128 else np.int32)
+        return self.write_partition("turns", day, columns, {"dictionaries": {"status": statuses, "request_type": request_types}})
+
+    def export_inventory(self, day: date, sources: Iterable[tuple[str, str, tuple]]) -> dict:
+        """Partición con el inventario actual, fechada `day`; fuentes con INVENTORY_SNAPSHOT_COLUMNS."""
+        medication_codes: list[str] = []
+        chunks: dict[str, list[np.ndarray]] = {name: [] for name in INVENTORY_SNAPSHOT_COLUMNS}
+        for rows in self._fetch(sources):
+            values = list(zip(*rows))
+            chunks["pharmacy_id"].append(np.array(values[0], dtype=np.int32))
+            chunks["medication_code"].append(_encode(values[1], medication_codes).astype(np.int32))
+            for position, name in ((2, "current_stock"), (3, "reserved_stock"), (4, "min_threshold")):
+                chunks[name].append(np.array([value or 0 for value in values[position]], dtype=np.int32))
+            chunks["last_updated"].append(_timestamps(values[5]))
+        columns = {
+            name: np.concatenate(parts) if parts else np.array([], dtype=self._empty_dtype(name))
+            for name, parts in chunks.items()
+        }
+        return self.write_partition("inventory", day, columns, {"dictionaries": {"medication_code": medication_codes}})
+
+    @staticmethod
+    def _empty_dtype(name: str) -> str:
+        if name.endswith("_at") or name == "last_updated":
+            return "datetime64[s]"
+        return "int64" if name == "id" else "int32"
+
+    # --- Lectura ------------------------------------------------------------------
+
+    def read(self, table: str, day: date, columns: Iterable[str]) -> tuple[dict, dict[str, np.ndarray]]:
+        """(meta, columnas mapeadas en memoria) de una partición."""
+        path = self.partition_path(table, day)
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in columns:
+            # np.load no mapea archivos vacíos
+            arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if meta["rows"] else None)
+        return meta, arrays
+
+    def _turns(self, start: date, end: date, columns: tuple[str, ...], pharmacy_id: Optional[int]) -> Iterator[tuple[date, dict, dict]]:
+        for day in self.partitions("turns", start, end):
+            meta, arrays = self.read("turns", day, ("pharmacy_id", *columns))
+            if pharmacy_id is not None:
+                mask = arrays["pharmacy_id"] == pharmacy_id
+                arrays = {name: values[mask] for name, values in arrays.items()}
+            yield day, meta, arrays
+
+    @staticmethod
+    def _hours(timestamps: np.ndarray) -> np.ndarray:
+        return ((timestamps - timestamps.astype("datetime64[D]")) // np.timedelta64(1, "h")).astype(np.int64)
+
+    @staticmethod
+    def _group(pharmacy_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (farmacias, índice de grupo de cada fila)
+        return np.unique(pharmacy_ids, return_inverse=True)
+
+    def wait_times(self, start: date, end: date, pharmacy_id: Optional[int] = None) -> dict:
+        """Espera (solicitud -> atención, en minutos) por farmacia: media y percentiles."""
+        pharmacies, waits = [], []
+        for _, _, arrays in self._turns(start, end, ("requested_at", "attended_at"), pharmacy_id):
+            wait = (arrays["attended_at"] - arrays["requested_at"]) / np.timedelta64(1, "s") / 60
+            valid = ~np.isnan(wait) & (wait >= 0)
+            pharmacies.append(arrays["pharmacy_id"][valid])
+            waits.append(wait[valid])
+        result = []
+        if pharmacies:
+            all_pharmacies, all_waits = np.concatenate(pharmacies), np.concatenate(waits)
+            order = np.argsort(all_pharmacies, kind="stable")
+            ids, starts = np.unique(all_pharmacies[order], return_index=True)
+            for pid, group in zip(ids, np.split(all_waits[order], starts[1:])):
+                p50, p90, p99 = np.percentile(group, [50, 90, 99])
+                result.append({
+                    "pharmacy_id": int(pid),
+                    "attended": int(group.size),
+                    "mean_minutes": round(float(group.mean()), 1),
+                    "p50_minutes": round(float(p50), 1),
+                    "p90_minutes": round(float(p90), 1),
+                    "p99_minutes": round(float(p99), 1),
+                    "max_minutes": round(float(group.max()), 1),
+                })
+        return {"start": start.isoformat(), "end": end.isoformat(), "pharmacies": result}
+
+    def demand(self, start: date, end: date, pharmacy_id: Optional[int] = None, top_medications: int = 10) -> dict:
+        """Llegadas por hora del día y tipo de turno, y medicamentos más consumidos según el inventario."""
+        by_hour: dict[int, np.ndarray] = {}
+        by_type: dict[int, dict[str, int]] = {}
+        days: dict[int, int] = {}
+        for _, meta, arrays in self._turns(start, end, ("requested_at", "request_type"), pharmacy_id):
+            ids, group = self._group(arrays["pharmacy_id"])
+            hours = np.bincount(group * 24 + self._hours(arrays["requested_at"]), minlength=len(ids) * 24).reshape(-1, 24)
+            type_names = meta["dictionaries"]["request_type"]
+            types = np.bincount(group * len(type_names) + arrays["request_type"], minlength=len(ids) * len(type_names))
+            types = types.reshape(-1, len(type_names))
+            for row, pid in enumerate(ids.tolist()):
+                by_hour[pid] = by_hour.get(pid, np.zeros(24, dtype=np.int64)) + hours[row]
+                counts = by_type.setdefault(pid, {})
+                for position, name in enumerate(type_names):
+                    counts[name] = counts.get(name, 0) + int(types[row, position])
+                days[pid] = days.get(pid, 0) + 1
+
+        consumption = self.consumption(start, end, pharmacy_id, top_medications)
+        pharmacies = []
+        for pid in sorted(by_hour):
+            hours = by_hour[pid]
+            pharmacies.append({
+                "pharmacy_id": pid,
+                "arrivals": int(hours.sum()),
+                "days": days[pid],
+                "daily_average": round(float(hours.sum()) / days[pid], 1),
+                "by_hour": hours.tolist(),
+                "peak_hour": int(hours.argmax()),
+                "by_request_type": {name: count for name, count in by_type[pid].items() if count},
+                "top_medications": consumption.get(pid, []),
+            })
+        return {"start": start.isoformat(), "end": end.isoformat(), "pharmacies": pharmacies}
+
+    def consumption(self, start: date, end: date, pharmacy_id: Optional[int] = None, top: int = 10) -> dict[int, list[dict]]:
+        """Unidades consumidas por medicamento: caídas de stock entre instantáneas consecutivas.
+
+        Las subidas (reposiciones) no cuentan; el primer día del rango necesita la instantánea
+        del día anterior.
+        """
+        days = self.partitions("inventory", start - timedelta(days=1), end)
+        codes: dict[str, int] = {}
+        totals: dict[int, float] = {}
+        previous = None
+        for day in days:
+            meta, arrays = self.read("inventory", day, ("pharmacy_id", "medication_code", "current_stock"))
+            dictionary = meta["dictionaries"]["medication_code"]
+            # Códigos locales de la partición -> ids globales del rango
+            remap = np.array([codes.setdefault(code, len(codes)) for code in dictionary] or [0], dtype=np.int64)
+            pharmacy_ids = np.asarray(arrays["pharmacy_id"], dtype=np.int64)
+            if pharmacy_id is not None:
+                keep = pharmacy_ids == pharmacy_id
+            else:
+                keep = slice(None)
+            keys = (pharmacy_ids[keep] << 32) | remap[np.asarray(arrays["medication_code"])[keep]]
+            stock = np.asarray(arrays["current_stock"], dtype=np.int64)[keep]
+            order = np.argsort(keys)
+            keys, stock = keys[order], stock[order]
+            if previous is not None and day >= start:
+                previous_keys, previous_stock = previous
+                _, current_index, previous_index = np.intersect1d(keys, previous_keys, assume_unique=True, return_indices=True)
+                drop = np.maximum(previous_stock[previous_index] - stock[current_index], 0)
+                for key, units in zip(keys[current_index][drop > 0].tolist(), drop[drop > 0].tolist()):
+                    totals[key] = totals.get(key, 0) + units
+            previous = (keys, stock)
+
+        names = {position: code for code, position in codes.items()}
+        by_pharmacy: dict[int, list[dict]] = {}
+        for key, units in sorted(totals.items(), key=lambda item: -item[1]):
+            pid = key >> 32
+            medications = by_pharmacy.setdefault(pid, [])
+            if len(medications) < top:
+                medications.append({"medication_code": names[key & 0xFFFFFFFF], "units": int(units)})
+        return by_pharmacy
+
+    def throughput(self, start: date, end: date, pharmacy_id: Optional[int] = None) -> dict:
+        """Turnos atendidos por día y por hora de atención, y cancelaciones."""
+        result: dict[int, dict] = {}
+        for day, meta, arrays in self._turns(start, end, ("status", "attended_at"), pharmacy_id):
+            statuses = meta["dictionaries"]["status"]
+            attended_code = statuses.index("attended")
+            cancelled_code = statuses.index("cancelled")
+            ids, group = self._group(arrays["pharmacy_id"])
+            attended = arrays["status"] == attended_code
+            attended_counts = np.bincount(group[attended], minlength=len(ids))
+            cancelled_counts = np.bincount(group[arrays["status"] == cancelled_code], minlength=len(ids))
+            total_counts = np.bincount(group, minlength=len(ids))
+            attended_at = arrays["attended_at"][attended]
+            valid = ~np.isnat(attended_at)
+            hours = np.bincount(
+                group[attended][valid] * 24 + self._hours(attended_at[valid]), minlength=len(ids) * 24
+            ).reshape(-1, 24)
+            for row, pid in enumerate(ids.tolist()):
+                entry = result.setdefault(pid, {
+                    "pharmacy_id": pid, "turns": 0, "attended": 0, "cancelled": 0,
+                    "by_date": {}, "by_hour": np.zeros(24, dtype=np.int64),
+                })
+                entry["turns"] += int(total_counts[row])
+                entry["attended"] += int(attended_counts[row])
+                entry["cancelled"] += int(cancelled_counts[row])
+                entry["by_date"][day.isoformat()] = int(attended_counts[row])
+                entry["by_hour"] = entry["by_hour"] + hours[row]
+
+        pharmacies = []
+        for pid in sorted(result):
+            entry = result[pid]
+            busy_hours = int(np.count_nonzero(entry["by_hour"]))
+            pharmacies.append({
+                **entry,
+                "by_hour": entry["by_hour"].tolist(),
+                "attended_per_day": round(entry["attended"] / len(entry["by_date"]), 1),
+                "cancellation_rate": round(entry["cancelled"] / entry["turns"], 3) if entry["turns"] else 0.0,
+                # Promedio sobre las horas del día en que se atendió a alguien
+                "attended_per_active_hour": round(entry["attended"] / busy_hours / len(entry["by_date"]), 2) if busy_hours else 0.0,
+            })
+        return {"start": start.isoformat(), "end": end.isoformat(), "pharmacies": pharmacies}
+
+    def stats(self) -> dict:
+        tables = {}
+        for table in ("turns", "inventory"):
+            days = self.partitions(table)
+            size = 0
+            for day in days:
+                path = self.partition_path(table, day)
+                size += sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            tables[table] = {
+                "partitions": len(days),
+                "first": days[0].isoformat() if days else None,
+                "last": days[-1].isoformat() if days else None,
+                "bytes": size,
+            }
+        return {"root": self.root, "tables": tables}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consultas sobre las instantáneas columnares (sin tocar la base)")
+    parser.add_argument("metric", choices=["wait-times", "demand", "throughput", "stats"])
+    parser.add_argument("--root", default=ANALYTICS_DIR)
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today() - timedelta(days=30))
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--pharmacy-id", type=int, default=None)
+    args = parser.parse_args()
+
+    store = ColumnarStore(args.root)
+    if args.metric == "stats":
+        output = store.stats()
+    else:
+        method = {"wait-times": store.wait_times, "demand": store.demand, "throughput": store.throughput}[args.metric]
+        output = method(args.start, args.end, args.pharmacy_id)
+    print(json.dumps(output, indent=2, ensure_ascii=False))
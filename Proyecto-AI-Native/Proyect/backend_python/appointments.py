@@ -0,0 +1,281 @@
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+from db_writer import ensure_autoincrement
+from local_time import local_now
+
+
+# Citas programadas para retirar medicamentos (pacientes crónicos).
+# Cada farmacia divide su horario de citas en franjas de appointment_slot_minutes con
+# appointment_slot_capacity cupos. Por farmacia y día se mantiene en memoria un árbol de
+# segmentos con los cupos libres de cada franja: "primera franja libre desde T" y reservar o
+# liberar un cupo cuestan O(log n). El árbol de un día se arma la primera vez que se consulta,
+# con un conteo de citas de ese día, y solo sirve para elegir la franja: el INSERT de la cita
+# vuelve a comprobar el cupo dentro de la transacción del escritor, así dos reservas
+# simultáneas nunca sobrepasan la capacidad.
+#
+# Al hacer check-in la cita se convierte en un turno con request_type 'scheduled'.
+#
+# Las franjas (slot_start) están en la hora local de PHARMACY_TIMEZONE, igual que "ahora" y
+# "hoy" al decidir qué franjas ya pasaron.
+
+APPOINTMENT_OPEN_TIME = os.getenv("APPOINTMENT_OPEN_TIME", "08:00")
+APPOINTMENT_CLOSE_TIME = os.getenv("APPOINTMENT_CLOSE_TIME", "20:00")
+APPOINTMENT_BOOKING_DAYS = int(os.getenv("APPOINTMENT_BOOKING_DAYS", "14"))
+DEFAULT_SLOT_MINUTES = 15
+DEFAULT_SLOT_CAPACITY = 2
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def init_appointment_schema(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(pharmacies)")}
+    if "appointment_slot_minutes" not in columns:
+        conn.execute(f"ALTER TABLE pharmacies ADD COLUMN appointment_slot_minutes INTEGER DEFAULT {DEFAULT_SLOT_MINUTES}")
+    if "appointment_slot_capacity" not in columns:
+        conn.execute(f"ALTER TABLE pharmacies ADD COLUMN appointment_slot_capacity INTEGER DEFAULT {DEFAULT_SLOT_CAPACITY}")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pharmacy_id INTEGER NOT NULL,
+            slot_start TIMESTAMP NOT NULL,
+            user_id TEXT,
+            user_name TEXT NOT NULL,
+            user_document TEXT NOT NULL,
+            phone_number TEXT,
+            status TEXT NOT NULL DEFAULT 'booked',
+            turn_id INTEGER NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            checked_in_at TIMESTAMP NULL,
+            cancelled_at TIMESTAMP NULL
+        )
+        """
+    )
+    # Ids públicos: no se reutilizan (ver shards.py)
+    ensure_autoincrement(conn, "appointments")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (pharmacy_id, slot_start, status)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_appointments_user ON appointments (user_document, slot_start)"
+    )
+
+
+def parse_time(value: str) -> tuple[int, int]:
+    hour, minute = (int(part) for part in value.split(":"))
+    return hour, minute
+
+
+def slot_config(pharmacy: dict) -> tuple[int, int]:
+    """(minutos por franja, cupos por franja) de una farmacia del catálogo."""
+    minutes = pharmacy.get("appointment_slot_minutes") or DEFAULT_SLOT_MINUTES
+    capacity = pharmacy.get("appointment_slot_capacity")
+    return minutes, DEFAULT_SLOT_CAPACITY if capacity is None else capacity
+
+
+def insert_appointment(
+    cursor: sqlite3.Cursor,
+    pharmacy_id: int,
+    slot_start: str,
+    capacity: int,
+    user_id: Optional[str],
+    user_name: str,
+    user_document: str,
+    phone_number: Optional[str],
+) -> Optional[int]:
+    """Inserta la cita solo si la franja tiene cupo (id o None si se llenó)."""
+    cursor.execute(
+        """
+        INSERT INTO appointments (pharmacy_id, slot_start, user_id, user_name, user_document, phone_number)
+        SELECT ?, ?, ?, ?, ?, ?
+        WHERE (
+            SELECT COUNT(*) FROM appointments
+            WHERE pharmacy_id = ? AND slot_start = ? AND status IN ('booked', 'checked_in')
+        ) < ?
+        RETURNING id
+        """,
+        (pharmacy_id, slot_start, user_id, user_name, user_document, phone_number, pharmacy_id, slot_start, capacity),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class SlotTree:
+    """Árbol de segmentos con el máximo de cupos libres por rango de franjas."""
+
+    def __init__(self, free: list[int]):
+        self.size = len(free)
+        self._leaves = 1
+        while self._leaves < max(1, self.size):
+            self._leaves *= 2
+        self._tree = [0] * (2 * self._leaves)
+        self._tree[self._leaves:self._leaves + self.size] = free
+        for node in range(self._leaves - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def free(self, index: int) -> int:
+        return self._tree[self._leaves + index]
+
+    def add(self, index: int, delta: int) -> None:
+        node = self._leaves + index
+        self._tree[node] += delta
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_free(self, start: int = 0) -> Optional[int]:
+        """Primera franja con cupo en [start, size), o None."""
+        if start >= self.size:
+            return None
+        return self._first_free(1, 0, self._leaves - 1, max(0, start))
+
+    def _first_free(self, node: int, low: int, high: int, start: int) -> Optional[int]:
+        if high < start or self._tree[node] <= 0:
+            return None
+        if low == high:
+            return low
+        middle = (low + high) // 2
+        found = self._first_free(2 * node, low, middle, start)
+        if found is None:
+            found = self._first_free(2 * node + 1, middle + 1, high, start)
+        return found
+
+
+class AppointmentBook:
+    def __init__(
+        self,
+        connect: Callable[[int], sqlite3.Connection],
+        open_time: str = APPOINTMENT_OPEN_TIME,
+        close_time: str = APPOINTMENT_CLOSE_TIME,
+        booking_days: int = APPOINTMENT_BOOKING_DAYS,
+    ):
+        # Conexión de lectura a la base (o shard) de cada farmacia
+        self.connect = connect
+        self.open_time = parse_time(open_time)
+        self.close_time = parse_time(close_time)
+        self.booking_days = booking_days
+        # (pharmacy_id, día) -> (minutos, capacidad, árbol)
+        self._days: dict[tuple[int, date], tuple[int, int, SlotTree]] = {}
+        self._lock = threading.Lock()
+
+    def slot_starts(self, day: date, minutes: int) -> list[datetime]:
+        start = datetime.combine(day, datetime.min.time()).replace(hour=self.open_time[0], minute=self.open_time[1])
+        end = start.replace(hour=self.close_time[0], minute=self.close_time[1])
+        count = max(0, int((end - start).total_seconds() // (minutes * 60)))
+        return [start + timedelta(minutes=minutes * i) for i in range(count)]
+
+    def _slot_index(self, day: date, minutes: int, moment: datetime) -> int:
+        """Índice de la primera franja que empieza en `moment` o después."""
+        first = datetime.combine(day, datetime.min.time()).replace(hour=self.open_time[0], minute=self.open_time[1])
+        seconds = (moment - first).total_seconds()
+        if seconds <= 0:
+            return 0
+        return -int(-seconds // (minutes * 60))
+
+    def _tree(self, pharmacy_id: int, day: date, minutes: int, capacity: int) -> SlotTree:
+        # Llamar con el lock tomado
+        cached = self._days.get((pharmacy_id, day))
+        if cached is not None and cached[:2] == (minutes, capacity):
+            return cached[2]
+        starts = self.slot_starts(day, minutes)
+        conn = self.connect(pharmacy_id)
+        try:
+            booked = dict(conn.execute(
+                """
+                SELECT slot_start, COUNT(*) FROM appointments
+                WHERE pharmacy_id = ? AND slot_start >= ? AND slot_start < ? AND status IN ('booked', 'checked_in')
+                GROUP BY slot_start
+                """,
+                (pharmacy_id, day.isoformat(), (day + timedelta(days=1)).isoformat()),
+            ).fetchall())
+        finally:
+            conn.close()
+        tree = SlotTree([
+            max(0, capacity - booked.get(start.strftime(TIMESTAMP_FORMAT), 0)) for start in starts
+        ])
+        # Los días pasados ya no se reservan
+        today = local_now().date()
+        self._days = {key: value for key, value in self._days.items() if key[1] >= today}
+        self._days[(pharmacy_id, day)] = (minutes, capacity, tree)
+        return tree
+
+    def _bookable_days(self, after: datetime) -> list[date]:
+        today = local_now().date()
+        last = today + timedelta(days=self.booking_days)
+        first = max(after.date(), today)
+        return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+    def _find(self, pharmacy_id: int, minutes: int, capacity: int, after: datetime) -> Optional[tuple[date, int, SlotTree]]:
+        # Nunca una franja que ya empezó
+        after = max(after, local_now())
+        for day in self._bookable_days(after):
+            tree = self._tree(pharmacy_id, day, minutes, capacity)
+            index = tree.first_free(self._slot_index(day, minutes, after) if day == after.date() else 0)
+            if index is not None:
+                return day, index, tree
+        return None
+
+    def next_free(self, pharmacy_id: int, minutes: int, capacity: int, after: datetime) -> Optional[dict]:
+        """Primera franja con cupo que empieza en `after` o después (dentro del horizonte de reservas)."""
+        with self._lock:
+            found = self._find(pharmacy_id, minutes, capacity, after)
+            if found is None:
+                return None
+            day, index, tree = found
+            return {"slot_start": self.slot_starts(day, minutes)[index].strftime(TIMESTAMP_FORMAT), "free": tree.free(index)}
+
+    def day_slots(self, pharmacy_id: int, minutes: int, capacity: int, day: date) -> list[dict]:
+        with self._lock:
+            tree = self._tree(pharmacy_id, day, minutes, capacity)
+            return [
+                {"slot_start": start.strftime(TIMESTAMP_FORMAT), "free": tree.free(index)}
+                for index, start in enumerate(self.slot_starts(day, minutes))
+            ]
+
+    def hold(self, pharmacy_id: int, minutes: int, capacity: int,
+             after: datetime, exact: bool = False) -> Optional[str]:
+        """Toma un cupo de la primera franja libre desde `after` (o de esa misma franja si `exact`)."""
+        with self._lock:
+            if exact:
+                day = after.date()
+                if after < local_now() or day not in self._bookable_days(after):
+                    return None
+                starts = self.slot_starts(day, minutes)
+                index = self._slot_index(day, minutes, after)
+                if index >= len(starts) or starts[index] != after:
+                    return None
+                tree = self._tree(pharmacy_id, day, minutes, capacity)
+                if tree.free(index) <= 0:
+                    return None
+            else:
+                found = self._find(pharmacy_id, minutes, capacity, after)
+                if found is None:
+                    return None
+                day, index, tree = found
+            tree.add(index, -1)
+            return self.slot_starts(day, minutes)[index].strftime(TIMESTAMP_FORMAT)
+
+    def release(self, pharmacy_id: int, slot_start: str) -> None:
+        """Devuelve un cupo (cita cancelada o reserva que no llegó a guardarse)."""
+        moment = datetime.strptime(slot_start, TIMESTAMP_FORMAT)
+        with self._lock:
+            cached = self._days.get((pharmacy_id, moment.date()))
+            if cached is None:
+                return
+            minutes, capacity, tree = cached
+            index = self._slot_index(moment.date(), minutes, moment)
+            if index < tree.size and tree.free(index) < capacity:
+                tree.add(index, 1)
+
+    def invalidate(self, pharmacy_id: int, day: Optional[date] = None) -> None:
+        """Descarta los árboles en memoria (se vuelven a armar desde la base)."""
+        with self._lock:
+            self._days = {
+                key: value for key, value in self._days.items()
+                if key[0] != pharmacy_id or (day is not None and key[1] != day)
+            }
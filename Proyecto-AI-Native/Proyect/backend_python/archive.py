@@ -0,0 +1,238 @@
+import argparse
+import glob
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Iterator, Optional
+
+
+# Archivo de turnos históricos: los turnos con más de N días salen de `turns` y pasan a
+# un archivo SQLite por mes (archive/turns_YYYY_MM.db) que se puede ATTACHar.
+# La tabla viva queda pequeña y las consultas de historial/estadísticas recorren ambas.
+
+DEFAULT_ARCHIVE_DIR = os.getenv("TURNS_ARCHIVE_DIR", "archive")
+DEFAULT_RETENTION_DAYS = int(os.getenv("TURNS_RETENTION_DAYS", "30"))
+
+# SQLite permite 10 bases adjuntas por defecto; dejamos margen para otras conexiones
+MAX_ATTACHED_ARCHIVES = 8
+MOVE_BATCH_SIZE = 5000
+
+ARCHIVE_FILE_RE = re.compile(r"turns_(\d{4})_(\d{2})\.db$")
+
+
+def _next_month(d: date) -> date:
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+class TurnArchive:
+    def __init__(self, db_path: str, archive_dir: str = DEFAULT_ARCHIVE_DIR):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+
+    def archive_path(self, month: date) -> str:
+        return os.path.join(self.archive_dir, f"turns_{month.year:04d}_{month.month:02d}.db")
+
+    def archive_months(self) -> list[date]:
+        """Meses archivados, del más reciente al más antiguo."""
+        months = []
+        for path in glob.glob(os.path.join(self.archive_dir, "turns_*.db")):
+            match = ARCHIVE_FILE_RE.search(path)
+            if match:
+                months.append(date(int(match.group(1)), int(match.group(2)), 1))
+        return sorted(months, reverse=True)
+
+    def months_in_range(self, start: Optional[date], end: Optional[date]) -> list[date]:
+        months = self.archive_months()
+        if start is not None:
+            months = [m for m in months if _next_month(m) > start]
+        if end is not None:
+            months = [m for m in months if m <= end]
+        return months
+
+    # --- Rollover -----------------------------------------------------------------
+
+    @staticmethod
+    def _ensure_archive_schema(conn: sqlite3.Connection, alias: str) -> None:
+        # La tabla archivada replica las columnas actuales de `turns` (incluidas las añadidas por migraciones)
+        live_columns = conn.execute("PRAGMA main.table_info(turns)").fetchall()
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {alias}.turns (id INTEGER PRIMARY KEY)")
+        archived = {row[1] for row in conn.execute(f"PRAGMA {alias}.table_info(turns)")}
+        for _, name, col_type, _, _, _ in live_columns:
+            if name not in archived:
+                conn.execute(f"ALTER TABLE {alias}.turns ADD COLUMN {name} {col_type}")
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS {alias}.idx_turns_user_history
+            ON turns (user_document, requested_at DESC, id DESC,
+                      pharmacy_id, turn_number, status, request_type, called_at, attended_at)
+        ''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_turns_pharmacy_requested ON turns (pharmacy_id, requested_at)")
+
+    def rollover(self, retention_days: int = DEFAULT_RETENTION_DAYS) -> dict:
+        """Mueve a los archivos mensuales los turnos de días anteriores a hoy - retention_days."""
+        cutoff = (datetime.utcnow().date() - timedelta(days=retention_days)).isoformat()
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        conn = sqlite3.connect(self.db_path)
+        moved_by_month: dict[str, int] = {}
+        try:
+            months = conn.execute('''
+                SELECT DISTINCT strftime('%Y-%m', requested_at)
+                FROM turns WHERE requested_at < ?
+            ''', (cutoff,)).fetchall()
+            columns = [row[1] for row in conn.execute("PRAGMA main.table_info(turns)")]
+            column_list = ", ".join(columns)
+
+            for (month_key,) in months:
+                month = datetime.strptime(month_key, "%Y-%m").date()
+                conn.execute("ATTACH DATABASE ? AS arch", (self.archive_path(month),))
+                try:
+                    self._ensure_archive_schema(conn, "arch")
+                    conn.commit()
+                    lower = month.isoformat()
+                    upper = min(_next_month(month).isoformat(), cutoff)
+                    moved = 0
+                    last_id = 0
+                    while True:
+                        # Lotes cortos (keyset por id) para no retener el bloqueo de escritura
+                        ids = [row[0] for row in conn.execute('''
+                            SELECT id FROM main.turns
+                            WHERE id > ? AND requested_at >= ? AND requested_at < ?
+                            ORDER BY id LIMIT ?
+                        ''', (last_id, lower, upper, MOVE_BATCH_SIZE))]
+                        if not ids:
+                            break
+                        last_id = ids[-1]
+                        placeholders = ", ".join("?" for _ in ids)
+                        conn.execute(
+                            f"INSERT OR IGNORE INTO arch.turns ({column_list}) "
+                            f"SELECT {column_list} FROM main.turns WHERE id IN ({placeholders})",
+                            ids,
+                        )
+                        conn.execute(f"DELETE FROM main.turns WHERE id IN ({placeholders})", ids)
+                        conn.commit()
+                        moved += len(ids)
+                    moved_by_month[month_key] = moved
+                finally:
+                    conn.execute("DETACH DATABASE arch")
+        finally:
+            conn.close()
+        self.reserve_archived_ids()
+
+        return {"cutoff": cutoff, "moved": sum(moved_by_month.values()), "by_month": moved_by_month}
+
+    def move_pharmacy(self, pharmacy_id: int, target: "TurnArchive") -> int:
+        """Mueve los turnos archivados de una farmacia a los archivos de `target` (migración a un shard)."""
+        moved = 0
+        for month in self.archive_months():
+            # La conexión abre la base viva de destino: el archivo nuevo replica sus columnas
+            conn = sqlite3.connect(target.db_path, timeout=30)
+            try:
+                conn.execute("ATTACH DATABASE ? AS source", (self.archive_path(month),))
+                if not conn.execute("SELECT 1 FROM source.turns WHERE pharmacy_id = ? LIMIT 1", (pharmacy_id,)).fetchone():
+                    continue
+                os.makedirs(target.archive_dir, exist_ok=True)
+                conn.execute("ATTACH DATABASE ? AS arch", (target.archive_path(month),))
+                self._ensure_archive_schema(conn, "arch")
+                conn.commit()
+                columns = ", ".join(row[1] for row in conn.execute("PRAGMA source.table_info(turns)"))
+                # Copia y luego borra, igual que el rollover: repetir tras una interrupción es seguro
+                conn.execute(
+                    f"INSERT OR REPLACE INTO arch.turns ({columns}) SELECT {columns} FROM source.turns WHERE pharmacy_id = ?",
+                    (pharmacy_id,),
+                )
+                conn.commit()
+                moved += conn.execute("DELETE FROM source.turns WHERE pharmacy_id = ?", (pharmacy_id,)).rowcount
+                conn.commit()
+            finally:
+                conn.close()
+        return moved
+
+    def archived_max_id(self) -> int:
+        max_id = 0
+        for month in self.archive_months():
+            conn = sqlite3.connect(self.archive_path(month))
+            try:
+                max_id = max(max_id, conn.execute("SELECT COALESCE(MAX(id), 0) FROM turns").fetchone()[0])
+            finally:
+                conn.close()
+        return max_id
+
+    def reserve_archived_ids(self) -> int:
+        """Sube la secuencia de `turns` por encima del id archivado más alto.
+
+        Con AUTOINCREMENT los ids no se reutilizan, pero los archivos creados antes de la
+        migración pueden tener ids más altos que la tabla viva.
+        """
+        max_id = self.archived_max_id()
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone() is None:
+                # `turns` sin AUTOINCREMENT (base sin migrar)
+                return max_id
+            updated = conn.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'turns'", (max_id,)
+            ).rowcount
+            if not updated and max_id:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('turns', ?)", (max_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        return max_id
+
+    # --- Consultas sobre vivo + archivos -------------------------------------------
+
+    @contextmanager
+    def history_connection(self, months: list[date], include_live: bool = True) -> Iterator[sqlite3.Connection]:
+        """Conexión con los meses indicados adjuntos y la vista temporal `turns_history`."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            selects = ["SELECT * FROM main.turns"] if include_live else []
+            live_columns = [row[1] for row in conn.execute("PRAGMA main.table_info(turns)")]
+            for index, month in enumerate(months):
+                alias = f"arch{index}"
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (self.archive_path(month),))
+                archived = {row[1] for row in conn.execute(f"PRAGMA {alias}.table_info(turns)")}
+                # Archivos antiguos pueden no tener columnas añadidas después: se rellenan con NULL
+                projection = ", ".join(c if c in archived else f"NULL AS {c}" for c in live_columns)
+                selects.append(f"SELECT {projection} FROM {alias}.turns")
+            conn.execute("CREATE TEMP VIEW turns_history AS " + " UNION ALL ".join(selects))
+            yield conn
+        finally:
+            conn.close()
+
+    def query(self, sql: str, params: tuple = (), start: Optional[date] = None, end: Optional[date] = None) -> list[tuple]:
+        """Ejecuta `sql` (escrito contra `turns_history`) sobre la tabla viva y los archivos del rango.
+
+        Si hay más meses que el límite de ATTACH se ejecuta por grupos y se concatenan las filas;
+        las agregaciones deben agrupar por fecha para que los grupos no se solapen.
+        """
+        months = self.months_in_range(start, end)
+        groups = [months[i:i + MAX_ATTACHED_ARCHIVES] for i in range(0, len(months), MAX_ATTACHED_ARCHIVES)] or [[]]
+        rows: list[tuple] = []
+        for index, group in enumerate(groups):
+            # La tabla viva solo se consulta en el primer grupo
+            with self.history_connection(group, include_live=index == 0) as conn:
+                rows.extend(conn.execute(sql, params).fetchall())
+        return rows
+
+    def query_each_archive(self, sql: str, params: tuple = (), start: Optional[date] = None, end: Optional[date] = None) -> Iterator[list[tuple]]:
+        """Ejecuta `sql` (contra `turns`) en cada archivo, del mes más reciente al más antiguo."""
+        for month in self.months_in_range(start, end):
+            conn = sqlite3.connect(self.archive_path(month))
+            try:
+                yield conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mueve turnos antiguos a archivos SQLite mensuales")
+    parser.add_argument("--db", default="farmacia.db")
+    parser.add_argument("--archive-dir", default=DEFAULT_ARCHIVE_DIR)
+    parser.add_argument("--days", type=int, default=DEFAULT_RETENTION_DAYS, help="Días que se conservan en la tabla viva")
+    args = parser.parse_args()
+
+    result = TurnArchive(args.db, args.archive_dir).rollover(args.days)
+    print(f"Turnos archivados: {result['moved']} (anteriores a {result['cutoff']}) {result['by_month']}")
@@ -0,0 +1,306 @@
+"""Micro-benchmarks de las consultas calientes de main.py a distintas escalas de datos.
+
+Para cada escala se genera una base temporal con el esquema de la app (init_db), se cargan
+farmacias, medicamentos, inventario y turnos sintéticos, y se mide cada sentencia por separado
+(mediana y p95 de N ejecuciones). La tabla final compara escalas y muestra cuánto crece cada
+consulta respecto a la escala más pequeña, junto con su plan (SCAN = recorre la tabla).
+
+Uso:
+    python bench_queries.py
+    python bench_queries.py --scales 10000,100000,1000000 --repeat 30 --json resultados.json
+
+Las sentencias replican las de main.py: si cambia una consulta allí, actualizarla aquí.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from load_test import percentile
+
+MEDICATIONS = 200
+TURNS_PER_PHARMACY = 1000
+HISTORY_DAYS = 30
+
+# (nombre, sql, función que genera los parámetros, es_escritura)
+QUERIES = [
+    (
+        "inventario JOIN medications (original)",
+        """
+        SELECT m.code, m.name, i.current_stock, i.min_threshold,
+               CASE WHEN i.current_stock = 0 THEN 'out_of_stock'
+                    WHEN i.current_stock <= i.min_threshold THEN 'low_stock'
+                    ELSE 'available' END as status,
+               0.0 as demand_score, i.last_updated
+        FROM inventory i
+        JOIN medications m ON i.medication_code = m.code
+        WHERE i.pharmacy_id = ?
+        ORDER BY m.name
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "inventario sin JOIN (catálogo en caché)",
+        """
+        SELECT i.medication_code, i.current_stock, i.min_threshold,
+               CASE WHEN i.current_stock = 0 THEN 'out_of_stock'
+                    WHEN i.current_stock <= i.min_threshold THEN 'low_stock'
+                    ELSE 'available' END as status,
+               0.0 as demand_score, i.last_updated
+        FROM inventory i
+        WHERE i.pharmacy_id = ?
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "COUNT diario con DATE() (original)",
+        """
+        SELECT COUNT(*) FROM turns
+        WHERE pharmacy_id = ? AND request_type = 'digital' AND DATE(requested_at) = DATE('now')
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "COUNT diario por rango",
+        """
+        SELECT COUNT(*) FROM turns
+        WHERE pharmacy_id = ? AND request_type = 'digital'
+        AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "MAX(turn_number) con DATE() (original)",
+        """
+        SELECT MAX(turn_number) FROM turns
+        WHERE pharmacy_id = ? AND DATE(requested_at) = DATE('now')
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "MAX(turn_number) por rango",
+        """
+        SELECT MAX(turn_number) FROM turns
+        WHERE pharmacy_id = ? AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "get_turns ordenado",
+        """
+        SELECT id, turn_number, user_name, status, requested_at, called_at, attended_at, request_type
+        FROM turns
+        WHERE pharmacy_id = ? AND DATE(requested_at) = DATE('now')
+        ORDER BY
+            CASE WHEN status = 'pending' THEN turn_number END ASC,
+            CASE WHEN status IN ('called', 'attended', 'cancelled') THEN called_at END DESC
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "get_turns ordenado por rango",
+        """
+        SELECT id, turn_number, user_name, status, requested_at, called_at, attended_at, request_type
+        FROM turns
+        WHERE pharmacy_id = ? AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        ORDER BY
+            CASE WHEN status = 'pending' THEN turn_number END ASC,
+            CASE WHEN status IN ('called', 'attended', 'cancelled') THEN called_at END DESC
+        """,
+        lambda ctx: (ctx.pharmacy(),),
+        False,
+    ),
+    (
+        "UPDATE condicional de stock",
+        """
+        UPDATE inventory
+        SET current_stock = current_stock - ?, last_updated = CURRENT_TIMESTAMP
+        WHERE pharmacy_id = ? AND medication_code = ? AND current_stock >= ?
+        RETURNING current_stock, min_threshold
+        """,
+        lambda ctx: (1, ctx.pharmacy(), ctx.medication(), 1),
+        True,
+    ),
+    (
+        "historial por usuario",
+        """
+        SELECT id, pharmacy_id, turn_number, status, request_type, requested_at, called_at, attended_at
+        FROM turns INDEXED BY idx_turns_user_history
+        WHERE user_document = ?
+        ORDER BY requested_at DESC, id DESC
+        LIMIT 20
+        """,
+        lambda ctx: (ctx.user(),),
+        False,
+    ),
+]
+
+
+class Context:
+    def __init__(self, pharmacies: int, users: int):
+        self.pharmacies = pharmacies
+        self.users = users
+        self.random = random.Random(7)
+
+    def pharmacy(self) -> int:
+        return self.random.randint(1, self.pharmacies)
+
+    def medication(self) -> str:
+        return f"BEN{self.random.randint(1, MEDICATIONS):04d}"
+
+    def user(self) -> str:
+        return f"U{self.random.randint(1, self.users):08d}"
+
+
+def populate(conn: sqlite3.Connection, turns: int, pharmacies: Optional[int] = None) -> Context:
+    """Carga datos sintéticos: `turns` turnos repartidos en HISTORY_DAYS días.
+
+    Sin `pharmacies` fijo, las farmacias crecen con la escala (TURNS_PER_PHARMACY turnos cada una);
+    con un valor fijo crece la cantidad de turnos por farmacia.
+    """
+    pharmacies = pharmacies or max(10, turns // TURNS_PER_PHARMACY)
+    users = max(100, turns // 5)
+    rng = random.Random(42)
+
+    # Base desechable: sin fsync durante la carga
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    conn.execute("DELETE FROM inventory")
+    conn.execute("DELETE FROM turns")
+    conn.execute("DELETE FROM pharmacies")
+    conn.executemany(
+        "INSERT INTO pharmacies (id, name, address, daily_digital_turn_limit) VALUES (?, ?, ?, 1000000)",
+        ((p, f"Farmacia {p}", f"Calle {p}") for p in range(1, pharmacies + 1)),
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO medications (code, name) VALUES (?, ?)",
+        ((f"BEN{m:04d}", f"Medicamento {m:04d}") for m in range(1, MEDICATIONS + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO inventory (pharmacy_id, medication_code, current_stock, min_threshold) VALUES (?, ?, ?, ?)",
+        (
+            (p, f"BEN{m:04d}", rng.randint(0, 500) + 1_000_000, rng.randint(5, 50))
+            for p in range(1, pharmacies + 1)
+            for m in range(1, MEDICATIONS + 1)
+        ),
+    )
+
+    now = datetime.utcnow()
+    statuses = ("pending", "called", "attended", "cancelled")
+
+    def turn_rows():
+        for n in range(turns):
+            requested = now - timedelta(seconds=rng.randint(0, HISTORY_DAYS * 86400))
+            stamp = requested.strftime("%Y-%m-%d %H:%M:%S")
+            yield (
+                rng.randint(1, pharmacies),
+                f"U{rng.randint(1, users):08d}",
+                "Paciente",
+                f"U{rng.randint(1, users):08d}",
+                n % 500 + 1,
+                statuses[n % 4],
+                "digital" if n % 3 else "physical",
+                stamp,
+                stamp,
+            )
+
+    conn.executemany(
+        """
+        INSERT INTO turns (pharmacy_id, user_id, user_name, user_document, turn_number,
+                           status, request_type, requested_at, called_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        turn_rows(),
+    )
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    return Context(pharmacies, users)
+
+
+def query_plan(conn: sqlite3.Connection, sql: str, params: tuple) -> str:
+    details = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    if any(detail.startswith("SCAN") and "USING" not in detail for detail in details):
+        return "SCAN"
+    return "SEARCH"
+
+
+def time_query(conn: sqlite3.Connection, sql: str, params_for, ctx: Context, repeat: int, is_write: bool) -> list[float]:
+    timings = []
+    if is_write:
+        conn.execute("BEGIN")
+    for _ in range(repeat):
+        params = params_for(ctx)
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    if is_write:
+        # Solo se mide la sentencia; el costo del commit lo cubre bench_writes.py
+        conn.execute("ROLLBACK")
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10000,100000,1000000", help="Cantidades de turnos separadas por coma")
+    parser.add_argument("--pharmacies", type=int, help="Número fijo de farmacias (por defecto crece con la escala)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo")
+    args = parser.parse_args()
+    scales = [int(value) for value in args.scales.split(",")]
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # init_db usa 'farmacia.db' relativo al directorio actual: cada escala en un directorio temporal
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="farmacia-queries-"))
+    import main as app_module
+
+    results: dict[str, dict[int, dict]] = {name: {} for name, _, _, _ in QUERIES}
+    for turns in scales:
+        os.chdir(tempfile.mkdtemp(prefix=f"farmacia-queries-{turns}-"))
+        app_module.init_db()
+        conn = sqlite3.connect("farmacia.db", isolation_level=None)
+        started = time.perf_counter()
+        ctx = populate(conn, turns, args.pharmacies)
+        print(f"Escala {turns:,} turnos / {ctx.pharmacies:,} farmacias: datos generados en {time.perf_counter() - started:.1f}s",
+              file=sys.stderr)
+        for name, sql, params_for, is_write in QUERIES:
+            timings = time_query(conn, sql, params_for, ctx, args.repeat, is_write)
+            results[name][turns] = {
+                "p50_ms": round(percentile(timings, 50), 3),
+                "p95_ms": round(percentile(timings, 95), 3),
+                "plan": query_plan(conn, sql, params_for(ctx)),
+            }
+        conn.close()
+
+    base = scales[0]
+    header = f"{'consulta':<42}" + "".join(f"{f'{s:,} p50 ms':>18}" for s in scales) + f"{'crecimiento':>13}{'plan':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, by_scale in results.items():
+        growth = by_scale[scales[-1]]["p50_ms"] / by_scale[base]["p50_ms"] if by_scale[base]["p50_ms"] else float("inf")
+        row = f"{name:<42}" + "".join(f"{by_scale[s]['p50_ms']:>18.3f}" for s in scales)
+        print(row + f"{growth:>12.1f}x{by_scale[scales[-1]]['plan']:>8}")
+    print(f"\nLos datos crecen {scales[-1] / base:,.0f}x entre la primera y la última escala; "
+          "una consulta que crece en la misma proporción recorre filas proporcionales a los datos "
+          "(SCAN, o un SEARCH que solo usa parte del índice, como DATE(requested_at)).")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"scales": scales, "repeat": args.repeat, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark de escrituras concurrentes: group commit frente a una transacción por petición.
+
+Cada escritor alterna solicitudes de turno, cambios de estado y dispensaciones contra la app
+en proceso (base temporal). Se ejecuta primero sin y luego con group commit.
+
+Uso:
+    python bench_writes.py
+    python bench_writes.py --writers 64 --duration 10
+    FARMACIA_SHARDING=pharmacy python bench_writes.py
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+from load_test import percentile
+
+
+async def writer(client: httpx.AsyncClient, n: int, deadline: float, latencies: list[float], statuses: dict) -> None:
+    i = 0
+    turn_id = None
+    while time.perf_counter() < deadline:
+        i += 1
+        start = time.perf_counter()
+        kind = i % 3
+        if kind == 0 or turn_id is None:
+            response = await client.post("/api/turns/request", json={
+                "pharmacy_id": 1 + n % 2,
+                "user_id": f"BENCH-{n}",
+                "user_name": f"Paciente {n}",
+                "user_document": f"W{n:04d}{i:07d}",
+            })
+            if response.status_code == 200:
+                turn_id = response.json()["turn_id"]
+        elif kind == 1:
+            response = await client.put(f"/api/turns/{turn_id}/status", params={"status": "called"})
+        else:
+            response = await client.post("/api/inventory/update", params={
+                "pharmacy_id": 1 + n % 2,
+                "medication_code": "MED001",
+                "quantity_dispensed": 1,
+            })
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+
+async def run(app_module, writers: int, duration: float, group_commit: bool) -> None:
+    # Con sharding cada shard tiene su escritor
+    writers_by_shard = [shard.writer for shard in app_module.shard_router.shards()]
+    for db_writer in writers_by_shard:
+        db_writer.enabled = group_commit
+        db_writer.batches = 0
+        db_writer.operations = 0
+    transport = httpx.ASGITransport(app=app_module.app, client=("127.0.0.1", 50000))
+    latencies: list[float] = []
+    statuses: dict = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=60) as client:
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(writer(client, n, deadline, latencies, statuses) for n in range(writers)))
+        elapsed = time.perf_counter() - started
+
+    batches = sum(db_writer.batches for db_writer in writers_by_shard)
+    operations = sum(db_writer.operations for db_writer in writers_by_shard)
+    label = "group commit" if group_commit else "commit por petición"
+    print(f"[{label}] escritores: {writers}  duración: {elapsed:.1f}s  sharding: {app_module.shard_router.mode}")
+    print(f"  escrituras/s: {len(latencies) / elapsed:,.0f}  estados: {dict(sorted(statuses.items()))}")
+    print(
+        f"  latencia (ms): p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+        f"p99={percentile(latencies, 99):.1f} media={statistics.fmean(latencies) if latencies else 0:.1f}"
+    )
+    if group_commit:
+        print(f"  lotes: {batches}  tamaño medio de lote: {operations / batches if batches else 0:.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    # La app usa 'farmacia.db' relativo al directorio actual: trabajar en uno temporal
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="farmacia-bench-"))
+    import main as app_module
+
+    conn = sqlite3.connect("farmacia.db")
+    conn.execute("UPDATE pharmacies SET daily_digital_turn_limit = 1000000")
+    conn.commit()
+    conn.close()
+    for shard in app_module.shard_router.shards():
+        conn = sqlite3.connect(shard.db_path)
+        conn.execute("UPDATE inventory SET current_stock = 100000000")
+        conn.commit()
+        conn.close()
+    app_module.catalog.invalidate()
+    app_module.turn_admission.enabled = False
+    app_module.api_concurrency.max_in_flight = 1_000_000
+
+    asyncio.run(run(app_module, args.writers, args.duration, group_commit=False))
+    asyncio.run(run(app_module, args.writers, args.duration, group_commit=True))
+
+
+if __name__ == "__main__":
+    main()
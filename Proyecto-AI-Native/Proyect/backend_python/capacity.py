@@ -0,0 +1,218 @@
+import math
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Optional
+
+from turn_transitions import DAY_CLOSE_TIME
+
+
+# Límite diario de turnos digitales adaptativo.
+# La tasa de servicio de cada farmacia (turnos atendidos por hora ocupada) se estima con
+# called_at/attended_at de los últimos días y se combina con la de hoy cuando ya hay suficientes
+# atenciones. Con ella se proyecta cuántos turnos se pueden atender antes del cierre y se admite
+# un turno digital nuevo solo si cabe detrás de los que ya esperan.
+#
+# daily_digital_turn_limit sigue siendo el límite mientras no haya historial suficiente y
+# define el tope (CAPACITY_MAX_FACTOR veces el configurado) cuando lo hay.
+# La misma política se valida fuera de línea con capacity_sim.py.
+#
+# Solo cuentan las horas de atención que quedan (CAPACITY_OPEN_TIME a CAPACITY_CLOSE_TIME): antes
+# de abrir se proyecta la jornada completa, no las horas con la farmacia cerrada. Las horas son
+# UTC, el mismo reloj del "hoy" de los conteos y de la tarea day-close, y el cierre nunca pasa de
+# TURNS_DAY_CLOSE_TIME: lo que siga en espera a esa hora se cancela.
+
+CAPACITY_CONTROL_ENABLED = os.getenv("CAPACITY_CONTROL_ENABLED", "1") != "0"
+CAPACITY_HISTORY_DAYS = int(os.getenv("CAPACITY_HISTORY_DAYS", "14"))
+CAPACITY_REFRESH_SECONDS = float(os.getenv("CAPACITY_REFRESH_SECONDS", "300"))
+# Fracción de la capacidad proyectada que se ofrece (margen para ausencias y turnos presenciales)
+CAPACITY_SAFETY_FACTOR = float(os.getenv("CAPACITY_SAFETY_FACTOR", "0.9"))
+CAPACITY_MAX_FACTOR = float(os.getenv("CAPACITY_MAX_FACTOR", "2.0"))
+# Atenciones mínimas en el historial (y hoy) para confiar en la tasa estimada
+CAPACITY_MIN_SERVED = int(os.getenv("CAPACITY_MIN_SERVED", "20"))
+# Horario de atención (UTC)
+CAPACITY_OPEN_TIME = os.getenv("CAPACITY_OPEN_TIME", "07:00")
+CAPACITY_CLOSE_TIME = os.getenv("CAPACITY_CLOSE_TIME", "20:00")
+
+# Un día con menos horas ocupadas que esto no da una tasa fiable
+MIN_ACTIVE_HOURS = 0.25
+
+
+def servable_turns(rate_per_hour, remaining_hours, safety: float = CAPACITY_SAFETY_FACTOR):
+    """Turnos que se alcanzan a atender antes del cierre (acepta escalares o arrays de numpy)."""
+    return rate_per_hour * remaining_hours * safety
+
+
+def _hour_minute(value: str) -> tuple[int, int]:
+    hour, minute = (int(part) for part in value.split(":"))
+    return hour, minute
+
+
+def horizon_close(close_time: str = CAPACITY_CLOSE_TIME) -> str:
+    """Cierre que cuenta para la proyección: nunca después del cierre del día."""
+    return min(close_time, DAY_CLOSE_TIME, key=_hour_minute)
+
+
+def remaining_hours(now: datetime, close_time: str = CAPACITY_CLOSE_TIME, open_time: str = CAPACITY_OPEN_TIME) -> float:
+    """Horas de atención que le quedan a hoy (`now` en UTC; 0 si ya cerró)."""
+    open_hour, open_minute = _hour_minute(open_time)
+    close_hour, close_minute = _hour_minute(horizon_close(close_time))
+    opening = now.replace(hour=open_hour, minute=open_minute, second=0, microsecond=0)
+    close = now.replace(hour=close_hour, minute=close_minute, second=0, microsecond=0)
+    return max(0.0, (close - max(now, opening)).total_seconds() / 3600)
+
+
+def busy_hours(intervals: list[tuple[datetime, datetime]]) -> float:
+    """Horas con al menos un turno en atención (unión de los intervalos llamado -> atendido)."""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += (current_end - current_start).total_seconds()
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += (current_end - current_start).total_seconds()
+    return total / 3600
+
+
+def daily_service_rates(conn: sqlite3.Connection, pharmacy_id: int, since: str) -> list[tuple[str, int, float]]:
+    """(día, atendidos, horas ocupadas) por día desde `since`, con idx_turns_pharmacy_requested.
+
+    Se usan las horas ocupadas y no la jornada completa: los ratos sin nadie en cola no deben
+    bajar la tasa (es justo cuando el límite fijo deja mostradores libres).
+    """
+    rows = conn.execute(
+        """
+        SELECT DATE(requested_at), called_at, attended_at
+        FROM turns
+        WHERE pharmacy_id = ? AND requested_at >= ?
+          AND status = 'attended' AND called_at IS NOT NULL AND attended_at >= called_at
+        """,
+        (pharmacy_id, since),
+    ).fetchall()
+    intervals_by_day: dict[str, list[tuple[datetime, datetime]]] = {}
+    for day, called_at, attended_at in rows:
+        intervals_by_day.setdefault(day, []).append(
+            (datetime.fromisoformat(called_at), datetime.fromisoformat(attended_at))
+        )
+    return [
+        (day, len(intervals), busy_hours(intervals))
+        for day, intervals in sorted(intervals_by_day.items())
+    ]
+
+
+def estimate_service_rate(conn: sqlite3.Connection, pharmacy_id: int, now: datetime, history_days: int = CAPACITY_HISTORY_DAYS) -> dict:
+    today = now.date().isoformat()
+    since = (now.date() - timedelta(days=history_days)).isoformat()
+    history_rates = []
+    history_served = 0
+    today_rate = None
+    today_served = 0
+    for day, served, hours in daily_service_rates(conn, pharmacy_id, since):
+        if day == today:
+            today_served = served
+            if served >= CAPACITY_MIN_SERVED and hours >= MIN_ACTIVE_HOURS:
+                today_rate = served / hours
+        elif hours >= MIN_ACTIVE_HOURS:
+            history_rates.append(served / hours)
+            history_served += served
+
+    # Mediana por día: un día atípico (corte de luz, campaña) no mueve la estimación
+    history_rate = statistics.median(history_rates) if history_rates and history_served >= CAPACITY_MIN_SERVED else None
+    if history_rate is not None and today_rate is not None:
+        rate = (history_rate + today_rate) / 2
+    else:
+        rate = history_rate if history_rate is not None else today_rate
+    return {
+        "rate_per_hour": round(rate, 2) if rate is not None else None,
+        "history_rate_per_hour": round(history_rate, 2) if history_rate is not None else None,
+        "today_rate_per_hour": round(today_rate, 2) if today_rate is not None else None,
+        "history_days": len(history_rates),
+        "history_served": history_served,
+        "today_served": today_served,
+    }
+
+
+def effective_limit(
+    rate_per_hour: Optional[float],
+    configured_limit: int,
+    digital_today: int,
+    open_backlog: int,
+    hours_left: float,
+    safety: float = CAPACITY_SAFETY_FACTOR,
+    max_factor: float = CAPACITY_MAX_FACTOR,
+) -> int:
+    """Límite de turnos digitales de hoy: los ya emitidos más los que caben antes del cierre."""
+    if rate_per_hour is None or configured_limit <= 0:
+        return configured_limit
+    headroom = max(0, math.floor(servable_turns(rate_per_hour, hours_left, safety)) - open_backlog)
+    return min(digital_today + headroom, math.floor(configured_limit * max_factor))
+
+
+class CapacityController:
+    def __init__(
+        self,
+        connect: Callable[[int], sqlite3.Connection],
+        enabled: bool = CAPACITY_CONTROL_ENABLED,
+        refresh_seconds: float = CAPACITY_REFRESH_SECONDS,
+        open_time: str = CAPACITY_OPEN_TIME,
+        close_time: str = CAPACITY_CLOSE_TIME,
+    ):
+        # Conexión de lectura a la base (o shard) de cada farmacia
+        self.connect = connect
+        self.enabled = enabled
+        self.refresh_seconds = refresh_seconds
+        self.open_time = open_time
+        self.close_time = close_time
+        self._estimates: dict[int, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, pharmacy_id: int) -> dict:
+        """Estimación de la tasa de servicio, recalculada como mucho cada refresh_seconds."""
+        cached = self._estimates.get(pharmacy_id)
+        if cached is not None and time.monotonic() - cached[0] < self.refresh_seconds:
+            return cached[1]
+        return self._recompute(pharmacy_id)
+
+    def _recompute(self, pharmacy_id: int) -> dict:
+        conn = self.connect(pharmacy_id)
+        try:
+            estimate = estimate_service_rate(conn, pharmacy_id, datetime.utcnow())
+        finally:
+            conn.close()
+        with self._lock:
+            self._estimates[pharmacy_id] = (time.monotonic(), estimate)
+        return estimate
+
+    def refresh(self, pharmacy_ids: Iterable[int]) -> dict:
+        """Recalcula las estimaciones (tarea periódica: create_turn las encuentra en caché)."""
+        if not self.enabled:
+            return {"refreshed": 0}
+        pharmacy_ids = list(pharmacy_ids)
+        for pharmacy_id in pharmacy_ids:
+            self._recompute(pharmacy_id)
+        return {"refreshed": len(pharmacy_ids)}
+
+    def service_rate(self, pharmacy_id: int) -> Optional[float]:
+        if not self.enabled:
+            return None
+        return self.estimate(pharmacy_id)["rate_per_hour"]
+
+    def hours_left(self) -> float:
+        return remaining_hours(datetime.utcnow(), self.close_time, self.open_time)
+
+    def limit(self, rate_per_hour: Optional[float], configured_limit: int, digital_today: int, open_backlog: int) -> int:
+        return effective_limit(rate_per_hour, configured_limit, digital_today, open_backlog, self.hours_left())
+
+    def invalidate(self, pharmacy_id: Optional[int] = None) -> None:
+        with self._lock:
+            if pharmacy_id is None:
+                self._estimates = {}
+            else:
+                self._estimates.pop(pharmacy_id, None)
@@ -0,0 +1,206 @@
+"""Simulador de eventos discretos del límite diario de turnos digitales (fijo frente a adaptativo).
+
+Cada día histórico es una fila: las llegadas de ese día se procesan en orden y todas las
+decisiones de admisión y tiempos de atención se calculan a la vez para todos los días (numpy).
+La cola de cada día es FIFO con la tasa de servicio medida ese día (tiempos exponenciales);
+la política adaptativa usa solo la tasa estimada con los días anteriores, como en producción.
+
+Resultados por día (promedios):
+  - admitidos, atendidos antes del cierre y sin atender al cierre (turnos que no se debían dar)
+  - rechazados y rechazados con la cola vacía (mostrador libre mientras se rechazaba)
+
+Uso:
+    python capacity_sim.py --synthetic --days 60
+    python capacity_sim.py --db farmacia.db --pharmacy-id 1 --demand-factor 1.5
+
+Con datos reales las llegadas son los turnos registrados, que ya vienen recortados por el
+límite vigente: --demand-factor permite probar demanda mayor.
+"""
+import argparse
+import sqlite3
+import statistics
+from datetime import date, timedelta
+
+import numpy as np
+
+from capacity import (
+    CAPACITY_CLOSE_TIME,
+    CAPACITY_HISTORY_DAYS,
+    CAPACITY_MAX_FACTOR,
+    CAPACITY_OPEN_TIME,
+    CAPACITY_SAFETY_FACTOR,
+    daily_service_rates,
+    horizon_close,
+    servable_turns,
+)
+
+
+def parse_hour(value: str) -> float:
+    hour, minute = (int(part) for part in value.split(":"))
+    return hour + minute / 60
+
+
+def synthetic_history(days: int, open_hour: float, close_hour: float, demand: float, rate: float, rng) -> tuple[list, np.ndarray]:
+    """Llegadas con picos de mañana y tarde, y una tasa de servicio que varía por día."""
+    arrivals = []
+    for _ in range(days):
+        count = rng.poisson(demand)
+        morning = rng.normal(open_hour + 2, 1.2, count // 2)
+        afternoon = rng.normal((open_hour + close_hour) / 2 + 2, 1.8, count - count // 2)
+        times = np.clip(np.concatenate([morning, afternoon]), open_hour, close_hour - 0.25)
+        arrivals.append(np.sort(times))
+    rates = np.clip(rng.normal(rate, rate * 0.2, days), rate * 0.3, None)
+    return arrivals, rates
+
+
+def database_history(db_path: str, pharmacy_id: int, days: int) -> tuple[list, np.ndarray]:
+    since = (date.today() - timedelta(days=days)).isoformat()
+    conn = sqlite3.connect(db_path)
+    try:
+        rates = {day: served / hours for day, served, hours in daily_service_rates(conn, pharmacy_id, since) if hours > 0}
+        rows = conn.execute(
+            """
+            SELECT DATE(requested_at), (julianday(requested_at) - julianday(DATE(requested_at))) * 24
+            FROM turns
+            WHERE pharmacy_id = ? AND requested_at >= ? AND requested_at < DATE('now')
+            ORDER BY requested_at
+            """,
+            (pharmacy_id, since),
+        ).fetchall()
+    finally:
+        conn.close()
+    by_day: dict[str, list[float]] = {}
+    for day, hour in rows:
+        by_day.setdefault(day, []).append(hour)
+    # Solo días con tasa de servicio medida
+    days_with_rate = [day for day in sorted(by_day) if day in rates]
+    return [np.array(by_day[day]) for day in days_with_rate], np.array([rates[day] for day in days_with_rate])
+
+
+def scale_demand(arrivals: list, factor: float, rng) -> list:
+    if factor == 1:
+        return arrivals
+    scaled = []
+    for times in arrivals:
+        if len(times) == 0:
+            scaled.append(times)
+            continue
+        count = rng.poisson(len(times) * factor)
+        # Remuestreo del perfil horario del día con un desvío de ~5 minutos
+        sample = rng.choice(times, count) + rng.normal(0, 5 / 60, count)
+        scaled.append(np.sort(np.clip(sample, times.min(), times.max())))
+    return scaled
+
+
+def estimated_rates(true_rates: np.ndarray, history_days: int) -> np.ndarray:
+    """Tasa que vería el controlador cada día: mediana de los días anteriores (NaN sin historial)."""
+    estimates = np.full(len(true_rates), np.nan)
+    for day in range(1, len(true_rates)):
+        estimates[day] = statistics.median(true_rates[max(0, day - history_days):day])
+    return estimates
+
+
+def simulate(
+    arrivals: list,
+    true_rates: np.ndarray,
+    policy_rates: np.ndarray,
+    configured_limit: int,
+    open_hour: float,
+    close_hour: float,
+    safety: float,
+    max_factor: float,
+    rng_seed: int,
+) -> dict:
+    """Simula todos los días a la vez; policy_rates NaN = límite fijo."""
+    days = len(arrivals)
+    width = max((len(times) for times in arrivals), default=0)
+    arrival = np.full((days, width), np.nan)
+    for day, times in enumerate(arrivals):
+        arrival[day, :len(times)] = times
+    # Mismos tiempos de servicio para ambas políticas (misma semilla)
+    service = np.random.default_rng(rng_seed).exponential(1.0, (days, width)) / true_rates[:, None]
+
+    completion = np.full((days, width), np.nan)
+    admitted = np.zeros(days, dtype=int)
+    rejected = np.zeros(days, dtype=int)
+    rejected_idle = np.zeros(days, dtype=int)
+    last_completion = np.full(days, -np.inf)
+    cap = np.floor(configured_limit * max_factor)
+
+    for k in range(width):
+        now = arrival[:, k]
+        valid = ~np.isnan(now)
+        # Turnos admitidos que todavía no terminaron cuando llega este
+        backlog = np.sum(completion[:, :k] > now[:, None], axis=1)
+        # Antes de abrir solo cuenta la jornada (como remaining_hours)
+        hours_left = np.clip(close_hour - np.maximum(now, open_hour), 0, None)
+        headroom = np.maximum(0, np.floor(servable_turns(policy_rates, hours_left, safety)) - backlog)
+        limit = np.where(np.isnan(policy_rates), configured_limit, np.minimum(admitted + headroom, cap))
+
+        admit = valid & (admitted < limit)
+        finish = np.maximum(np.maximum(np.nan_to_num(now, nan=0.0), open_hour), last_completion) + service[:, k]
+        completion[:, k] = np.where(admit, finish, np.nan)
+        last_completion = np.where(admit, finish, last_completion)
+        admitted += admit
+        rejected += valid & ~admit
+        rejected_idle += valid & ~admit & (backlog == 0)
+
+    served = np.sum(completion <= close_hour, axis=1)
+    return {
+        "admitted": admitted,
+        "served": served,
+        "unserved_at_close": admitted - served,
+        "rejected": rejected,
+        "rejected_idle": rejected_idle,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="farmacia.db")
+    parser.add_argument("--pharmacy-id", type=int, default=1)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--synthetic", action="store_true", help="Generar el historial en lugar de leerlo de la base")
+    parser.add_argument("--demand", type=float, default=180, help="Llegadas por día (sintético)")
+    parser.add_argument("--service-rate", type=float, default=12, help="Atenciones por hora (sintético)")
+    parser.add_argument("--open-time", default=CAPACITY_OPEN_TIME, help="Apertura (UTC)")
+    parser.add_argument("--close-time", default=CAPACITY_CLOSE_TIME, help="Cierre (UTC; nunca después de TURNS_DAY_CLOSE_TIME)")
+    parser.add_argument("--limit", type=int, default=100, help="daily_digital_turn_limit configurado")
+    parser.add_argument("--demand-factor", type=float, default=1.0)
+    parser.add_argument("--safety", type=float, default=CAPACITY_SAFETY_FACTOR)
+    parser.add_argument("--max-factor", type=float, default=CAPACITY_MAX_FACTOR)
+    parser.add_argument("--history-days", type=int, default=CAPACITY_HISTORY_DAYS)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    open_hour = parse_hour(args.open_time)
+    close_hour = parse_hour(horizon_close(args.close_time))
+    if args.synthetic:
+        arrivals, rates = synthetic_history(args.days, open_hour, close_hour, args.demand, args.service_rate, rng)
+    else:
+        arrivals, rates = database_history(args.db, args.pharmacy_id, args.days)
+        if not arrivals:
+            parser.error("No hay días con turnos atendidos en el historial; use --synthetic")
+    arrivals = scale_demand(arrivals, args.demand_factor, rng)
+
+    policies = {
+        "fijo": np.full(len(rates), np.nan),
+        "adaptativo": estimated_rates(rates, args.history_days),
+    }
+    print(f"Días simulados: {len(arrivals)}  llegadas/día: {np.mean([len(a) for a in arrivals]):.0f}  "
+          f"tasa de servicio media: {rates.mean():.1f}/h  límite fijo: {args.limit}")
+    header = f"{'política':<12}{'admitidos':>11}{'atendidos':>11}{'sin atender':>13}{'rechazados':>12}{'rech. ociosos':>15}"
+    print(header)
+    print("-" * len(header))
+    for name, policy_rates in policies.items():
+        result = simulate(arrivals, rates, policy_rates, args.limit, open_hour, close_hour, args.safety, args.max_factor, args.seed)
+        print(
+            f"{name:<12}{result['admitted'].mean():>11.1f}{result['served'].mean():>11.1f}"
+            f"{result['unserved_at_close'].mean():>13.1f}{result['rejected'].mean():>12.1f}"
+            f"{result['rejected_idle'].mean():>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+# Caché en proceso de datos de referencia (farmacias y catálogo de medicamentos).
+# Estos datos casi no cambian: se cargan completos una vez, se invalidan explícitamente en
+# las escrituras de administración y se recargan igualmente al vencer el TTL
+# (por si otra instancia o un script modificó la base).
+
+DEFAULT_CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "300"))
+
+PHARMACY_COLUMNS = (
+    "id", "name", "address", "phone", "daily_digital_turn_limit", "latitude", "longitude", "region",
+    "appointment_slot_minutes", "appointment_slot_capacity",
+)
+MEDICATION_COLUMNS = ("code", "name", "description")
+
+
+class CatalogCache:
+    def __init__(self, db_path: str, ttl_seconds: float = DEFAULT_CATALOG_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._pharmacies: dict[int, dict] = {}
+        self._medications: dict[str, dict] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _load(self) -> None:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            pharmacies = {
+                row[0]: dict(zip(PHARMACY_COLUMNS, row))
+                for row in conn.execute(f"SELECT {', '.join(PHARMACY_COLUMNS)} FROM pharmacies")
+            }
+            medications = {
+                row[0]: dict(zip(MEDICATION_COLUMNS, row))
+                for row in conn.execute(f"SELECT {', '.join(MEDICATION_COLUMNS)} FROM medications")
+            }
+        finally:
+            conn.close()
+        # Reemplazo atómico: los lectores ven el catálogo anterior o el nuevo, nunca uno a medias
+        self._pharmacies = pharmacies
+        self._medications = medications
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def _ensure_fresh(self) -> None:
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl_seconds:
+            return
+        with self._lock:
+            # Otro hilo pudo recargar mientras esperábamos el lock
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl_seconds:
+                self._load()
+
+    def pharmacy(self, pharmacy_id: int) -> Optional[dict]:
+        self._ensure_fresh()
+        return self._pharmacies.get(pharmacy_id)
+
+    def medication(self, code: str) -> Optional[dict]:
+        self._ensure_fresh()
+        return self._medications.get(code)
+
+    def medications(self) -> dict[str, dict]:
+        """Catálogo de medicamentos completo (no modificar: se reemplaza entero en cada cambio)."""
+        self._ensure_fresh()
+        return self._medications
+
+    def pharmacy_ids(self) -> set[int]:
+        self._ensure_fresh()
+        return set(self._pharmacies)
+
+    def medication_codes(self) -> set[str]:
+        self._ensure_fresh()
+        return set(self._medications)
+
+    def invalidate(self) -> None:
+        """Fuerza la recarga completa en la siguiente lectura."""
+        with self._lock:
+            self._loaded_at = None
+
+    def refresh_pharmacy(self, pharmacy_id: int) -> None:
+        """Recarga una sola farmacia después de una escritura de administración."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute(
+                f"SELECT {', '.join(PHARMACY_COLUMNS)} FROM pharmacies WHERE id = ?", (pharmacy_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            pharmacies = dict(self._pharmacies)
+            if row is None:
+                pharmacies.pop(pharmacy_id, None)
+            else:
+                pharmacies[pharmacy_id] = dict(zip(PHARMACY_COLUMNS, row))
+            self._pharmacies = pharmacies
+
+    def refresh_medication(self, code: str) -> None:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute(
+                f"SELECT {', '.join(MEDICATION_COLUMNS)} FROM medications WHERE code = ?", (code,)
+            ).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            medications = dict(self._medications)
+            if row is None:
+                medications.pop(code, None)
+            else:
+                medications[code] = dict(zip(MEDICATION_COLUMNS, row))
+            self._medications = medications
+
+    def stats(self) -> dict:
+        loaded_at = self._loaded_at
+        return {
+            "pharmacies": len(self._pharmacies),
+            "medications": len(self._medications),
+            "reloads": self.reloads,
+            "age_seconds": round(time.monotonic() - loaded_at, 1) if loaded_at is not None else None,
+            "ttl_seconds": self.ttl_seconds,
+        }
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+
+# Tablero en vivo de las colas: contadores por farmacia y estado de los turnos de hoy y el
+# último turno llamado, en memoria. Se reconstruyen desde SQLite al arrancar y cada transición
+# (solicitud, cambio de estado, transiciones en bloque y cierre del día) los ajusta en O(1),
+# así el tablero de todas las farmacias no lee la tabla turns.
+#
+# Solo se cuentan los turnos solicitados hoy (UTC, igual que get_turns); al cambiar el día los
+# contadores vuelven a cero y las transiciones de turnos de días anteriores se ignoran.
+
+DASHBOARD_STATUSES = ("pending", "called", "attended", "cancelled")
+
+
+def _utc_today() -> str:
+    return datetime.utcnow().date().isoformat()
+
+
+class QueueDashboard:
+    def __init__(self):
+        self._day = _utc_today()
+        # pharmacy_id -> {estado: cantidad}
+        self._counts: dict[int, dict[str, int]] = {}
+        # pharmacy_id -> (turn_number, called_at) del último turno llamado
+        self._current: dict[int, tuple[int, Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            self._day = _utc_today()
+            self._counts = {}
+            self._current = {}
+        self.extend(conn)
+
+    def extend(self, conn: sqlite3.Connection) -> None:
+        """Suma los turnos de hoy de otra base (un shard)."""
+        day = self._day
+        next_day = (datetime.fromisoformat(day) + timedelta(days=1)).date().isoformat()
+        counts = conn.execute(
+            '''
+            SELECT pharmacy_id, status, COUNT(*) FROM turns
+            WHERE requested_at >= ? AND requested_at < ?
+            GROUP BY pharmacy_id, status
+            ''',
+            (day, next_day),
+        ).fetchall()
+        called = conn.execute(
+            '''
+            SELECT pharmacy_id, turn_number, called_at FROM turns
+            WHERE requested_at >= ? AND requested_at < ? AND called_at IS NOT NULL
+            ORDER BY called_at, turn_number
+            ''',
+            (day, next_day),
+        ).fetchall()
+        with self._lock:
+            if self._day != day:
+                return
+            for pharmacy_id, status, count in counts:
+                pharmacy_counts = self._counts.setdefault(pharmacy_id, dict.fromkeys(DASHBOARD_STATUSES, 0))
+                pharmacy_counts[status] = pharmacy_counts.get(status, 0) + count
+            for pharmacy_id, turn_number, called_at in called:
+                self._current[pharmacy_id] = (turn_number, called_at)
+
+    def _roll_day(self) -> None:
+        today = _utc_today()
+        if today != self._day:
+            self._day = today
+            self._counts = {}
+            self._current = {}
+
+    def apply(
+        self,
+        turn_id: int,
+        pharmacy_id: int,
+        requested_at: str,
+        turn_number: int,
+        old_status: Optional[str],
+        new_status: str,
+    ) -> None:
+        """Refleja una transición (old_status None = turno nuevo)."""
+        if old_status == new_status:
+            return
+        with self._lock:
+            self._roll_day()
+            if str(requested_at)[:10] != self._day:
+                return
+            counts = self._counts.setdefault(pharmacy_id, dict.fromkeys(DASHBOARD_STATUSES, 0))
+            if old_status is not None:
+                counts[old_status] = max(0, counts.get(old_status, 0) - 1)
+            counts[new_status] = counts.get(new_status, 0) + 1
+            if new_status == "called":
+                self._current[pharmacy_id] = (turn_number, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+
+    def snapshot(self, pharmacy_ids: Iterable[int]) -> dict:
+        """Contadores de hoy de cada farmacia (en cero si no tiene turnos)."""
+        with self._lock:
+            self._roll_day()
+            day = self._day
+            counts = {pharmacy_id: dict(values) for pharmacy_id, values in self._counts.items()}
+            current = dict(self._current)
+        pharmacies = []
+        for pharmacy_id in pharmacy_ids:
+            pharmacy_counts = counts.get(pharmacy_id) or dict.fromkeys(DASHBOARD_STATUSES, 0)
+            current_turn, called_at = current.get(pharmacy_id, (None, None))
+            pharmacies.append({
+                "pharmacy_id": pharmacy_id,
+                **pharmacy_counts,
+                "total": sum(pharmacy_counts.values()),
+                "current_turn": current_turn,
+                "current_turn_called_at": called_at,
+            })
+        return {"date": day, "pharmacies": pharmacies}
@@ -0,0 +1,218 @@
+import asyncio
+import contextvars
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from tracing import tracer, traced_connect
+
+
+# Escritor único con group commit.
+# Las operaciones de escritura de los endpoints calientes (turnos, dispensación, cambios de estado)
+# se encolan y un hilo dedicado las agrupa en una sola transacción, acotada por tamaño y tiempo:
+# un fsync por lote en lugar de uno por petición, y sin competir por el bloqueo de escritura.
+# Cada operación corre en su propio SAVEPOINT: si falla, solo se deshace esa operación y su
+# excepción (p. ej. HTTPException) llega únicamente a quien la envió.
+#
+# Las lecturas usan conexiones aparte en modo solo lectura (ver read_connection).
+#
+# Cada operación corre con el contexto de trazas de quien la envió: sus sentencias SQL quedan
+# en la traza de la petición, junto con la espera en cola, el BEGIN (bloqueo) y el COMMIT del lote.
+
+GROUP_COMMIT_ENABLED = os.getenv("FARMACIA_GROUP_COMMIT", "1") != "0"
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("FARMACIA_GROUP_COMMIT_MAX_BATCH", "128"))
+GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv("FARMACIA_GROUP_COMMIT_MAX_DELAY_MS", "2"))
+
+# Una operación recibe la conexión del escritor, no hace commit y devuelve su resultado
+WriteOperation = Callable[[sqlite3.Connection], Any]
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    # WAL: los lectores no bloquean al escritor ni al revés
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+
+
+def ensure_autoincrement(conn: sqlite3.Connection, table: str) -> bool:
+    """Reconstruye `table` con `id INTEGER PRIMARY KEY AUTOINCREMENT` si aún no lo tiene.
+
+    Sin AUTOINCREMENT SQLite reutiliza los ids más altos cuando se borran (p. ej. al archivar
+    turnos). Conserva filas, columnas añadidas por migraciones, índices y triggers.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        if row is None or "AUTOINCREMENT" in row[0].upper():
+            conn.rollback()
+            return False
+        create_sql, replaced = re.subn(
+            r"\bid\s+INTEGER\s+PRIMARY\s+KEY\b", "id INTEGER PRIMARY KEY AUTOINCREMENT", row[0], count=1, flags=re.IGNORECASE
+        )
+        if not replaced:
+            raise ValueError(f"{table}.id no es INTEGER PRIMARY KEY")
+        create_sql = re.sub(r"^CREATE TABLE\s+\S+", f"CREATE TABLE {table}_rebuild", create_sql, count=1)
+        dependents = [sql for (sql,) in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+            (table,),
+        )]
+        conn.execute(create_sql)
+        # Copiar ids explícitos deja sqlite_sequence en el id más alto
+        conn.execute(f"INSERT INTO {table}_rebuild SELECT * FROM {table}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+        for sql in dependents:
+            conn.execute(sql)
+        conn.commit()
+        return True
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def read_connection(db_path: str) -> sqlite3.Connection:
+    """Conexión de solo lectura (mode=ro + query_only) para endpoints de consulta."""
+    conn = traced_connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class GroupCommitWriter:
+    def __init__(
+        self,
+        db_path: str,
+        enabled: bool = GROUP_COMMIT_ENABLED,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+        max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS,
+    ):
+        self.db_path = db_path
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="farmacia-db-writer", daemon=True)
+                self._thread.start()
+
+    async def submit(self, operation: WriteOperation) -> Any:
+        """Ejecuta `operation` dentro del próximo lote y devuelve su resultado tras el commit."""
+        if not self.enabled:
+            # Sin group commit: una transacción (y un fsync) por operación, como antes
+            return await asyncio.to_thread(self._run_single, operation)
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((operation, loop, future, contextvars.copy_context(), time.time_ns()))
+        return await future
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: BEGIN/SAVEPOINT/COMMIT se controlan explícitamente
+        conn = traced_connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        configure_connection(conn)
+        return conn
+
+    def _run_single(self, operation: WriteOperation) -> Any:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = operation(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        finally:
+            conn.close()
+
+    def _collect(self) -> list[tuple]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Vaciar lo que ya esté encolado sin esperar más
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        conn = self._connect()
+        while True:
+            batch = self._collect()
+            outcomes: list[tuple[bool, Any]] = []
+            begin_ns = time.time_ns()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                begun_ns = time.time_ns()
+                for operation, _, _, context, _ in batch:
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        result = context.run(operation, conn)
+                        conn.execute("RELEASE op")
+                        outcomes.append((True, result))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO op")
+                        conn.execute("RELEASE op")
+                        outcomes.append((False, e))
+                commit_ns = time.time_ns()
+                conn.execute("COMMIT")
+                committed_ns = time.time_ns()
+                for _, _, _, context, queued_ns in batch:
+                    context.run(self._record_batch_spans, len(batch), queued_ns, begin_ns, begun_ns, commit_ns, committed_ns)
+            except Exception as e:
+                # Falló el lote completo (p. ej. disco lleno): todas las operaciones reciben el error
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                outcomes = [(False, e)] * len(batch)
+
+            self.batches += 1
+            self.operations += len(batch)
+            for (_, loop, future, _, _), (ok, value) in zip(batch, outcomes):
+                loop.call_soon_threadsafe(self._resolve, future, ok, value)
+
+    @staticmethod
+    def _record_batch_spans(batch_size: int, queued_ns: int, begin_ns: int, begun_ns: int, commit_ns: int, committed_ns: int) -> None:
+        # Tramos compartidos por todo el lote, registrados en la traza de cada operación
+        tracer.record_span("db_writer queue wait", queued_ns, begin_ns)
+        tracer.record_span("sqlite BEGIN IMMEDIATE", begin_ns, begun_ns, **{"db.system": "sqlite", "db_writer.batch_size": batch_size})
+        tracer.record_span("sqlite COMMIT", commit_ns, committed_ns, **{"db.system": "sqlite", "db_writer.batch_size": batch_size})
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, ok: bool, value: Any) -> None:
+        if future.cancelled():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "batches": self.batches,
+            "operations": self.operations,
+            "avg_batch_size": round(self.operations / self.batches, 2) if self.batches else None,
+            "queued": self._queue.qsize(),
+        }
@@ -0,0 +1,382 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable, Optional
+
+from archive import TurnArchive
+from shards import shard_databases
+
+
+# Mapas de calor de demanda por farmacia y hora, sin recorrer `turns`.
+# Por (farmacia, fecha, hora de solicitud) se cuentan las llegadas de turnos y se guarda un
+# histograma de la espera hasta la atención en buckets logarítmicos fijos: el bucket i cubre
+# [WAIT_MIN_SECONDS * r^(i-1), WAIT_MIN_SECONDS * r^i) con r = 2^(1/4), así cualquier percentil
+# se estima con un error relativo de ~9 %. Los histogramas se suman bucket a bucket (se pueden
+# mezclar entre horas, días y workers sin perder nada).
+#
+# Cada worker acumula en memoria los deltas de sus transiciones (O(1) por evento) y la tarea
+# programada demand-flush los suma a la tabla demand_histograms de la base (o shard) de cada
+# farmacia. Las consultas leen la tabla y agregan los deltas de este worker que aún no se
+# guardaron.
+#
+# backfill reescribe las celdas desde los turnos: los deltas pendientes de esas celdas ya están
+# en los turnos y se sumarían dos veces. Dentro de la app (POST /api/admin/demand/backfill) se
+# descartan los de este worker mientras la base está bloqueada; el script se corre con los
+# workers detenidos (al apagarse guardan lo pendiente).
+
+DEMAND_FLUSH_SECONDS = float(os.getenv("DEMAND_FLUSH_SECONDS", "60"))
+
+WAIT_MIN_SECONDS = 10.0
+WAIT_MAX_SECONDS = 12 * 3600.0
+WAIT_GROWTH = 2 ** 0.25
+# Bucket 0: menos de WAIT_MIN_SECONDS; el último también recibe las esperas mayores al máximo
+WAIT_BUCKETS = math.ceil(math.log(WAIT_MAX_SECONDS / WAIT_MIN_SECONDS, WAIT_GROWTH)) + 1
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+def init_demand_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS demand_histograms (
+            pharmacy_id INTEGER NOT NULL,
+            stat_date TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            arrivals INTEGER NOT NULL DEFAULT 0,
+            wait_count INTEGER NOT NULL DEFAULT 0,
+            wait_buckets TEXT NOT NULL,
+            PRIMARY KEY (pharmacy_id, stat_date, hour)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def wait_bucket(seconds: float) -> int:
+    if seconds < WAIT_MIN_SECONDS:
+        return 0
+    index = int(math.log(seconds / WAIT_MIN_SECONDS, WAIT_GROWTH)) + 1
+    return min(index, WAIT_BUCKETS - 1)
+
+
+def bucket_value(index: int) -> float:
+    """Valor representativo (media geométrica de los bordes) de un bucket, en segundos."""
+    if index == 0:
+        return WAIT_MIN_SECONDS / 2
+    return WAIT_MIN_SECONDS * WAIT_GROWTH ** (index - 0.5)
+
+
+def estimate_percentiles(buckets: list[int], percentiles: Iterable[float] = DEFAULT_PERCENTILES) -> dict:
+    """Percentiles (en minutos) de un histograma; None si está vacío."""
+    total = sum(buckets)
+    result = {}
+    for percentile in percentiles:
+        if total == 0:
+            result[f"p{percentile:g}"] = None
+            continue
+        rank = max(1, math.ceil(total * percentile / 100))
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if seen >= rank:
+                result[f"p{percentile:g}"] = round(bucket_value(index) / 60, 1)
+                break
+    return result
+
+
+def _hour_key(requested_at: str) -> tuple[str, int, datetime]:
+    requested = datetime.fromisoformat(str(requested_at))
+    return requested.date().isoformat(), requested.hour, requested
+
+
+class DemandHistograms:
+    def __init__(self, db_path_for: Callable[[int], str]):
+        # Base (o shard) donde se guardan los histogramas de cada farmacia
+        self.db_path_for = db_path_for
+        # (pharmacy_id, fecha, hora) -> [llegadas, esperas, buckets] aún no guardados
+        self._pending: dict[tuple[int, str, int], list] = {}
+        self._lock = threading.Lock()
+        self.flushes = 0
+
+    def _delta(self, key: tuple[int, str, int]) -> list:
+        # Llamar con el lock tomado
+        delta = self._pending.get(key)
+        if delta is None:
+            delta = self._pending[key] = [0, 0, [0] * WAIT_BUCKETS]
+        return delta
+
+    def record_arrival(self, pharmacy_id: int, requested_at: str) -> None:
+        stat_date, hour, _ = _hour_key(requested_at)
+        with self._lock:
+            self._delta((pharmacy_id, stat_date, hour))[0] += 1
+
+    def record_wait(self, pharmacy_id: int, requested_at: str, seconds: float) -> None:
+        stat_date, hour, _ = _hour_key(requested_at)
+        index = wait_bucket(max(0.0, seconds))
+        with self._lock:
+            delta = self._delta((pharmacy_id, stat_date, hour))
+            delta[1] += 1
+            delta[2][index] += 1
+
+    def apply(
+        self,
+        turn_id: int,
+        pharmacy_id: int,
+        requested_at: str,
+        turn_number: int,
+        old_status: Optional[str],
+        new_status: str,
+    ) -> None:
+        """Refleja una transición (old_status None = turno nuevo)."""
+        if old_status is None:
+            self.record_arrival(pharmacy_id, requested_at)
+        if new_status == "attended" and old_status != "attended":
+            # attended_at es el momento de la transición (CURRENT_TIMESTAMP en la misma escritura)
+            _, _, requested = _hour_key(requested_at)
+            self.record_wait(pharmacy_id, requested_at, (datetime.utcnow() - requested).total_seconds())
+
+    def flush(self) -> dict:
+        """Suma los deltas pendientes a demand_histograms (tarea periódica del planificador)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        by_db: dict[str, dict] = {}
+        for key, delta in pending.items():
+            by_db.setdefault(self.db_path_for(key[0]), {})[key] = delta
+        flushed = 0
+        remaining = list(by_db.items())
+        while remaining:
+            db_path, deltas = remaining[0]
+            try:
+                self._merge(db_path, deltas)
+            except Exception:
+                # Los deltas de esta base y de las siguientes vuelven a la cola para el próximo intento
+                with self._lock:
+                    for _, failed in remaining:
+                        for key, (arrivals, wait_count, buckets) in failed.items():
+                            delta = self._delta(key)
+                            delta[0] += arrivals
+                            delta[1] += wait_count
+                            delta[2] = [a + b for a, b in zip(delta[2], buckets)]
+                raise
+            flushed += len(deltas)
+            remaining.pop(0)
+        self.flushes += 1
+        return {"buckets": flushed}
+
+    @staticmethod
+    def _merge(db_path: str, deltas: dict[tuple[int, str, int], list]) -> None:
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = []
+            for (pharmacy_id, stat_date, hour), (arrivals, wait_count, buckets) in deltas.items():
+                existing = conn.execute(
+                    """
+                    SELECT arrivals, wait_count, wait_buckets FROM demand_histograms
+                    WHERE pharmacy_id = ? AND stat_date = ? AND hour = ?
+                    """,
+                    (pharmacy_id, stat_date, hour),
+                ).fetchone()
+                if existing is not None:
+                    arrivals += existing[0]
+                    wait_count += existing[1]
+                    buckets = [a + b for a, b in zip(buckets, json.loads(existing[2]))]
+                rows.append((pharmacy_id, stat_date, hour, arrivals, wait_count, json.dumps(buckets, separators=(",", ":"))))
+            conn.executemany("INSERT OR REPLACE INTO demand_histograms VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load(self, conn: sqlite3.Connection, pharmacy_id: int, start: date, end: date) -> dict[tuple[str, int], list]:
+        """(fecha, hora) -> [llegadas, esperas, buckets] del rango: guardado + pendiente."""
+        cells: dict[tuple[str, int], list] = {}
+        for stat_date, hour, arrivals, wait_count, buckets in conn.execute(
+            """
+            SELECT stat_date, hour, arrivals, wait_count, wait_buckets FROM demand_histograms
+            WHERE pharmacy_id = ? AND stat_date BETWEEN ? AND ?
+            """,
+            (pharmacy_id, start.isoformat(), end.isoformat()),
+        ):
+            cells[(stat_date, hour)] = [arrivals, wait_count, json.loads(buckets)]
+        with self._lock:
+            pending = [
+                (key[1:], arrivals, wait_count, list(buckets))
+                for key, (arrivals, wait_count, buckets) in self._pending.items()
+                if key[0] == pharmacy_id and start.isoformat() <= key[1] <= end.isoformat()
+            ]
+        for key, arrivals, wait_count, buckets in pending:
+            cell = cells.setdefault(key, [0, 0, [0] * WAIT_BUCKETS])
+            cell[0] += arrivals
+            cell[1] += wait_count
+            cell[2] = [a + b for a, b in zip(cell[2], buckets)]
+        return cells
+
+    def heatmap(self, conn: sqlite3.Connection, pharmacy_id: int, start: date, end: date) -> dict:
+        """Llegadas y espera mediana por día y hora, con la hora pico de cada día y del rango."""
+        cells = self._load(conn, pharmacy_id, start, end)
+        days = []
+        totals = [0] * 24
+        for offset in range((end - start).days + 1):
+            stat_date = (start + timedelta(days=offset)).isoformat()
+            arrivals = [cells.get((stat_date, hour), [0])[0] for hour in range(24)]
+            medians = [
+                estimate_percentiles(cells[(stat_date, hour)][2], (50,))["p50"] if (stat_date, hour) in cells else None
+                for hour in range(24)
+            ]
+            totals = [a + b for a, b in zip(totals, arrivals)]
+            days.append({
+                "date": stat_date,
+                "arrivals": arrivals,
+                "wait_p50_minutes": medians,
+                "total": sum(arrivals),
+                "peak_hour": arrivals.index(max(arrivals)) if any(arrivals) else None,
+            })
+        return {
+            "pharmacy_id": pharmacy_id,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "days": days,
+            "arrivals_by_hour": totals,
+            "peak_hour": totals.index(max(totals)) if any(totals) else None,
+        }
+
+    def percentiles(
+        self,
+        conn: sqlite3.Connection,
+        pharmacy_id: int,
+        start: date,
+        end: date,
+        hour: Optional[int] = None,
+        percentiles: Iterable[float] = DEFAULT_PERCENTILES,
+    ) -> dict:
+        """Percentiles de espera del rango (todas las horas o una) y por hora del día."""
+        percentiles = tuple(percentiles)
+        cells = self._load(conn, pharmacy_id, start, end)
+        by_hour = [[0] * WAIT_BUCKETS for _ in range(24)]
+        for (_, cell_hour), (_, _, buckets) in cells.items():
+            by_hour[cell_hour] = [a + b for a, b in zip(by_hour[cell_hour], buckets)]
+        selected = by_hour[hour] if hour is not None else [sum(column) for column in zip(*by_hour)]
+        return {
+            "pharmacy_id": pharmacy_id,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "hour": hour,
+            "count": sum(selected),
+            **estimate_percentiles(selected, percentiles),
+            "by_hour": [
+                {"hour": h, "count": sum(buckets), **estimate_percentiles(buckets, percentiles)}
+                for h, buckets in enumerate(by_hour) if sum(buckets)
+            ],
+        }
+
+    def discard(self, db_path: str, start: Optional[date] = None, end: Optional[date] = None) -> int:
+        """Descarta los deltas pendientes de las farmacias de `db_path` en el rango (los recalcula backfill)."""
+        first = start.isoformat() if start is not None else None
+        last = end.isoformat() if end is not None else None
+        with self._lock:
+            keys = [
+                key for key in self._pending
+                if (first is None or key[1] >= first) and (last is None or key[1] <= last)
+                and self.db_path_for(key[0]) == db_path
+            ]
+            for key in keys:
+                del self._pending[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending_buckets": pending, "flushes": self.flushes, "wait_buckets": WAIT_BUCKETS}
+
+
+def backfill(
+    db_path: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    archive: Optional[TurnArchive] = None,
+    on_locked: Optional[Callable[[], None]] = None,
+) -> int:
+    """Recalcula los histogramas del rango desde `turns` y los archivos mensuales.
+
+    on_locked corre con la base bloqueada para escritura, antes de leer los turnos.
+    """
+    archive = archive or TurnArchive(db_path)
+    conditions = []
+    params: list = []
+    if start is not None:
+        conditions.append("requested_at >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append("requested_at < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = sqlite3.connect(db_path)
+    try:
+        init_demand_schema(conn)
+        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        if on_locked is not None:
+            on_locked()
+        rows = archive.query(
+            f"""
+            SELECT pharmacy_id, requested_at,
+                   CASE WHEN status = 'attended' AND attended_at IS NOT NULL
+                        THEN (julianday(attended_at) - julianday(requested_at)) * 86400 END
+            FROM turns_history
+            {where}
+            """,
+            tuple(params),
+            start,
+            end,
+        )
+        cells: dict[tuple[int, str, int], list] = {}
+        for pharmacy_id, requested_at, wait_seconds in rows:
+            stat_date, hour, _ = _hour_key(requested_at)
+            cell = cells.setdefault((pharmacy_id, stat_date, hour), [0, 0, [0] * WAIT_BUCKETS])
+            cell[0] += 1
+            if wait_seconds is not None:
+                cell[1] += 1
+                cell[2][wait_bucket(max(0.0, wait_seconds))] += 1
+
+        delete_conditions = []
+        delete_params: list = []
+        if start is not None:
+            delete_conditions.append("stat_date >= ?")
+            delete_params.append(start.isoformat())
+        if end is not None:
+            delete_conditions.append("stat_date <= ?")
+            delete_params.append(end.isoformat())
+        delete_where = f"WHERE {' AND '.join(delete_conditions)}" if delete_conditions else ""
+        conn.execute(f"DELETE FROM demand_histograms {delete_where}", delete_params)
+        conn.executemany(
+            "INSERT INTO demand_histograms VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (pharmacy_id, stat_date, hour, arrivals, wait_count, json.dumps(buckets, separators=(",", ":")))
+                for (pharmacy_id, stat_date, hour), (arrivals, wait_count, buckets) in cells.items()
+            ],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return len(cells)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reconstruye los histogramas demand_histograms desde los turnos existentes",
+        epilog="Correr con los workers detenidos: sus deltas aún no guardados se sumarían dos veces. "
+               "Con la app en marcha use POST /api/admin/demand/backfill.",
+    )
+    parser.add_argument("--db", default="farmacia.db", help="Base principal; también se recorren sus shards")
+    parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD (por defecto: todo el historial)")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    args = parser.parse_args()
+
+    # Cada shard guarda los turnos, archivos e histogramas de sus farmacias
+    for db_path, archive in shard_databases(args.db):
+        cells = backfill(db_path, args.start, args.end, archive)
+        print(f"{db_path}: {cells} celdas recalculadas (farmacia, fecha, hora)")
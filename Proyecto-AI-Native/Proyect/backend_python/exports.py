@@ -0,0 +1,79 @@
+import csv
+import io
+import json
+import sqlite3
+import zlib
+from typing import Iterable, Iterator
+
+
+# Exportaciones completas de inventario y turnos con memoria constante:
+# las filas se leen con fetchmany y se serializan lote a lote en un generador
+# que consume StreamingResponse.
+
+EXPORT_BATCH_SIZE = 5000
+
+# Cada fuente es (ruta_db, sql, parámetros); permite encadenar la tabla viva y los archivos
+ExportSource = tuple[str, str, tuple]
+
+
+def _iter_rows(sources: Iterable[ExportSource], batch_size: int) -> Iterator[list[tuple]]:
+    for db_path, sql, params in sources:
+        # StreamingResponse avanza el generador desde el threadpool (hilos distintos)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+
+def _serialize(columns: list[str], batches: Iterator[list[tuple]], fmt: str) -> Iterator[bytes]:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue().encode("utf-8")
+        for rows in batches:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue().encode("utf-8")
+    else:
+        for rows in batches:
+            yield "".join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+            ).encode("utf-8")
+
+
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(
+    sources: Iterable[ExportSource],
+    columns: list[str],
+    fmt: str = "csv",
+    gzipped: bool = False,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[bytes]:
+    chunks = _serialize(columns, _iter_rows(sources, batch_size), fmt)
+    return _gzip(chunks) if gzipped else chunks
+
+
+def export_media_type(fmt: str, gzipped: bool) -> str:
+    if gzipped:
+        return "application/gzip"
+    return "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+
+
+def export_filename(name: str, fmt: str, gzipped: bool) -> str:
+    return f"{name}.{fmt}" + (".gz" if gzipped else "")
@@ -0,0 +1,216 @@
+import heapq
+import math
+import sqlite3
+import threading
+from typing import Iterator, Optional
+
+
+# Búsqueda de farmacias cercanas.
+# Las coordenadas se guardan en `pharmacies` y se replican por triggers en un R*Tree de SQLite
+# (pharmacy_locations), que es la copia persistente del índice. Al arrancar se carga una
+# grilla en memoria (celdas de GRID_CELL_DEGREES) sobre la que se recorren los k vecinos
+# más cercanos por anillos, sin distancias contra todas las farmacias.
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+GRID_CELL_DEGREES = 0.05  # ~5,5 km de lado en latitud
+
+
+def init_geo_schema(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(pharmacies)")}
+    if "latitude" not in columns:
+        conn.execute("ALTER TABLE pharmacies ADD COLUMN latitude REAL")
+    if "longitude" not in columns:
+        conn.execute("ALTER TABLE pharmacies ADD COLUMN longitude REAL")
+
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS pharmacy_locations
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        """
+    )
+    # El R*Tree sigue a `pharmacies` aunque las coordenadas se carguen por fuera de la API
+    conn.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS pharmacies_location_insert
+        AFTER INSERT ON pharmacies
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO pharmacy_locations
+            VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS pharmacies_location_update
+        AFTER UPDATE OF latitude, longitude ON pharmacies
+        BEGIN
+            DELETE FROM pharmacy_locations WHERE id = OLD.id;
+            INSERT INTO pharmacy_locations
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS pharmacies_location_delete
+        AFTER DELETE ON pharmacies
+        BEGIN
+            DELETE FROM pharmacy_locations WHERE id = OLD.id;
+        END;
+        """
+    )
+    # Bases creadas antes del R*Tree: se pobla una sola vez
+    if conn.execute("SELECT COUNT(*) FROM pharmacy_locations").fetchone()[0] == 0:
+        conn.execute(
+            """
+            INSERT INTO pharmacy_locations
+            SELECT id, latitude, latitude, longitude, longitude
+            FROM pharmacies WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """
+        )
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class PharmacyGeoIndex:
+    def __init__(self, cell_degrees: float = GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._cells: dict[tuple[int, int], list[tuple[int, float, float]]] = {}
+        self._locations: dict[int, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def _cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        """Reconstruye la grilla desde el R*Tree persistido."""
+        # El R*Tree guarda float32 (redondeado hacia afuera): las coordenadas exactas vienen de `pharmacies`
+        rows = conn.execute(
+            """
+            SELECT l.id, p.latitude, p.longitude
+            FROM pharmacy_locations l
+            JOIN pharmacies p ON p.id = l.id
+            """
+        ).fetchall()
+        cells: dict[tuple[int, int], list[tuple[int, float, float]]] = {}
+        locations: dict[int, tuple[float, float]] = {}
+        for pharmacy_id, latitude, longitude in rows:
+            locations[pharmacy_id] = (latitude, longitude)
+            cells.setdefault(self._cell(latitude, longitude), []).append((pharmacy_id, latitude, longitude))
+        with self._lock:
+            self._cells = cells
+            self._locations = locations
+
+    def _add(self, pharmacy_id: int, latitude: float, longitude: float) -> None:
+        # Copia al escribir: las búsquedas en curso recorren las listas sin tomar el lock
+        self._locations[pharmacy_id] = (latitude, longitude)
+        cell = self._cell(latitude, longitude)
+        self._cells[cell] = self._cells.get(cell, []) + [(pharmacy_id, latitude, longitude)]
+
+    def _remove(self, pharmacy_id: int) -> None:
+        location = self._locations.pop(pharmacy_id, None)
+        if location is None:
+            return
+        cell = self._cell(*location)
+        entries = [entry for entry in self._cells.get(cell, []) if entry[0] != pharmacy_id]
+        if entries:
+            self._cells[cell] = entries
+        else:
+            self._cells.pop(cell, None)
+
+    def upsert(self, pharmacy_id: int, latitude: Optional[float], longitude: Optional[float]) -> None:
+        with self._lock:
+            self._remove(pharmacy_id)
+            if latitude is not None and longitude is not None:
+                self._add(pharmacy_id, latitude, longitude)
+
+    def _ring(self, center: tuple[int, int], radius: int) -> Iterator[tuple[int, int]]:
+        row, col = center
+        if radius == 0:
+            yield center
+            return
+        for dc in range(-radius, radius + 1):
+            yield (row - radius, col + dc)
+            yield (row + radius, col + dc)
+        for dr in range(-radius + 1, radius):
+            yield (row + dr, col - radius)
+            yield (row + dr, col + radius)
+
+    def _ring_lower_bound_km(self, latitude: float, longitude: float, radius: int) -> float:
+        # Distancia mínima a cualquier celda del anillo `radius` o más allá (aún sin recorrer).
+        # En longitud las celdas se estrechan con cos(lat): se usa la latitud más alejada del ecuador
+        # y un margen del 1% porque el arco de círculo máximo es algo más corto que el del paralelo.
+        row, col = self._cell(latitude, longitude)
+        lat_gap = min(latitude - (row - radius + 1) * self.cell_degrees, (row + radius) * self.cell_degrees - latitude)
+        lon_gap = min(longitude - (col - radius + 1) * self.cell_degrees, (col + radius) * self.cell_degrees - longitude)
+        far_latitude = min(89.9, abs(latitude) + (radius + 1) * self.cell_degrees)
+        lon_gap_km = lon_gap * KM_PER_DEGREE * math.cos(math.radians(far_latitude)) * 0.99
+        return max(0.0, min(lat_gap * KM_PER_DEGREE, lon_gap_km))
+
+    def _cell_lower_bound_km(self, latitude: float, longitude: float, cell: tuple[int, int]) -> float:
+        # Desigualdad triangular: ningún punto de la celda está más cerca que centro - semidiagonal
+        center_lat = (cell[0] + 0.5) * self.cell_degrees
+        center_lon = (cell[1] + 0.5) * self.cell_degrees
+        half_diagonal = self.cell_degrees * KM_PER_DEGREE * 0.7072
+        return max(0.0, haversine_km(latitude, longitude, center_lat, center_lon) - half_diagonal)
+
+    def iter_nearest(self, latitude: float, longitude: float, max_distance_km: Optional[float] = None) -> Iterator[tuple[float, int]]:
+        """Genera (distancia_km, pharmacy_id) en orden creciente de distancia."""
+        with self._lock:
+            cells = self._cells
+            total = len(self._locations)
+        center = self._cell(latitude, longitude)
+        heap: list[tuple[float, int]] = []
+        seen = 0
+        radius = 0
+
+        # Fase 1: anillos de celdas alrededor del punto (zonas densas)
+        while seen < total and (2 * radius + 1) ** 2 <= len(cells):
+            for cell in self._ring(center, radius):
+                for pharmacy_id, lat, lon in cells.get(cell, ()):
+                    seen += 1
+                    heapq.heappush(heap, (haversine_km(latitude, longitude, lat, lon), pharmacy_id))
+            radius += 1
+            bound = self._ring_lower_bound_km(latitude, longitude, radius)
+            while heap and heap[0][0] <= bound:
+                distance, pharmacy_id = heapq.heappop(heap)
+                if max_distance_km is not None and distance > max_distance_km:
+                    return
+                yield distance, pharmacy_id
+            if max_distance_km is not None and bound > max_distance_km:
+                return
+
+        # Fase 2: zona poco poblada; abrir más anillos costaría más que recorrer las celdas
+        # ocupadas restantes, que se visitan en orden de cota inferior
+        if seen < total:
+            pending = [
+                (self._cell_lower_bound_km(latitude, longitude, cell), cell)
+                for cell in list(cells)
+                if max(abs(cell[0] - center[0]), abs(cell[1] - center[1])) >= radius
+            ]
+            heapq.heapify(pending)
+            while pending:
+                bound, cell = heapq.heappop(pending)
+                while heap and heap[0][0] <= bound:
+                    distance, pharmacy_id = heapq.heappop(heap)
+                    if max_distance_km is not None and distance > max_distance_km:
+                        return
+                    yield distance, pharmacy_id
+                if max_distance_km is not None and bound > max_distance_km:
+                    break
+                for pharmacy_id, lat, lon in cells.get(cell, ()):
+                    heapq.heappush(heap, (haversine_km(latitude, longitude, lat, lon), pharmacy_id))
+
+        while heap:
+            distance, pharmacy_id = heapq.heappop(heap)
+            if max_distance_km is not None and distance > max_distance_km:
+                return
+            yield distance, pharmacy_id
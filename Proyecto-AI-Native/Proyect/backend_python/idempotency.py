@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+# Claves de idempotencia para endpoints de escritura (header Idempotency-Key).
+# Nivel 1: LRU en memoria con TTL. Nivel 2: tabla SQLite compartida entre workers.
+# Las peticiones duplicadas concurrentes esperan el mismo futuro en lugar de repetir el trabajo.
+# Las consultas a SQLite corren en un hilo aparte para no bloquear el event loop. Una vez hecho
+# el trabajo la clave nunca se libera: si no se puede guardar la respuesta, queda en el LRU y se
+# reintenta en segundo plano.
+
+PENDING_TIMEOUT_SECONDS = 60
+PERSIST_RETRY_MAX_SECONDS = 30.0
+
+
+def init_idempotency_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status_code INTEGER NULL,
+            response_body TEXT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (scope, idempotency_key)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)")
+
+
+def request_fingerprint(payload: Any) -> str:
+    encoded = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, db_path: str, max_entries: int = 10_000, ttl_seconds: float = 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # (scope, key) -> (fingerprint, status_code, body, created_at)
+        self._cache: "OrderedDict[tuple[str, str], tuple[str, int, Any, float]]" = OrderedDict()
+        self._in_flight: dict[tuple[str, str], asyncio.Future] = {}
+        # Respuestas que no se pudieron guardar en SQLite y se reintentan
+        self._retrying: dict[tuple[str, str], asyncio.Task] = {}
+
+    def _cache_get(self, cache_key: tuple[str, str], now: float) -> Optional[tuple[str, int, Any, float]]:
+        entry = self._cache.get(cache_key)
+        if entry is None:
+            return None
+        if now - entry[3] > self.ttl_seconds:
+            del self._cache[cache_key]
+            return None
+        self._cache.move_to_end(cache_key)
+        return entry
+
+    def _cache_put(self, cache_key: tuple[str, str], entry: tuple[str, int, Any, float]) -> None:
+        self._cache[cache_key] = entry
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _claim(self, scope: str, key: str, fingerprint: str, now: float) -> Optional[tuple[str, Optional[int], Any, float]]:
+        """Reserva la clave en SQLite. Devuelve None si la reservamos, o la fila existente."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            # Reservas abandonadas (proceso caído) o respuestas vencidas se pueden reutilizar
+            cursor.execute(
+                """
+                DELETE FROM idempotency_keys
+                WHERE scope = ? AND idempotency_key = ?
+                AND ((status_code IS NULL AND created_at < ?) OR created_at < ?)
+                """,
+                (scope, key, now - PENDING_TIMEOUT_SECONDS, now - self.ttl_seconds),
+            )
+            cursor.execute(
+                """
+                INSERT OR IGNORE INTO idempotency_keys (scope, idempotency_key, fingerprint, created_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (scope, key, fingerprint, now),
+            )
+            if cursor.rowcount == 1:
+                conn.commit()
+                return None
+            conn.commit()
+            cursor.execute(
+                """
+                SELECT fingerprint, status_code, response_body, created_at
+                FROM idempotency_keys WHERE scope = ? AND idempotency_key = ?
+                """,
+                (scope, key),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            body = json.loads(row[2]) if row[2] is not None else None
+            return row[0], row[1], body, row[3]
+        finally:
+            conn.close()
+
+    def _persist(self, scope: str, key: str, entry: tuple[str, int, Any, float]) -> None:
+        fingerprint, status_code, body, created_at = entry
+        conn = sqlite3.connect(self.db_path)
+        try:
+            # Upsert: la reserva pudo vencer (PENDING_TIMEOUT_SECONDS) mientras se reintentaba
+            conn.execute(
+                """
+                INSERT INTO idempotency_keys (scope, idempotency_key, fingerprint, status_code, response_body, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(scope, idempotency_key) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    status_code = excluded.status_code,
+                    response_body = excluded.response_body
+                """,
+                (scope, key, fingerprint, status_code, json.dumps(body), created_at),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _retry_persist(self, scope: str, key: str, entry: tuple[str, int, Any, float]) -> None:
+        delay = 0.5
+        try:
+            while time.time() - entry[3] < self.ttl_seconds:
+                await asyncio.sleep(delay)
+                try:
+                    await asyncio.to_thread(self._persist, scope, key, entry)
+                    return
+                except sqlite3.Error:
+                    delay = min(delay * 2, PERSIST_RETRY_MAX_SECONDS)
+        finally:
+            self._retrying.pop((scope, key), None)
+
+    def purge_expired(self) -> dict:
+        """Borra las claves vencidas (tarea periódica del planificador, fuera de las peticiones)."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            deleted = conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return {"deleted": deleted}
+
+    def _release(self, scope: str, key: str) -> None:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE scope = ? AND idempotency_key = ? AND status_code IS NULL",
+                (scope, key),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _replay(fingerprint: str, entry: tuple[str, Optional[int], Any, float]) -> Any:
+        stored_fingerprint, status_code, body, _ = entry
+        if stored_fingerprint != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="La clave de idempotencia ya se usó con otra solicitud",
+            )
+        if status_code is None:
+            # Otro worker está procesando la misma clave
+            raise HTTPException(
+                status_code=409,
+                detail="Solicitud en proceso, intente nuevamente",
+                headers={"Retry-After": "1"},
+            )
+        if status_code >= 400:
+            raise HTTPException(status_code=status_code, detail=body.get("detail") if isinstance(body, dict) else body)
+        return JSONResponse(status_code=status_code, content=body, headers={"Idempotent-Replayed": "true"})
+
+    def cached_response(self, scope: str, key: Optional[str], payload: Any) -> Optional[Any]:
+        """Respuesta ya guardada en memoria para la clave, sin tocar SQLite."""
+        if not key:
+            return None
+        cached = self._cache_get((scope, key), time.time())
+        if cached is None:
+            return None
+        return self._replay(request_fingerprint(payload), cached)
+
+    async def execute(self, scope: str, key: Optional[str], payload: Any, work: Callable[[], Awaitable[Any]]) -> Any:
+        if not key:
+            return await work()
+
+        cache_key = (scope, key)
+        fingerprint = request_fingerprint(payload)
+        now = time.time()
+
+        cached = self._cache_get(cache_key, now)
+        if cached is not None:
+            return self._replay(fingerprint, cached)
+
+        # Duplicado concurrente en este proceso: esperar el resultado del primero
+        in_flight = self._in_flight.get(cache_key)
+        if in_flight is not None:
+            try:
+                await asyncio.shield(in_flight)
+            except BaseException:
+                if not in_flight.done():
+                    # Se canceló esta solicitud, no la primera
+                    raise
+            # La respuesta pudo salir ya del LRU, o el primero falló y liberó la clave:
+            # se resuelve de nuevo (caché, SQLite o reintento)
+            return await self.execute(scope, key, payload, work)
+
+        # En vuelo desde antes de reservar: los duplicados que lleguen mientras tanto esperan
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[cache_key] = future
+        try:
+            existing = await asyncio.to_thread(self._claim, scope, key, fingerprint, now)
+        except BaseException as exc:
+            del self._in_flight[cache_key]
+            future.set_exception(exc)
+            future.exception()
+            raise
+        if existing is not None:
+            del self._in_flight[cache_key]
+            future.set_result(None)
+            if existing[1] is not None:
+                self._cache_put(cache_key, existing)
+            return self._replay(fingerprint, existing)
+
+        try:
+            try:
+                body = await work()
+                status_code = 200
+            except HTTPException as exc:
+                if exc.status_code >= 500:
+                    raise
+                # Los errores de validación/negocio también se recuerdan: reintentar no debe cambiar el resultado
+                body = {"detail": exc.detail}
+                status_code = exc.status_code
+        except BaseException as exc:
+            # El trabajo no terminó: la clave se libera antes de despertar a los duplicados
+            try:
+                await asyncio.to_thread(self._release, scope, key)
+            finally:
+                del self._in_flight[cache_key]
+                future.set_exception(exc)
+                # Evita el aviso "exception was never retrieved" si nadie más esperaba
+                future.exception()
+            raise
+
+        # El trabajo ya se hizo (p. ej. el turno existe): desde aquí la clave no se libera nunca
+        entry = (fingerprint, status_code, jsonable_encoder(body), now)
+        self._cache_put(cache_key, entry)
+        del self._in_flight[cache_key]
+        future.set_result(None)
+        try:
+            await asyncio.to_thread(self._persist, scope, key, entry)
+        except sqlite3.Error:
+            if cache_key not in self._retrying:
+                self._retrying[cache_key] = asyncio.create_task(self._retry_persist(scope, key, entry))
+
+        if status_code >= 400:
+            raise HTTPException(status_code=status_code, detail=body["detail"])
+        return body
@@ -0,0 +1,336 @@
+import argparse
+import codecs
+import csv
+import gzip
+import json
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Callable, Optional
+
+from shards import pharmacy_databases
+
+
+# Importación masiva de stock desde exportaciones ERP (CSV o NDJSON).
+# El archivo se procesa por fragmentos: solo se mantienen en memoria la línea incompleta
+# y el lote pendiente de escribir. Cada lote es un UPSERT en una transacción.
+#
+# Columnas: pharmacy_id, medication_code, current_stock y opcionalmente min_threshold.
+# En CSV no se admiten saltos de línea dentro de campos entrecomillados.
+#
+# El stock del archivo es el conteo físico y se guarda tal cual, aunque quede por debajo de
+# reserved_stock: esas filas se informan en below_reserved para revisar las reservas activas.
+
+DEFAULT_CHUNK_SIZE = 10_000
+MAX_REPORTED_ERRORS = 1000
+
+UPSERT_INVENTORY_SQL = """
+    INSERT INTO inventory (pharmacy_id, medication_code, current_stock, min_threshold, last_updated)
+    VALUES (?, ?, ?, COALESCE(?, 10), CURRENT_TIMESTAMP)
+    ON CONFLICT(pharmacy_id, medication_code) DO UPDATE SET
+        current_stock = excluded.current_stock,
+        min_threshold = COALESCE(?, inventory.min_threshold),
+        last_updated = CURRENT_TIMESTAMP
+"""
+
+REQUIRED_COLUMNS = ("pharmacy_id", "medication_code", "current_stock")
+
+
+class InventoryImporter:
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        fmt: str = "csv",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        gzipped: bool = False,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        on_stock_change: Optional[Callable[[int, str, Optional[int], int, int], None]] = None,
+        pharmacy_ids: Optional[set[int]] = None,
+        medication_codes: Optional[set[str]] = None,
+        connection_for: Optional[Callable[[int], sqlite3.Connection]] = None,
+    ):
+        if fmt not in ("csv", "ndjson"):
+            raise ValueError("Formato no soportado (csv o ndjson)")
+        self.conn = conn
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.on_progress = on_progress
+        # Recibe (pharmacy_id, code, stock_anterior, stock_nuevo, umbral) por fila escrita
+        self.on_stock_change = on_stock_change
+        # Con sharding, la conexión de cada farmacia; sin él todas las filas van a `conn`
+        self.connection_for = connection_for
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self._partial = ""
+        self._header: Optional[list[str]] = None
+        self._delimiter = ","
+        self._pending: list[tuple] = []
+        self._started = time.perf_counter()
+
+        # Validación sin consultas por fila (el servidor pasa los conjuntos del catálogo en memoria)
+        if pharmacy_ids is None:
+            pharmacy_ids = {row[0] for row in conn.execute("SELECT id FROM pharmacies")}
+        if medication_codes is None:
+            medication_codes = {row[0] for row in conn.execute("SELECT code FROM medications")}
+        self.pharmacy_ids = pharmacy_ids
+        self.medication_codes = medication_codes
+
+        self.line_number = 0
+        self.rows_processed = 0
+        self.rows_upserted = 0
+        self.error_count = 0
+        self.errors: list[dict] = []
+        self.below_reserved_count = 0
+        self.below_reserved: list[dict] = []
+
+    # --- Entrada incremental -------------------------------------------------------
+
+    def feed(self, data: bytes) -> None:
+        if self._inflater is not None:
+            data = self._inflater.decompress(data)
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split("\n")
+        # La última línea puede estar incompleta hasta el siguiente fragmento
+        self._partial = lines.pop()
+        self._process_lines(lines)
+
+    def finish(self) -> dict:
+        if self._inflater is not None:
+            tail = self._inflater.flush()
+            text = self._partial + self._decoder.decode(tail, final=True)
+        else:
+            text = self._partial + self._decoder.decode(b"", final=True)
+        self._partial = ""
+        self._process_lines(text.split("\n"))
+        self._flush()
+        return self.summary()
+
+    def _process_lines(self, lines: list[str]) -> None:
+        if not lines:
+            return
+        if self.fmt == "csv":
+            self._process_csv(lines)
+        else:
+            self._process_ndjson(lines)
+
+    def _process_csv(self, lines: list[str]) -> None:
+        if self._header is None:
+            while lines and not lines[0].strip():
+                self.line_number += 1
+                lines = lines[1:]
+            if not lines:
+                return
+            header_line = lines[0]
+            lines = lines[1:]
+            self.line_number += 1
+            self._delimiter = ";" if header_line.count(";") > header_line.count(",") else ","
+            self._header = [name.strip().lower() for name in next(csv.reader([header_line], delimiter=self._delimiter))]
+            missing = [c for c in REQUIRED_COLUMNS if c not in self._header]
+            if missing:
+                raise ValueError(f"Faltan columnas en el encabezado: {', '.join(missing)}")
+
+        index = {name: i for i, name in enumerate(self._header)}
+        threshold_index = index.get("min_threshold")
+        for values in csv.reader(lines, delimiter=self._delimiter):
+            self.line_number += 1
+            if not values or (len(values) == 1 and not values[0].strip()):
+                continue
+            try:
+                record = {
+                    "pharmacy_id": values[index["pharmacy_id"]],
+                    "medication_code": values[index["medication_code"]],
+                    "current_stock": values[index["current_stock"]],
+                    "min_threshold": values[threshold_index] if threshold_index is not None and threshold_index < len(values) else None,
+                }
+            except IndexError:
+                self._error("Número de columnas incorrecto")
+                continue
+            self._accept(record)
+
+    def _process_ndjson(self, lines: list[str]) -> None:
+        for line in lines:
+            self.line_number += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                self._error("JSON no válido")
+                continue
+            if not isinstance(record, dict):
+                self._error("Se esperaba un objeto JSON")
+                continue
+            self._accept(record)
+
+    # --- Validación y escritura ----------------------------------------------------
+
+    def _error(self, message: str) -> None:
+        self.rows_processed += 1
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": self.line_number, "error": message})
+
+    def _accept(self, record: dict) -> None:
+        try:
+            pharmacy_id = int(record.get("pharmacy_id"))
+            current_stock = int(record.get("current_stock"))
+            threshold = record.get("min_threshold")
+            min_threshold = int(threshold) if threshold not in (None, "") else None
+        except (TypeError, ValueError):
+            self._error("pharmacy_id, current_stock y min_threshold deben ser enteros")
+            return
+        medication_code = str(record.get("medication_code") or "").strip()
+
+        if current_stock < 0 or (min_threshold is not None and min_threshold < 0):
+            self._error("El stock y el umbral no pueden ser negativos")
+            return
+        if pharmacy_id not in self.pharmacy_ids:
+            self._error(f"Farmacia {pharmacy_id} no encontrada")
+            return
+        if medication_code not in self.medication_codes:
+            self._error(f"Medicamento '{medication_code}' no encontrado")
+            return
+
+        self.rows_processed += 1
+        self._pending.append((pharmacy_id, medication_code, current_stock, min_threshold, min_threshold))
+        if len(self._pending) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        if self.connection_for is None:
+            groups = {self.conn: self._pending}
+        else:
+            groups = {}
+            for row in self._pending:
+                groups.setdefault(self.connection_for(row[0]), []).append(row)
+        # Una transacción por base destino
+        for conn, rows in groups.items():
+            self._load_keys(conn, rows)
+            previous = self._previous_stock(conn) if self.on_stock_change is not None else None
+            with conn:
+                conn.executemany(UPSERT_INVENTORY_SQL, rows)
+                short = self._below_reserved(conn)
+            self.below_reserved_count += len(short)
+            self.below_reserved.extend(short[:MAX_REPORTED_ERRORS - len(self.below_reserved)])
+            if previous is not None:
+                for pharmacy_id, medication_code, current_stock, min_threshold, _ in rows:
+                    old_stock, old_threshold = previous.get((pharmacy_id, medication_code), (None, 10))
+                    threshold = min_threshold if min_threshold is not None else old_threshold
+                    self.on_stock_change(pharmacy_id, medication_code, old_stock, current_stock, threshold)
+        self.rows_upserted += len(self._pending)
+        self._pending = []
+        if self.on_progress is not None:
+            self.on_progress(self.summary())
+
+    @staticmethod
+    def _load_keys(conn: sqlite3.Connection, pending: list[tuple]) -> None:
+        # Tabla temporal de claves del lote: un lookup por índice (pharmacy_id, medication_code) por fila
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_keys (pharmacy_id INTEGER, medication_code TEXT)")
+        conn.execute("DELETE FROM import_keys")
+        conn.executemany("INSERT INTO import_keys VALUES (?, ?)", ((row[0], row[1]) for row in pending))
+
+    @staticmethod
+    def _previous_stock(conn: sqlite3.Connection) -> dict[tuple[int, str], tuple[int, int]]:
+        rows = conn.execute(
+            """
+            SELECT i.pharmacy_id, i.medication_code, i.current_stock, i.min_threshold
+            FROM import_keys k
+            JOIN inventory i ON i.pharmacy_id = k.pharmacy_id AND i.medication_code = k.medication_code
+            """
+        ).fetchall()
+        return {(row[0], row[1]): (row[2], row[3]) for row in rows}
+
+    @staticmethod
+    def _below_reserved(conn: sqlite3.Connection) -> list[dict]:
+        # En la misma transacción que el UPSERT: las reservas vistas son las vigentes
+        if "reserved_stock" not in {row[1] for row in conn.execute("PRAGMA table_info(inventory)")}:
+            # Base que la app aún no migró: no hay reservas
+            return []
+        rows = conn.execute(
+            """
+            SELECT i.pharmacy_id, i.medication_code, i.current_stock, i.reserved_stock
+            FROM import_keys k
+            JOIN inventory i ON i.pharmacy_id = k.pharmacy_id AND i.medication_code = k.medication_code
+            WHERE i.current_stock < i.reserved_stock
+            """
+        ).fetchall()
+        return [
+            {"pharmacy_id": row[0], "medication_code": row[1], "current_stock": row[2], "reserved_stock": row[3]}
+            for row in rows
+        ]
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self._started
+        return {
+            "rows_processed": self.rows_processed,
+            "rows_upserted": self.rows_upserted,
+            "error_count": self.error_count,
+            "errors": self.errors,
+            "below_reserved_count": self.below_reserved_count,
+            "below_reserved": self.below_reserved,
+            "elapsed_seconds": round(elapsed, 2),
+            "rows_per_second": round(self.rows_processed / elapsed) if elapsed > 0 else None,
+        }
+
+
+def detect_format(filename: str, explicit: Optional[str] = None) -> str:
+    if explicit:
+        return explicit
+    name = filename.lower().removesuffix(".gz")
+    return "ndjson" if name.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importa stock desde un archivo CSV o NDJSON (opcionalmente .gz)")
+    parser.add_argument("file")
+    parser.add_argument("--db", default="farmacia.db", help="Base principal; las farmacias con shard se escriben en el suyo")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    def report(progress: dict) -> None:
+        print(
+            f"\r{progress['rows_processed']:>12,} filas  {progress['error_count']:>8,} errores  "
+            f"{progress['rows_per_second'] or 0:>10,} filas/s",
+            end="",
+            file=sys.stderr,
+        )
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    # Mismo reparto que la app: cada farmacia asignada a un shard se escribe en su base
+    shard_paths = pharmacy_databases(args.db)
+    connections = {args.db: conn}
+
+    def connection_for(pharmacy_id: int) -> sqlite3.Connection:
+        path = shard_paths.get(pharmacy_id, args.db)
+        if path not in connections:
+            connections[path] = sqlite3.connect(path, timeout=30)
+        return connections[path]
+
+    importer = InventoryImporter(
+        conn, detect_format(args.file, args.format), args.chunk_size, on_progress=report, connection_for=connection_for
+    )
+    opener = gzip.open if args.file.endswith(".gz") else open
+    with opener(args.file, "rb") as source:
+        while True:
+            block = source.read(1 << 20)
+            if not block:
+                break
+            importer.feed(block)
+    result = importer.finish()
+    for shard_conn in connections.values():
+        shard_conn.close()
+
+    print(file=sys.stderr)
+    for error in result["errors"][:20]:
+        print(f"  línea {error['line']}: {error['error']}", file=sys.stderr)
+    for row in result["below_reserved"][:20]:
+        print(
+            f"  farmacia {row['pharmacy_id']} {row['medication_code']}: stock {row['current_stock']} "
+            f"menor que lo reservado ({row['reserved_stock']})",
+            file=sys.stderr,
+        )
+    print(json.dumps({k: v for k, v in result.items() if k not in ("errors", "below_reserved")}, ensure_ascii=False))
@@ -0,0 +1,123 @@
+"""Escenario de carga para POST /api/turns/request: usuarios legítimos durante una inundación de bots.
+
+Uso:
+    python load_test.py                 # en proceso, contra una base temporal
+    python load_test.py --no-limits     # mismo escenario sin control de admisión
+    python load_test.py --url http://localhost:8000   # el servidor necesita TRUSTED_PROXY=1
+
+Cada cliente simulado envía su propia IP en X-Forwarded-For.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def legit_user(client: httpx.AsyncClient, n: int, duration: float, latencies: list[float], statuses: dict) -> None:
+    await asyncio.sleep(random.uniform(0, duration))
+    payload = {
+        "pharmacy_id": 1,
+        "user_id": f"LEGIT-{n}",
+        "user_name": f"Paciente {n}",
+        "user_document": f"L{n:07d}",
+    }
+    headers = {"X-Forwarded-For": f"10.1.{n // 250}.{n % 250}"}
+    start = time.perf_counter()
+    response = await client.post("/api/turns/request", json=payload, headers=headers)
+    latencies.append((time.perf_counter() - start) * 1000)
+    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+
+async def bot(client: httpx.AsyncClient, n: int, deadline: float, statuses: dict) -> None:
+    i = 0
+    while time.perf_counter() < deadline:
+        i += 1
+        payload = {
+            "pharmacy_id": 1,
+            "user_id": f"BOT-{n}",
+            "user_name": "Bot",
+            "user_document": f"B{n:03d}{i % 3}",
+        }
+        headers = {"X-Forwarded-For": f"203.0.113.{n % 5}"}
+        response = await client.post("/api/turns/request", json=payload, headers=headers)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        await asyncio.sleep(0)
+
+
+async def run(client: httpx.AsyncClient, legit: int, bots: int, duration: float) -> None:
+    latencies: list[float] = []
+    legit_statuses: dict = {}
+    bot_statuses: dict = {}
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(legit_user(client, n, duration, latencies, legit_statuses) for n in range(legit)),
+        *(bot(client, n, deadline, bot_statuses) for n in range(bots)),
+    )
+    elapsed = time.perf_counter() - started
+
+    print(f"Duración: {elapsed:.1f}s  usuarios legítimos: {legit}  bots: {bots}")
+    print(f"Bots      -> peticiones: {sum(bot_statuses.values())}  estados: {dict(sorted(bot_statuses.items()))}")
+    print(f"Legítimos -> estados: {dict(sorted(legit_statuses.items()))}")
+    print(
+        "Latencia legítimos (ms): "
+        f"p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+        f"p99={percentile(latencies, 99):.1f} media={statistics.fmean(latencies) if latencies else 0:.1f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Servidor a probar; por defecto la app en proceso")
+    parser.add_argument("--legit", type=int, default=60)
+    parser.add_argument("--bots", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--no-limits", action="store_true", help="Desactiva el control de admisión (solo en proceso)")
+    args = parser.parse_args()
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30)
+    else:
+        # La app usa 'farmacia.db' relativo al directorio actual: trabajar en uno temporal
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.chdir(tempfile.mkdtemp(prefix="farmacia-load-"))
+        os.environ.setdefault("TRUSTED_PROXY", "1")
+        import main as app_module
+
+        conn = sqlite3.connect("farmacia.db")
+        conn.execute("UPDATE pharmacies SET daily_digital_turn_limit = 1000000")
+        conn.commit()
+        conn.close()
+        # Al importar, la app ya cargó el catálogo (asignación de shards) con el límite anterior
+        app_module.catalog.invalidate()
+
+        if args.no_limits:
+            app_module.turn_admission.enabled = False
+            app_module.api_concurrency.max_in_flight = 1_000_000
+        transport = httpx.ASGITransport(app=app_module.app, client=("127.0.0.1", 50000))
+        client = httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30)
+
+    async def runner() -> None:
+        async with client:
+            await run(client, args.legit, args.bots, args.duration)
+
+    asyncio.run(runner())
+
+
+if __name__ == "__main__":
+    main()
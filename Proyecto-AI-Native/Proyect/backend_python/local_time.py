@@ -0,0 +1,16 @@
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+
+# Hora local de las farmacias.
+# La base guarda los timestamps en UTC (CURRENT_TIMESTAMP); las franjas de citas se configuran en
+# la hora local de PHARMACY_TIMEZONE (nombre IANA, p. ej. America/Bogota). El "hoy" de los turnos,
+# el límite diario y la tarea day-close siguen en UTC.
+# Todas las fechas son naive: UTC en la base, hora local en las franjas.
+
+PHARMACY_TIMEZONE = ZoneInfo(os.getenv("PHARMACY_TIMEZONE", "UTC"))
+
+
+def local_now() -> datetime:
+    return datetime.now(PHARMACY_TIMEZONE).replace(tzinfo=None)
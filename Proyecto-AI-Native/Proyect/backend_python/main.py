@@ -1,14 +1,63 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import sqlite3
 import json
-from datetime import datetime
+import asyncio
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 import uuid
 import os
+import base64
 from twilio.rest import Client
 from dotenv import load_dotenv
+from alerts import StockAlertEngine
+from analytics import INVENTORY_SNAPSHOT_COLUMNS, TURN_SNAPSHOT_COLUMNS, ColumnarStore
+from appointments import AppointmentBook, init_appointment_schema, insert_appointment, slot_config
+from capacity import CapacityController
+from catalog import CatalogCache
+from dashboard import QueueDashboard
+from db_writer import GroupCommitWriter, configure_connection, ensure_autoincrement, read_connection
+from demand import DEMAND_FLUSH_SECONDS, DemandHistograms, backfill as backfill_demand, init_demand_schema
+from exports import export_filename, export_media_type, stream_export
+from geo import PharmacyGeoIndex, init_geo_schema
+from idempotency import IdempotencyStore, init_idempotency_schema
+from inventory_import import InventoryImporter
+from local_time import local_now
+from rate_limit import ConcurrencyLimiter, TurnAdmissionController, retry_after_header
+from reservations import (
+    ReservationManager,
+    close_reservations,
+    consume_reservation,
+    init_reservation_schema,
+    reserve_stock,
+)
+from scheduler import JobScheduler, init_scheduler_schema
+from shards import ShardRouter, init_shard_schema
+from substitutes import SubstitutionIndex
+from terminal_sync import (
+    MAX_SYNC_BATCH,
+    SyncConflict,
+    apply_batch,
+    init_terminal_sync_schema,
+    recent_conflicts,
+    sync_state,
+)
+from tracing import SPAN_KIND_CLIENT, traced_connect, tracer
+from turn_queue import TurnQueueIndex
+from turn_stats import init_turn_stats_schema, query_stats, record_status_change, record_turn_created
+from turn_transitions import (
+    DAY_CLOSE_TIME,
+    MAX_BULK_TURN_IDS,
+    TURN_STATUSES,
+    allowed_sources,
+    close_day,
+    init_turn_transitions_schema,
+    transition_turns,
+)
 
 # Cargar variables de entorno
 load_dotenv()
@@ -39,6 +88,13 @@ class SMSService:
             print("⚠️ Twilio no configurado - SMS desactivado")
     
     def send_turn_notification(self, phone_number: str, turn_number: str, pharmacy_name: str, user_name: str):
+        with tracer.span("twilio send_sms", SPAN_KIND_CLIENT, **{"sms.simulated": not self.enabled}) as span:
+            result = self._send(phone_number, turn_number, pharmacy_name, user_name)
+            if span is not None:
+                span["sms.status"] = result["status"]
+            return result
+    
+    def _send(self, phone_number: str, turn_number: str, pharmacy_name: str, user_name: str):
         if not self.enabled:
             print(f"📱 SMS simulado: {turn_number} para {user_name} en {pharmacy_name}")
             return {"status": "simulated", "message": "SMS no configurado"}
@@ -60,6 +116,53 @@ class SMSService:
 
 sms_service = SMSService()
 
+# Control de admisión: límites por documento/IP/farmacia y tope global de concurrencia
+turn_admission = TurnAdmissionController.from_env()
+api_concurrency = ConcurrencyLimiter(int(os.getenv("MAX_CONCURRENT_REQUESTS", "64")))
+
+@app.middleware("http")
+async def shed_load(request: Request, call_next):
+    # Bajo saturación se rechaza de inmediato en vez de encolar contra SQLite
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    if not api_concurrency.try_acquire():
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Servidor saturado, intente nuevamente"},
+            headers=retry_after_header(1),
+        )
+    try:
+        return await call_next(request)
+    finally:
+        api_concurrency.release()
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Span raíz por petición (muestreo con TRACE_SAMPLE_RATE o traceparent entrante)
+    with tracer.start_trace(
+        f"{request.method} {request.url.path}",
+        request.headers.get("traceparent"),
+        **{"http.method": request.method, "url.path": request.url.path}
+    ) as span:
+        response = await call_next(request)
+        if span is not None:
+            route = request.scope.get("route")
+            span["http.route"] = getattr(route, "path", None)
+            span["http.status_code"] = response.status_code
+            response.headers["X-Trace-Id"] = tracer.current_trace_id()
+        return response
+
+# Solo detrás de un proxy propio (Render) X-Forwarded-For es confiable; sin proxy cualquier
+# cliente podría inventarse una IP nueva en cada petición y saltarse el límite por IP
+TRUSTED_PROXY = os.getenv("TRUSTED_PROXY", "0") != "0"
+
+def get_client_ip(request: Request) -> str:
+    # Detrás del proxy la IP real es la última entrada de X-Forwarded-For (la que agrega el proxy)
+    forwarded = request.headers.get("x-forwarded-for") if TRUSTED_PROXY else None
+    if forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
 # Modelos de datos
 class Medication(BaseModel):
     code: str
@@ -76,6 +179,9 @@ class TurnRequest(BaseModel):
     user_name: str
     user_document: str
     phone_number: Optional[str] = None
+    # Medicamento a reservar hasta que el turno llegue al mostrador (opcional)
+    medication_code: Optional[str] = None
+    quantity: int = 1
 
 class Turn(BaseModel):
     id: int
@@ -87,9 +193,52 @@ class Turn(BaseModel):
     attended_at: Optional[str] = None
     request_type: str
 
+class PharmacyUpdate(BaseModel):
+    name: Optional[str] = None
+    address: Optional[str] = None
+    phone: Optional[str] = None
+    daily_digital_turn_limit: Optional[int] = None
+    appointment_slot_minutes: Optional[int] = None
+    appointment_slot_capacity: Optional[int] = None
+
+class AppointmentRequest(BaseModel):
+    pharmacy_id: int
+    user_id: str
+    user_name: str
+    user_document: str
+    phone_number: Optional[str] = None
+    # Franja exacta; sin ella se toma la primera libre desde `after` (o desde ahora)
+    slot_start: Optional[str] = None
+    after: Optional[str] = None
+
+class MedicationUpsert(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+class BulkStatusRequest(BaseModel):
+    status: str
+    turn_ids: Optional[List[int]] = None
+    pharmacy_id: Optional[int] = None
+    current_status: Optional[List[str]] = None
+    requested_date: Optional[str] = None
+
+class TerminalEvent(BaseModel):
+    # Secuencia del terminal: empieza en 1 y no tiene huecos
+    sequence: int
+    type: str
+    medication_code: Optional[str] = None
+    quantity: int = 1
+    turn_id: Optional[int] = None
+    status: Optional[str] = None
+
+class TerminalSyncBatch(BaseModel):
+    terminal_id: str
+    pharmacy_id: int
+    events: List[TerminalEvent]
+
 # Base de datos SQLite
-def init_db():
-    conn = sqlite3.connect('farmacia.db')
+def create_schema(conn: sqlite3.Connection):
+    """Tablas e índices; se usa también para crear cada shard (ver shards.py)"""
     cursor = conn.cursor()
     
     # Crear tablas si no existen
@@ -127,7 +276,7 @@ def init_db():
     
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS turns (
-            id INTEGER PRIMARY KEY,
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             pharmacy_id INTEGER,
             user_id TEXT,
             user_name TEXT NOT NULL,
@@ -140,15 +289,47 @@ def init_db():
             attended_at TIMESTAMP NULL
         )
     ''')
+    # Bases anteriores: los ids de turnos archivados no se deben volver a asignar
+    ensure_autoincrement(conn, "turns")
+    
+    # Índice cubriente para el historial por usuario (evita recorrer toda la tabla)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_turns_user_history
+        ON turns (user_document, requested_at DESC, id DESC,
+                  pharmacy_id, turn_number, status, request_type, called_at, attended_at)
+    ''')
+    
+    # Índice para consultas por farmacia y rango de fechas (cola del día, cierres en bloque)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_turns_pharmacy_requested
+        ON turns (pharmacy_id, requested_at)
+    ''')
+    
+    init_turn_transitions_schema(conn)
+    init_geo_schema(conn)
+    init_idempotency_schema(conn)
+    init_turn_stats_schema(conn)
+    init_shard_schema(conn)
+    init_reservation_schema(conn)
+    init_appointment_schema(conn)
+    init_terminal_sync_schema(conn)
+    init_demand_schema(conn)
+
+def init_db():
+    conn = sqlite3.connect('farmacia.db')
+    configure_connection(conn)
+    create_schema(conn)
+    init_scheduler_schema(conn)
+    cursor = conn.cursor()
     
     # Insertar datos de ejemplo
     cursor.execute("SELECT COUNT(*) FROM pharmacies")
     if cursor.fetchone()[0] == 0:
         cursor.execute('''
-            INSERT INTO pharmacies (id, name, address, phone, daily_digital_turn_limit)
+            INSERT INTO pharmacies (id, name, address, phone, daily_digital_turn_limit, latitude, longitude)
             VALUES 
-            (1, 'Farmacia Central EPS', 'Calle 50 #45-67, Bogotá', '+57 1 2345678', 100),
-            (2, 'Farmacia IMSS Unidad 1', 'Av. Principal #123, Ciudad de México', '+52 55 87654321', 150)
+            (1, 'Farmacia Central EPS', 'Calle 50 #45-67, Bogotá', '+57 1 2345678', 100, 4.6389, -74.0836),
+            (2, 'Farmacia IMSS Unidad 1', 'Av. Principal #123, Ciudad de México', '+52 55 87654321', 150, 19.4326, -99.1332)
         ''')
         
         cursor.execute('''
@@ -205,21 +386,293 @@ def init_db():
 # Inicializar base de datos al iniciar
 init_db()
 
+# Escritor único: agrupa las escrituras de turnos y dispensación en group commits
+db_writer = GroupCommitWriter('farmacia.db')
+
+# Farmacias y catálogo de medicamentos en memoria (TTL + invalidación en escrituras de administración)
+catalog = CatalogCache('farmacia.db')
+
+# Inventario y turnos de cada farmacia en su shard (FARMACIA_SHARDING=pharmacy|region); por defecto en farmacia.db
+shard_router = ShardRouter(
+    'farmacia.db',
+    db_writer,
+    create_schema,
+    region_of=lambda pharmacy_id: (catalog.pharmacy(pharmacy_id) or {}).get("region"),
+)
+shard_router.load()
+shard_router.assign_all(catalog.pharmacy_ids())
+for shard in shard_router.shards():
+    shard.archive.reserve_archived_ids()
+
+# Límite diario adaptativo según la tasa de servicio medida de cada farmacia
+capacity = CapacityController(lambda pharmacy_id: read_connection(shard_router.for_pharmacy(pharmacy_id).db_path))
+
+# Cupos libres de citas por farmacia y día (árbol de segmentos en memoria)
+appointment_book = AppointmentBook(lambda pharmacy_id: read_connection(shard_router.for_pharmacy(pharmacy_id).db_path))
+
+# Respuestas guardadas por Idempotency-Key para reintentos de clientes móviles
+idempotency_store = IdempotencyStore('farmacia.db')
+
+# Alertas de stock bajo/agotado detectadas en cada escritura de inventario
+stock_alerts = StockAlertEngine(hysteresis_ratio=float(os.getenv("STOCK_ALERT_HYSTERESIS", "0.1")))
+
+def load_stock_alert_state():
+    # Única lectura completa por shard: estado inicial de los ítems ya bajo el umbral
+    rows = []
+    for shard in shard_router.shards():
+        conn = sqlite3.connect(shard.db_path)
+        rows.extend(conn.execute('''
+            SELECT pharmacy_id, medication_code, current_stock, min_threshold
+            FROM inventory WHERE current_stock <= min_threshold
+        ''').fetchall())
+        conn.close()
+    stock_alerts.load(rows)
+
+load_stock_alert_state()
+
+# Índice espacial en memoria, reconstruido desde el R*Tree pharmacy_locations
+pharmacy_geo_index = PharmacyGeoIndex()
+
+def load_pharmacy_geo_index():
+    conn = sqlite3.connect('farmacia.db')
+    pharmacy_geo_index.load(conn)
+    conn.close()
+
+load_pharmacy_geo_index()
+
+# Grafo de sustitutos por principio activo; se reconstruye cuando cambia el catálogo
+substitution_index = SubstitutionIndex()
+
+def current_substitution_index() -> SubstitutionIndex:
+    substitution_index.sync(catalog.medications())
+    return substitution_index
+
+# Cola de turnos pendientes por farmacia y día (árbol de Fenwick por número de turno)
+turn_queue = TurnQueueIndex()
+
+def load_turn_queue():
+    conn = sqlite3.connect('farmacia.db')
+    turn_queue.load(conn)
+    conn.close()
+    # Turnos de los shards con sus ids públicos
+    for shard in shard_router.shards()[1:]:
+        conn = sqlite3.connect(shard.db_path)
+        turn_queue.extend(conn, shard.id_offset)
+        conn.close()
+
+load_turn_queue()
+
+# Contadores por estado de los turnos de hoy para el tablero de supervisores
+queue_dashboard = QueueDashboard()
+
+def load_queue_dashboard():
+    conn = sqlite3.connect('farmacia.db')
+    queue_dashboard.load(conn)
+    conn.close()
+    for shard in shard_router.shards()[1:]:
+        conn = sqlite3.connect(shard.db_path)
+        queue_dashboard.extend(conn)
+        conn.close()
+
+load_queue_dashboard()
+
+# Histogramas por hora de llegadas y esperas (mapas de calor); se guardan en el shard de cada farmacia
+demand_histograms = DemandHistograms(lambda pharmacy_id: shard_router.for_pharmacy(pharmacy_id).db_path)
+
+# Reservas de stock de los turnos; sus vencimientos en una rueda de tiempo en memoria
+reservations = ReservationManager()
+
+def load_reservations():
+    for shard in shard_router.shards():
+        conn = sqlite3.connect(shard.db_path)
+        reservations.load(conn, shard.number, shard.id_offset)
+        conn.close()
+
+load_reservations()
+
+def on_turn_transition(turn_id: int, pharmacy_id: int, requested_at: str, turn_number: int,
+                       old_status: Optional[str], new_status: str):
+    # Los índices usan el id público actual (un id anterior a la migración a un shard también llega aquí)
+    turn_id = shard_router.canonical_turn_id(turn_id)
+    # Índices en memoria que siguen cada cambio de estado (cola, tablero e histogramas de demanda)
+    turn_queue.apply(turn_id, pharmacy_id, requested_at, turn_number, old_status, new_status)
+    queue_dashboard.apply(turn_id, pharmacy_id, requested_at, turn_number, old_status, new_status)
+    demand_histograms.apply(turn_id, pharmacy_id, requested_at, turn_number, old_status, new_status)
+    # Turno atendido o cancelado: su reserva de stock vuelve a estar disponible
+    if new_status in ('attended', 'cancelled'):
+        reservations.release_turn(turn_id)
+
 # API Endpoints
 
 @app.get("/")
 async def root():
     return {"message": "FarmaciaConnect API funcionando"}
 
+@app.get("/api/pharmacies/nearby")
+async def get_nearby_pharmacies(
+    latitude: float,
+    longitude: float,
+    medication_code: Optional[str] = None,
+    min_stock: int = 1,
+    limit: int = 10,
+    max_distance_km: Optional[float] = None
+):
+    """Farmacias más cercanas, opcionalmente solo las que tienen el medicamento en stock"""
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas no válidas")
+    if medication_code and catalog.medication(medication_code) is None:
+        raise HTTPException(status_code=404, detail="Medicamento no encontrado")
+    limit = max(1, min(limit, 100))
+    
+    results = []
+    candidates = pharmacy_geo_index.iter_nearest(latitude, longitude, max_distance_km)
+    # Candidatos por lotes en orden de distancia: el filtro de stock es una consulta por lote
+    batch_size = max(32, limit * 4)
+    while len(results) < limit:
+        batch = [candidate for _, candidate in zip(range(batch_size), candidates)]
+        if not batch:
+            break
+        distances = {pharmacy_id: distance for distance, pharmacy_id in batch}
+        if medication_code:
+            # Una consulta por shard del lote; las filas se ordenan juntas por distancia
+            rows = []
+            for shard, pharmacy_ids in shard_router.group_by_shard(distances).items():
+                placeholders = ", ".join("?" for _ in pharmacy_ids)
+                conn = read_connection(shard.db_path)
+                rows.extend(conn.execute(f'''
+                    SELECT pharmacy_id, current_stock - reserved_stock
+                    FROM inventory
+                    WHERE pharmacy_id IN ({placeholders}) AND medication_code = ?
+                      AND current_stock - reserved_stock >= ?
+                ''', (*pharmacy_ids, medication_code, min_stock)).fetchall())
+                conn.close()
+        else:
+            rows = [(pharmacy_id, None) for pharmacy_id in distances]
+        rows.sort(key=lambda row: distances[row[0]])
+        for pharmacy_id, available_stock in rows[:limit - len(results)]:
+            pharmacy = catalog.pharmacy(pharmacy_id)
+            if pharmacy is None:
+                continue
+            results.append({
+                "pharmacy_id": pharmacy_id,
+                "name": pharmacy["name"],
+                "address": pharmacy["address"],
+                "phone": pharmacy["phone"],
+                "latitude": pharmacy["latitude"],
+                "longitude": pharmacy["longitude"],
+                "distance_km": round(distances[pharmacy_id], 3),
+                "available_stock": available_stock
+            })
+    
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "medication_code": medication_code,
+        "pharmacies": results
+    }
+
+@app.put("/api/pharmacies/{pharmacy_id}/location")
+async def update_pharmacy_location(pharmacy_id: int, latitude: float, longitude: float):
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas no válidas")
+    
+    conn = traced_connect('farmacia.db')
+    cursor = conn.cursor()
+    
+    # Los triggers de geo.py actualizan el R*Tree en la misma transacción
+    cursor.execute('''
+        UPDATE pharmacies SET latitude = ?, longitude = ? WHERE id = ?
+    ''', (latitude, longitude, pharmacy_id))
+    
+    if cursor.rowcount == 0:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    
+    conn.commit()
+    conn.close()
+    
+    pharmacy_geo_index.upsert(pharmacy_id, latitude, longitude)
+    catalog.refresh_pharmacy(pharmacy_id)
+    
+    return {"success": True, "message": "Ubicación actualizada"}
+
+@app.put("/api/admin/pharmacies/{pharmacy_id}")
+async def admin_update_pharmacy(pharmacy_id: int, update: PharmacyUpdate):
+    fields = update.model_dump(exclude_none=True)
+    if not fields:
+        raise HTTPException(status_code=400, detail="No hay campos para actualizar")
+    if fields.get("appointment_slot_minutes", 1) <= 0 or fields.get("appointment_slot_capacity", 0) < 0:
+        raise HTTPException(status_code=400, detail="Configuración de franjas no válida")
+    
+    conn = traced_connect('farmacia.db')
+    cursor = conn.cursor()
+    cursor.execute(
+        f"UPDATE pharmacies SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+        (*fields.values(), pharmacy_id)
+    )
+    if cursor.rowcount == 0:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    conn.commit()
+    conn.close()
+    
+    catalog.refresh_pharmacy(pharmacy_id)
+    return {"success": True, "pharmacy": catalog.pharmacy(pharmacy_id)}
+
+@app.put("/api/admin/medications/{medication_code}")
+async def admin_upsert_medication(medication_code: str, medication: MedicationUpsert):
+    conn = traced_connect('farmacia.db')
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO medications (code, name, description)
+        VALUES (?, ?, ?)
+        ON CONFLICT(code) DO UPDATE SET
+            name = excluded.name,
+            description = excluded.description
+    ''', (medication_code, medication.name, medication.description))
+    conn.commit()
+    conn.close()
+    
+    catalog.refresh_medication(medication_code)
+    return {"success": True, "medication": catalog.medication(medication_code)}
+
+@app.get("/api/admin/catalog")
+async def get_catalog_cache_stats():
+    return {**catalog.stats(), "substitutes": current_substitution_index().stats()}
+
+@app.get("/api/admin/db-writer")
+async def get_db_writer_stats():
+    """Lotes y tamaño medio de los group commits"""
+    return db_writer.stats()
+
+@app.get("/api/admin/shards")
+async def get_shards():
+    """Shards, farmacias asignadas y estadísticas del escritor de cada uno"""
+    return shard_router.stats()
+
+@app.get("/api/admin/reservations")
+async def get_reservations_stats():
+    """Reservas de stock activas, vencidas y liberadas"""
+    return reservations.stats()
+
+@app.post("/api/admin/catalog/invalidate")
+async def invalidate_catalog_cache():
+    """Fuerza la recarga del catálogo (p. ej. tras cargar farmacias por script)"""
+    catalog.invalidate()
+    return {"success": True}
+
 @app.get("/api/pharmacy/{pharmacy_id}/inventory")
 async def get_inventory(pharmacy_id: int):
-    conn = sqlite3.connect('farmacia.db')
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
     cursor = conn.cursor()
     
+    # Los nombres vienen del catálogo en memoria (sin JOIN a medications)
     cursor.execute('''
         SELECT 
-            m.code,
-            m.name,
+            i.medication_code,
             i.current_stock,
             i.min_threshold,
             CASE 
@@ -228,27 +681,44 @@ async def get_inventory(pharmacy_id: int):
                 ELSE 'available'
             END as status,
             0.0 as demand_score,
-            i.last_updated
+            i.last_updated,
+            i.reserved_stock
         FROM inventory i
-        JOIN medications m ON i.medication_code = m.code
         WHERE i.pharmacy_id = ?
-        ORDER BY m.name
     ''', (pharmacy_id,))
     
     results = cursor.fetchall()
     conn.close()
     
+    # Agotados: hasta 3 sustitutos con stock en esta misma farmacia (sin otra consulta)
+    substitutes = current_substitution_index()
+    available = {row[0]: row[1] - row[6] for row in results}
+    
     medications = []
     for row in results:
+        medication = catalog.medication(row[0])
+        if medication is None:
+            continue
+        in_stock_substitutes = []
+        if row[3] == 'out_of_stock':
+            for _, code, _ in substitutes.substitutes(row[0]):
+                if available.get(code, 0) > 0:
+                    in_stock_substitutes.append(code)
+                    if len(in_stock_substitutes) == 3:
+                        break
         medications.append({
             "code": row[0],
-            "name": row[1],
-            "current_stock": row[2],
-            "min_threshold": row[3],
-            "status": row[4],
-            "demand_score": row[5],
-            "last_updated": row[6]
+            "name": medication["name"],
+            "current_stock": row[1],
+            "min_threshold": row[2],
+            "status": row[3],
+            "demand_score": row[4],
+            "last_updated": row[5],
+            "reserved_stock": row[6],
+            "available_stock": max(0, row[1] - row[6]),
+            "substitutes": in_stock_substitutes
         })
+    medications.sort(key=lambda medication: medication["name"])
     
     return {
         "pharmacy_id": pharmacy_id,
@@ -257,84 +727,358 @@ async def get_inventory(pharmacy_id: int):
         "last_updated": datetime.now().isoformat()
     }
 
-@app.post("/api/inventory/update")
-async def update_inventory(pharmacy_id: int, medication_code: str, quantity_dispensed: int):
-    conn = sqlite3.connect('farmacia.db')
-    cursor = conn.cursor()
+@app.get("/api/pharmacy/{pharmacy_id}/substitutes")
+async def get_substitutes(
+    pharmacy_id: int,
+    medication_code: str,
+    nearby: int = 5,
+    max_distance_km: Optional[float] = None,
+    min_stock: int = 1,
+    limit: int = 10
+):
+    """Sustitutos con stock (mismo principio activo) en la farmacia y en las más cercanas"""
+    pharmacy = catalog.pharmacy(pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    medication = catalog.medication(medication_code)
+    if medication is None:
+        raise HTTPException(status_code=404, detail="Medicamento no encontrado")
+    limit = max(1, min(limit, 50))
+    nearby = max(0, min(nearby, 20))
+    min_stock = max(1, min_stock)
+    
+    index = current_substitution_index()
+    # El propio medicamento también cuenta en las farmacias cercanas
+    ranking = {medication_code: (0.0, "same")}
+    for score, code, match in index.substitutes(medication_code):
+        ranking[code] = (score, match)
+    
+    distances = {pharmacy_id: 0.0}
+    if nearby and pharmacy["latitude"] is not None and pharmacy["longitude"] is not None:
+        for distance, other_id in pharmacy_geo_index.iter_nearest(pharmacy["latitude"], pharmacy["longitude"], max_distance_km):
+            if len(distances) > nearby:
+                break
+            distances.setdefault(other_id, distance)
+    
+    # Una consulta por shard: todas las farmacias y todos los candidatos a la vez
+    rows = []
+    code_placeholders = ", ".join("?" for _ in ranking)
+    for shard, pharmacy_ids in shard_router.group_by_shard(distances).items():
+        placeholders = ", ".join("?" for _ in pharmacy_ids)
+        conn = read_connection(shard.db_path)
+        rows.extend(conn.execute(f'''
+            SELECT pharmacy_id, medication_code, current_stock - reserved_stock
+            FROM inventory
+            WHERE pharmacy_id IN ({placeholders}) AND medication_code IN ({code_placeholders})
+              AND current_stock - reserved_stock >= ?
+        ''', (*pharmacy_ids, *ranking, min_stock)).fetchall())
+        conn.close()
+    
+    in_pharmacy = []
+    nearby_results = []
+    for other_id, code, available_stock in rows:
+        candidate = catalog.medication(code)
+        other = catalog.pharmacy(other_id)
+        if candidate is None or other is None:
+            continue
+        score, match = ranking[code]
+        suggestion = {
+            "code": code,
+            "name": candidate["name"],
+            "match": match,
+            "score": score,
+            "available_stock": available_stock,
+            "pharmacy_id": other_id,
+            "pharmacy_name": other["name"],
+            "distance_km": round(distances[other_id], 3)
+        }
+        if other_id == pharmacy_id:
+            # El mismo medicamento en esta farmacia no es una sugerencia
+            if code != medication_code:
+                in_pharmacy.append(suggestion)
+        else:
+            nearby_results.append(suggestion)
+    in_pharmacy.sort(key=lambda suggestion: (suggestion["score"], suggestion["code"]))
+    nearby_results.sort(key=lambda suggestion: (
+        suggestion["score"], suggestion["match"] != "same", suggestion["distance_km"], suggestion["code"]
+    ))
+    
+    return {
+        "pharmacy_id": pharmacy_id,
+        "medication": {"code": medication_code, "name": medication["name"], **(index.parsed(medication_code) or {})},
+        "in_pharmacy": in_pharmacy[:limit],
+        "nearby": nearby_results[:limit]
+    }
+
+def dispense_stock(cursor: sqlite3.Cursor, pharmacy_id: int, medication_code: str, quantity: int,
+                   local_turn_id: Optional[int] = None) -> tuple:
+    """Descuenta stock dentro de una transacción del escritor; (stock nuevo, umbral, id de reserva usada)"""
+    reservation = None
+    if local_turn_id is not None:
+        reservation = consume_reservation(cursor, local_turn_id, pharmacy_id, medication_code)
+    reserved = reservation[1] if reservation else 0
     
-    # Actualizar inventario
+    # Actualizar inventario: solo se dispensa lo disponible (stock menos reservas de otros turnos)
     cursor.execute('''
         UPDATE inventory 
         SET current_stock = current_stock - ?,
+            reserved_stock = MAX(0, reserved_stock - ?),
             last_updated = CURRENT_TIMESTAMP
-        WHERE pharmacy_id = ? AND medication_code = ? AND current_stock >= ?
-    ''', (quantity_dispensed, pharmacy_id, medication_code, quantity_dispensed))
+        WHERE pharmacy_id = ? AND medication_code = ? AND current_stock - reserved_stock + ? >= ?
+        RETURNING current_stock, min_threshold
+    ''', (quantity, reserved, pharmacy_id, medication_code, reserved, quantity))
     
-    if cursor.rowcount == 0:
-        conn.close()
+    updated = cursor.fetchone()
+    if not updated:
         raise HTTPException(status_code=400, detail="No hay suficiente stock o medicamento no encontrado")
+    return (*updated, reservation[0] if reservation else None)
+
+@app.post("/api/inventory/update")
+async def update_inventory(
+    pharmacy_id: int,
+    medication_code: str,
+    quantity_dispensed: int,
+    turn_id: Optional[int] = None,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    payload = {
+        "pharmacy_id": pharmacy_id,
+        "medication_code": medication_code,
+        "quantity_dispensed": quantity_dispensed,
+        "turn_id": turn_id,
+    }
+    return await idempotency_store.execute(
+        "inventory.update",
+        idempotency_key,
+        payload,
+        lambda: dispense_medication(pharmacy_id, medication_code, quantity_dispensed, turn_id),
+    )
+
+async def dispense_medication(pharmacy_id: int, medication_code: str, quantity_dispensed: int, turn_id: Optional[int] = None):
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    if catalog.medication(medication_code) is None:
+        raise HTTPException(status_code=404, detail="Medicamento no encontrado")
     
-    conn.commit()
-    conn.close()
+    shard = shard_router.for_pharmacy(pharmacy_id)
+    # Con turn_id se usa la reserva del turno (si sigue activa) además del stock disponible
+    local_turn_id = shard.local_turn_id(turn_id) if turn_id is not None and shard_router.for_turn(turn_id) is shard else None
+    
+    def apply_dispense(conn: sqlite3.Connection):
+        return dispense_stock(conn.cursor(), pharmacy_id, medication_code, quantity_dispensed, local_turn_id)
+    
+    # El commit lo hace el escritor del shard (group commit); al volver la escritura ya es durable
+    new_stock, min_threshold, reservation_id = await shard.writer.submit(apply_dispense)
+    if reservation_id is not None:
+        reservations.forget(shard.number, reservation_id)
+    
+    # Comparar stock anterior y nuevo: solo se emite alerta si cambia el nivel
+    stock_alerts.evaluate(pharmacy_id, medication_code, new_stock + quantity_dispensed, new_stock, min_threshold)
     
     return {"success": True, "message": "Inventario actualizado"}
 
-@app.post("/api/turns/request")
-async def request_turn(request: TurnRequest):
-    conn = sqlite3.connect('farmacia.db')
-    cursor = conn.cursor()
+@app.get("/api/alerts")
+async def get_stock_alerts(pharmacy_id: Optional[int] = None):
+    """Alertas activas y eventos recientes de stock bajo/agotado"""
+    return {
+        "active": stock_alerts.active_alerts(pharmacy_id),
+        "recent_events": stock_alerts.recent_events(pharmacy_id)
+    }
+
+@app.get("/api/alerts/stream")
+async def stream_stock_alerts(http_request: Request, pharmacy_id: Optional[int] = None):
+    """Eventos de alerta en tiempo real (Server-Sent Events)"""
+    queue = stock_alerts.subscribe_queue()
     
-    # Verificar límite diario de turnos digitales
-    cursor.execute('''
-        SELECT COUNT(*) as count
-        FROM turns 
-        WHERE pharmacy_id = ? 
-        AND request_type = 'digital' 
-        AND DATE(requested_at) = DATE('now')
-    ''', (request.pharmacy_id,))
+    async def event_source():
+        try:
+            while not await http_request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if pharmacy_id is None or event["pharmacy_id"] == pharmacy_id:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            stock_alerts.unsubscribe_queue(queue)
     
-    digital_count = cursor.fetchone()[0]
+    return StreamingResponse(event_source(), media_type="text/event-stream")
+
+# Progreso de importaciones masivas recientes (consultable mientras se ejecutan)
+import_jobs: "OrderedDict[str, dict]" = OrderedDict()
+MAX_TRACKED_IMPORT_JOBS = 50
+
+@app.post("/api/inventory/import")
+async def import_inventory(http_request: Request, format: Optional[str] = None):
+    """Importación masiva de stock (CSV o NDJSON) procesada en streaming con UPSERT por lotes"""
+    content_type = http_request.headers.get("content-type", "")
+    fmt = format or ("ndjson" if "ndjson" in content_type or "jsonl" in content_type else "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato no soportado (csv o ndjson)")
+    gzipped = http_request.headers.get("content-encoding", "").lower() == "gzip"
     
-    cursor.execute('''
-        SELECT daily_digital_turn_limit FROM pharmacies WHERE id = ?
-    ''', (request.pharmacy_id,))
+    job_id = http_request.headers.get("x-import-id") or str(uuid.uuid4())
+    job = {"job_id": job_id, "status": "running", "format": fmt, "started_at": datetime.now().isoformat()}
+    import_jobs[job_id] = job
+    while len(import_jobs) > MAX_TRACKED_IMPORT_JOBS:
+        import_jobs.popitem(last=False)
     
-    limit_result = cursor.fetchone()
-    if not limit_result:
-        conn.close()
+    # La conexión se usa desde el threadpool (un fragmento a la vez) para no bloquear el event loop.
+    # Los lotes compiten con el escritor de cada base: se espera el lock en vez de fallar
+    conn = traced_connect('farmacia.db', timeout=30, check_same_thread=False)
+    # Con sharding, cada lote se reparte entre las conexiones de los shards que toca
+    shard_connections = {0: conn}
+    
+    def connection_for(pharmacy_id: int) -> sqlite3.Connection:
+        shard = shard_router.for_pharmacy(pharmacy_id)
+        if shard.number not in shard_connections:
+            shard_connections[shard.number] = traced_connect(shard.db_path, timeout=30, check_same_thread=False)
+        return shard_connections[shard.number]
+    
+    try:
+        importer = InventoryImporter(
+            conn,
+            fmt,
+            gzipped=gzipped,
+            on_progress=lambda progress: job.update(progress),
+            on_stock_change=stock_alerts.evaluate,
+            pharmacy_ids=catalog.pharmacy_ids(),
+            medication_codes=catalog.medication_codes(),
+            connection_for=connection_for,
+        )
+        async for chunk in http_request.stream():
+            if chunk:
+                await run_in_threadpool(importer.feed, chunk)
+        result = await run_in_threadpool(importer.finish)
+    except ValueError as e:
+        job.update({"status": "failed", "error": str(e)})
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        # Los lotes ya guardados quedan (rows_upserted); el trabajo no queda "running" para siempre
+        job.update({"status": "failed", "error": str(e)})
+        raise HTTPException(status_code=500, detail=f"La importación falló: {e}")
+    finally:
+        for shard_conn in shard_connections.values():
+            shard_conn.close()
+    
+    job.update(result)
+    job["status"] = "completed"
+    return job
+
+@app.get("/api/inventory/import/{job_id}")
+async def get_import_status(job_id: str):
+    job = import_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Importación no encontrada")
+    # Durante la ejecución no se devuelven las listas completas de errores y avisos
+    return {key: value for key, value in job.items() if key not in ("errors", "below_reserved") or job["status"] != "running"}
+
+@app.post("/api/turns/request")
+async def request_turn(
+    request: TurnRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    # Un reintento ya respondido no cuenta contra los límites de admisión
+    replay = idempotency_store.cached_response("turns.request", idempotency_key, request)
+    if replay is not None:
+        return replay
+    
+    # Farmacia inexistente: se rechaza con el catálogo en memoria, sin consumir cupos de admisión
+    if catalog.pharmacy(request.pharmacy_id) is None:
         raise HTTPException(status_code=404, detail="Farmacia no encontrada")
     
-    daily_limit = limit_result[0]
+    # Rechazar ráfagas antes de tocar la base de datos
+    allowed, retry_after, _ = turn_admission.admit(
+        request.user_document, get_client_ip(http_request), request.pharmacy_id
+    )
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas solicitudes de turno, intente nuevamente más tarde",
+            headers=retry_after_header(retry_after),
+        )
     
-    if digital_count >= daily_limit:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Límite diario de turnos digitales alcanzado")
+    return await idempotency_store.execute(
+        "turns.request", idempotency_key, request, lambda: create_turn(request)
+    )
+
+async def create_turn(request: TurnRequest):
+    pharmacy = catalog.pharmacy(request.pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
     
-    # Generar número de turno
-    cursor.execute('''
-        SELECT MAX(turn_number) as last_number 
-        FROM turns 
-        WHERE pharmacy_id = ? AND DATE(requested_at) = DATE('now')
-    ''', (request.pharmacy_id,))
+    if request.medication_code is not None:
+        if catalog.medication(request.medication_code) is None:
+            raise HTTPException(status_code=404, detail="Medicamento no encontrado")
+        if request.quantity <= 0:
+            raise HTTPException(status_code=400, detail="La cantidad a reservar debe ser mayor que cero")
     
-    last_turn = cursor.fetchone()
-    turn_number = (last_turn[0] or 0) + 1
+    daily_limit = pharmacy["daily_digital_turn_limit"]
+    shard = shard_router.for_pharmacy(request.pharmacy_id)
+    # Tasa de servicio estimada (en caché); None mientras no haya historial suficiente
+    service_rate = capacity.service_rate(request.pharmacy_id)
     
-    # Crear turno
-    cursor.execute('''
-        INSERT INTO turns (pharmacy_id, user_id, user_name, user_document, turn_number, request_type)
-        VALUES (?, ?, ?, ?, ?, 'digital')
-    ''', (request.pharmacy_id, request.user_id, request.user_name, request.user_document, turn_number))
+    def insert_turn(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        
+        # Turnos digitales de hoy y turnos aún en espera (rango sobre idx_turns_pharmacy_requested)
+        cursor.execute('''
+            SELECT
+                COALESCE(SUM(CASE WHEN request_type = 'digital' THEN 1 ELSE 0 END), 0) as digital_count,
+                COALESCE(SUM(CASE WHEN status IN ('pending', 'called') THEN 1 ELSE 0 END), 0) as open_count
+            FROM turns 
+            WHERE pharmacy_id = ? 
+            AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        ''', (request.pharmacy_id,))
+        
+        digital_count, open_count = cursor.fetchone()
+        
+        # Límite adaptativo: lo que se alcanza a atender antes del cierre (ver capacity.py)
+        if digital_count >= capacity.limit(service_rate, daily_limit, digital_count, open_count):
+            raise HTTPException(status_code=400, detail="Límite diario de turnos digitales alcanzado")
+        
+        # Generar número de turno
+        cursor.execute('''
+            SELECT MAX(turn_number) as last_number 
+            FROM turns 
+            WHERE pharmacy_id = ? AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        ''', (request.pharmacy_id,))
+        
+        last_turn = cursor.fetchone()
+        turn_number = (last_turn[0] or 0) + 1
+        
+        # Crear turno
+        cursor.execute('''
+            INSERT INTO turns (pharmacy_id, user_id, user_name, user_document, turn_number, request_type)
+            VALUES (?, ?, ?, ?, ?, 'digital')
+            RETURNING id, requested_at
+        ''', (request.pharmacy_id, request.user_id, request.user_name, request.user_document, turn_number))
+        
+        turn_id, requested_at = cursor.fetchone()
+        
+        # Reserva del medicamento en la misma transacción: sin stock disponible no se da el turno
+        reservation = None
+        if request.medication_code is not None:
+            reservation = reserve_stock(
+                cursor, turn_id, request.pharmacy_id, request.medication_code, request.quantity, reservations.ttl_seconds
+            )
+            if reservation is None:
+                raise HTTPException(status_code=400, detail="No hay suficiente stock disponible para reservar")
+        
+        # Rollup de estadísticas en la misma transacción
+        record_turn_created(cursor, request.pharmacy_id, requested_at, 'digital')
+        return turn_id, turn_number, requested_at, reservation
     
-    turn_id = cursor.lastrowid
+    local_turn_id, turn_number, requested_at, reservation = await shard.writer.submit(insert_turn)
+    turn_id = shard.global_turn_id(local_turn_id)
+    if reservation is not None:
+        reservations.track(shard.number, reservation[0], turn_id, reservation[1])
     
-    # Obtener nombre de la farmacia para el SMS
-    cursor.execute('SELECT name FROM pharmacies WHERE id = ?', (request.pharmacy_id,))
-    pharmacy_result = cursor.fetchone()
-    pharmacy_name = pharmacy_result[0] if pharmacy_result else "Farmacia"
+    pharmacy_name = pharmacy["name"] or "Farmacia"
     
-    conn.commit()
-    conn.close()
+    on_turn_transition(turn_id, request.pharmacy_id, requested_at, turn_number, None, 'pending')
     
     # Enviar SMS si se proporcionó número de teléfono
     sms_result = None
@@ -350,12 +1094,218 @@ async def request_turn(request: TurnRequest):
         "success": True,
         "turn_id": turn_id,
         "turn_number": turn_number,
+        "reservation": {
+            "medication_code": request.medication_code,
+            "quantity": request.quantity,
+            "expires_at": reservation[1]
+        } if reservation is not None else None,
         "sms_sent": sms_result
     }
 
+def parse_datetime_param(value: Optional[str], default: Optional[datetime]) -> Optional[datetime]:
+    if value is None:
+        return default
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha y hora no válida, use YYYY-MM-DDTHH:MM")
+
+@app.get("/api/pharmacy/{pharmacy_id}/slots")
+async def get_appointment_slots(pharmacy_id: int, date: Optional[str] = None):
+    """Franjas de citas de un día con sus cupos libres"""
+    pharmacy = catalog.pharmacy(pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    day = parse_date_param(date, local_now().date())
+    minutes, capacity = slot_config(pharmacy)
+    return {
+        "pharmacy_id": pharmacy_id,
+        "date": day.isoformat(),
+        "slot_minutes": minutes,
+        "slot_capacity": capacity,
+        "slots": appointment_book.day_slots(pharmacy_id, minutes, capacity, day)
+    }
+
+@app.get("/api/pharmacy/{pharmacy_id}/slots/next")
+async def get_next_free_slot(pharmacy_id: int, after: Optional[str] = None):
+    """Primera franja con cupo desde `after` (por defecto ahora), en O(log n) por día"""
+    pharmacy = catalog.pharmacy(pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    minutes, capacity = slot_config(pharmacy)
+    slot = appointment_book.next_free(pharmacy_id, minutes, capacity, parse_datetime_param(after, local_now()))
+    return {"pharmacy_id": pharmacy_id, "slot": slot}
+
+@app.post("/api/appointments")
+async def request_appointment(
+    request: AppointmentRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await idempotency_store.execute(
+        "appointments.book", idempotency_key, request, lambda: book_appointment(request)
+    )
+
+async def book_appointment(request: AppointmentRequest):
+    pharmacy = catalog.pharmacy(request.pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    minutes, capacity = slot_config(pharmacy)
+    if capacity <= 0:
+        raise HTTPException(status_code=400, detail="La farmacia no ofrece citas programadas")
+    
+    exact = request.slot_start is not None
+    after = parse_datetime_param(request.slot_start if exact else request.after, local_now())
+    # Cupo tomado en memoria; el INSERT lo confirma contra la base dentro del escritor
+    slot_start = appointment_book.hold(request.pharmacy_id, minutes, capacity, after, exact=exact)
+    if slot_start is None:
+        detail = "La franja no existe o no tiene cupos" if exact else "No hay franjas con cupo disponibles"
+        raise HTTPException(status_code=409, detail=detail)
+    shard = shard_router.for_pharmacy(request.pharmacy_id)
+    
+    def insert(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        # Una cita activa por usuario, farmacia y día
+        cursor.execute('''
+            SELECT 1 FROM appointments
+            WHERE user_document = ? AND pharmacy_id = ? AND status = 'booked'
+            AND slot_start >= DATE(?) AND slot_start < DATE(?, '+1 day')
+        ''', (request.user_document, request.pharmacy_id, slot_start, slot_start))
+        if cursor.fetchone():
+            raise HTTPException(status_code=409, detail="Ya tiene una cita reservada ese día en esta farmacia")
+        return insert_appointment(
+            cursor, request.pharmacy_id, slot_start, capacity,
+            request.user_id, request.user_name, request.user_document, request.phone_number
+        )
+    
+    try:
+        local_id = await shard.writer.submit(insert)
+    except BaseException:
+        appointment_book.release(request.pharmacy_id, slot_start)
+        raise
+    if local_id is None:
+        # La franja se llenó (p. ej. otra instancia): el árbol del día se rearma desde la base
+        appointment_book.invalidate(request.pharmacy_id, datetime.fromisoformat(slot_start).date())
+        raise HTTPException(status_code=409, detail="La franja se llenó, intente con otra")
+    
+    # Mismo esquema de ids públicos que los turnos (número de shard en los bits altos)
+    return {
+        "success": True,
+        "appointment_id": shard.global_turn_id(local_id),
+        "slot_start": slot_start,
+        "slot_minutes": minutes
+    }
+
+@app.post("/api/appointments/{appointment_id}/check-in")
+async def check_in_appointment(appointment_id: int):
+    """Convierte una cita de hoy en un turno 'scheduled' en la cola de la farmacia"""
+    shard = shard_router.for_appointment(appointment_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Cita no encontrada")
+    local_id = shard.local_turn_id(appointment_id)
+    
+    def check_in(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT pharmacy_id, slot_start, status, user_id, user_name, user_document FROM appointments WHERE id = ?",
+            (local_id,)
+        )
+        appointment = cursor.fetchone()
+        if not appointment:
+            raise HTTPException(status_code=404, detail="Cita no encontrada")
+        pharmacy_id, slot_start, status, user_id, user_name, user_document = appointment
+        if status != 'booked':
+            raise HTTPException(status_code=409, detail=f"La cita está en estado {status}")
+        if str(slot_start)[:10] != local_now().date().isoformat():
+            raise HTTPException(status_code=400, detail="Solo se puede hacer check-in el día de la cita")
+        
+        cursor.execute('''
+            SELECT MAX(turn_number) FROM turns
+            WHERE pharmacy_id = ? AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+        ''', (pharmacy_id,))
+        turn_number = (cursor.fetchone()[0] or 0) + 1
+        
+        cursor.execute('''
+            INSERT INTO turns (pharmacy_id, user_id, user_name, user_document, turn_number, request_type)
+            VALUES (?, ?, ?, ?, ?, 'scheduled')
+            RETURNING id, requested_at
+        ''', (pharmacy_id, user_id, user_name, user_document, turn_number))
+        turn_id, requested_at = cursor.fetchone()
+        
+        cursor.execute(
+            "UPDATE appointments SET status = 'checked_in', turn_id = ?, checked_in_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (turn_id, local_id)
+        )
+        record_turn_created(cursor, pharmacy_id, requested_at, 'scheduled')
+        return pharmacy_id, turn_id, turn_number, requested_at
+    
+    pharmacy_id, local_turn_id, turn_number, requested_at = await shard.writer.submit(check_in)
+    turn_id = shard.global_turn_id(local_turn_id)
+    on_turn_transition(turn_id, pharmacy_id, requested_at, turn_number, None, 'pending')
+    
+    return {
+        "success": True,
+        "appointment_id": appointment_id,
+        "turn_id": turn_id,
+        "turn_number": turn_number
+    }
+
+@app.post("/api/appointments/{appointment_id}/cancel")
+async def cancel_appointment(appointment_id: int):
+    shard = shard_router.for_appointment(appointment_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Cita no encontrada")
+    
+    def cancel(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE appointments SET status = 'cancelled', cancelled_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'booked'
+            RETURNING pharmacy_id, slot_start
+        ''', (shard.local_turn_id(appointment_id),))
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Cita no encontrada o ya no está reservada")
+        return row
+    
+    pharmacy_id, slot_start = await shard.writer.submit(cancel)
+    appointment_book.release(pharmacy_id, str(slot_start))
+    return {"success": True}
+
+@app.get("/api/pharmacy/{pharmacy_id}/capacity")
+async def get_pharmacy_capacity(pharmacy_id: int):
+    """Tasa de servicio estimada y límite efectivo de turnos digitales para hoy"""
+    pharmacy = catalog.pharmacy(pharmacy_id)
+    if pharmacy is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT
+            COALESCE(SUM(CASE WHEN request_type = 'digital' THEN 1 ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN status IN ('pending', 'called') THEN 1 ELSE 0 END), 0)
+        FROM turns
+        WHERE pharmacy_id = ? AND requested_at >= DATE('now') AND requested_at < DATE('now', '+1 day')
+    ''', (pharmacy_id,))
+    digital_count, open_count = cursor.fetchone()
+    conn.close()
+    
+    service_rate = capacity.service_rate(pharmacy_id)
+    return {
+        "pharmacy_id": pharmacy_id,
+        "enabled": capacity.enabled,
+        "configured_limit": pharmacy["daily_digital_turn_limit"],
+        "effective_limit": capacity.limit(service_rate, pharmacy["daily_digital_turn_limit"], digital_count, open_count),
+        "digital_turns_today": digital_count,
+        "open_turns": open_count,
+        "remaining_hours": round(capacity.hours_left(), 2),
+        **capacity.estimate(pharmacy_id)
+    }
+
 @app.get("/api/pharmacy/{pharmacy_id}/turns", response_model=List[Turn])
 async def get_turns(pharmacy_id: int):
-    conn = sqlite3.connect('farmacia.db')
+    shard = shard_router.for_pharmacy(pharmacy_id)
+    conn = read_connection(shard.db_path)
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -381,7 +1331,7 @@ async def get_turns(pharmacy_id: int):
     turns = []
     for row in results:
         turns.append(Turn(
-            id=row[0],
+            id=shard.global_turn_id(row[0]),
             turn_number=row[1],
             user_name=row[2],
             status=row[3],
@@ -393,14 +1343,375 @@ async def get_turns(pharmacy_id: int):
     
     return turns
 
-@app.put("/api/turns/{turn_id}/status")
-async def update_turn_status(turn_id: int, status: str):
-    if status not in ['pending', 'called', 'attended', 'cancelled']:
-        raise HTTPException(status_code=400, detail="Estado no válido")
+def encode_history_cursor(requested_at: str, turn_id: int) -> str:
+    raw = json.dumps([requested_at, turn_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_history_cursor(cursor_value: str) -> tuple:
+    try:
+        requested_at, turn_id = json.loads(base64.urlsafe_b64decode(cursor_value.encode("ascii")))
+        return str(requested_at), int(turn_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+@app.get("/api/user/{user_document}/turns")
+async def get_user_turns(
+    user_document: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    active_only: bool = False,
+    include_archived: bool = False,
+):
+    """Historial de turnos de un usuario, del más reciente al más antiguo (paginación por cursor)"""
+    limit = max(1, min(limit, 100))
     
-    conn = sqlite3.connect('farmacia.db')
+    conditions = ["user_document = ?"]
+    params: list = [user_document]
+    if active_only:
+        conditions.append("status IN ('pending', 'called')")
+    last_id = None
+    if cursor:
+        # Keyset: continuar justo después del último (requested_at, id) devuelto
+        last_requested_at, last_id = decode_history_cursor(cursor)
+        conditions.append("(requested_at, id) < (?, ?)")
+        params.append(last_requested_at)
+    
+    history_sql = f'''
+        SELECT id, pharmacy_id, turn_number, status, request_type, requested_at, called_at, attended_at
+        FROM turns INDEXED BY idx_turns_user_history
+        WHERE {" AND ".join(conditions)}
+        ORDER BY requested_at DESC, id DESC
+        LIMIT ?
+    '''
+    
+    # Fan-out: los primeros limit + 1 de cada shard y luego la mezcla por (requested_at, id público)
+    results = []
+    for shard in shard_router.shards():
+        shard_params = params + ([shard.local_keyset_id(last_id)] if last_id is not None else [])
+        conn = read_connection(shard.db_path)
+        db_cursor = conn.cursor()
+        db_cursor.execute(history_sql, shard_params + [limit + 1])
+        shard_results = db_cursor.fetchall()
+        conn.close()
+        
+        # Los archivos mensuales son siempre más antiguos que la tabla viva: se recorren en orden
+        if include_archived and len(shard_results) <= limit:
+            for archived in shard.archive.query_each_archive(
+                history_sql, tuple(shard_params + [limit + 1 - len(shard_results)])
+            ):
+                shard_results.extend(archived)
+                if len(shard_results) > limit:
+                    break
+        results.extend((shard.global_turn_id(row[0]), *row[1:]) for row in shard_results)
+    results.sort(key=lambda row: (row[5], row[0]), reverse=True)
+    
+    has_more = len(results) > limit
+    results = results[:limit]
+    
+    turns = []
+    for row in results:
+        turns.append({
+            "id": row[0],
+            "pharmacy_id": row[1],
+            "turn_number": row[2],
+            "status": row[3],
+            "request_type": row[4],
+            "requested_at": row[5],
+            "called_at": row[6],
+            "attended_at": row[7]
+        })
+    
+    next_cursor = None
+    if has_more and results:
+        next_cursor = encode_history_cursor(results[-1][5], results[-1][0])
+    
+    return {
+        "user_document": user_document,
+        "turns": turns,
+        "next_cursor": next_cursor
+    }
+
+def parse_date_param(value: Optional[str], default: Optional[date]) -> Optional[date]:
+    if value is None:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha no válida, use YYYY-MM-DD")
+
+@app.get("/api/pharmacy/{pharmacy_id}/turn-statistics")
+async def get_turn_statistics(
+    pharmacy_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    granularity: str = "day",
+):
+    """Estadísticas de turnos por día u hora desde los rollups turn_stats_hourly"""
+    end_date = parse_date_param(end, datetime.utcnow().date())
+    start_date = parse_date_param(start, end_date - timedelta(days=6))
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="El rango de fechas no es válido")
+    if granularity not in ("day", "hour"):
+        raise HTTPException(status_code=400, detail="Granularidad no válida (day u hour)")
+    
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
+    stats = query_stats(conn, pharmacy_id, start_date, end_date, granularity)
+    conn.close()
+    
+    return {
+        "pharmacy_id": pharmacy_id,
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "granularity": granularity,
+        "stats": stats
+    }
+
+@app.get("/api/pharmacy/{pharmacy_id}/demand-heatmap")
+async def get_demand_heatmap(
+    pharmacy_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """Llegadas de turnos y espera mediana por día y hora, con la hora pico"""
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    end_date = parse_date_param(end, datetime.utcnow().date())
+    start_date = parse_date_param(start, end_date - timedelta(days=6))
+    if start_date > end_date or (end_date - start_date).days > 366:
+        raise HTTPException(status_code=400, detail="El rango de fechas no es válido")
+    
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
+    heatmap = demand_histograms.heatmap(conn, pharmacy_id, start_date, end_date)
+    conn.close()
+    return heatmap
+
+@app.get("/api/pharmacy/{pharmacy_id}/wait-percentiles")
+async def get_wait_percentiles(
+    pharmacy_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    hour: Optional[int] = None,
+):
+    """Percentiles de espera (minutos) del rango, en total o para una hora del día"""
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    if hour is not None and not 0 <= hour <= 23:
+        raise HTTPException(status_code=400, detail="Hora no válida (0 a 23)")
+    end_date = parse_date_param(end, datetime.utcnow().date())
+    start_date = parse_date_param(start, end_date - timedelta(days=29))
+    if start_date > end_date or (end_date - start_date).days > 366:
+        raise HTTPException(status_code=400, detail="El rango de fechas no es válido")
+    
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
+    percentiles = demand_histograms.percentiles(conn, pharmacy_id, start_date, end_date, hour)
+    conn.close()
+    return percentiles
+
+@app.get("/api/admin/demand")
+async def get_demand_stats():
+    """Celdas pendientes de guardar y guardados de los histogramas de demanda de este worker"""
+    return demand_histograms.stats()
+
+@app.post("/api/admin/demand/backfill")
+async def backfill_demand_histograms(start: Optional[str] = None, end: Optional[str] = None):
+    """Reconstruye los histogramas de demanda desde los turnos en cada shard (por defecto todo el historial)"""
+    start_date = parse_date_param(start, None)
+    end_date = parse_date_param(end, None)
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="El rango de fechas no es válido")
+    
+    by_shard = {}
+    for shard in shard_router.shards():
+        # Lo pendiente de este worker ya está en los turnos: se descarta con la base bloqueada
+        discard = lambda db_path=shard.db_path: demand_histograms.discard(db_path, start_date, end_date)
+        by_shard[shard.key] = await run_in_threadpool(
+            backfill_demand, shard.db_path, start_date, end_date, shard.archive, discard
+        )
+    return {"cells": sum(by_shard.values()), "by_shard": by_shard}
+
+EXPORT_TURN_COLUMNS = [
+    "id", "pharmacy_id", "user_id", "user_name", "user_document", "turn_number",
+    "status", "request_type", "requested_at", "called_at", "attended_at"
+]
+
+EXPORT_INVENTORY_COLUMNS = [
+    "pharmacy_id", "medication_code", "current_stock", "min_threshold", "last_updated"
+]
+
+def export_response(name: str, sources: list, columns: list, format: str, gzip: bool) -> StreamingResponse:
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato no soportado (csv o ndjson)")
+    filename = export_filename(name, format, gzip)
+    return StreamingResponse(
+        stream_export(sources, columns, format, gzip),
+        media_type=export_media_type(format, gzip),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.get("/api/export/inventory")
+async def export_inventory(
+    format: str = "csv",
+    gzip: bool = False,
+    pharmacy_id: Optional[int] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """Volcado completo del inventario en streaming (filtro opcional por farmacia y last_updated)"""
+    conditions = []
+    params: list = []
+    if pharmacy_id is not None:
+        conditions.append("pharmacy_id = ?")
+        params.append(pharmacy_id)
+    if start is not None:
+        conditions.append("last_updated >= ?")
+        params.append(parse_date_param(start, None).isoformat())
+    if end is not None:
+        conditions.append("last_updated < ?")
+        params.append((parse_date_param(end, None) + timedelta(days=1)).isoformat())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    sql = f"SELECT {', '.join(EXPORT_INVENTORY_COLUMNS)} FROM inventory {where} ORDER BY pharmacy_id, medication_code"
+    shards = [shard_router.for_pharmacy(pharmacy_id)] if pharmacy_id is not None else shard_router.shards()
+    sources = [(shard.db_path, sql, tuple(params)) for shard in shards]
+    return export_response("inventory", sources, EXPORT_INVENTORY_COLUMNS, format, gzip)
+
+@app.get("/api/export/turns")
+async def export_turns(
+    format: str = "csv",
+    gzip: bool = False,
+    pharmacy_id: Optional[int] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    include_archived: bool = True,
+):
+    """Volcado de turnos en streaming, incluidos los archivos mensuales del rango"""
+    start_date = parse_date_param(start, None)
+    end_date = parse_date_param(end, None)
+    conditions = []
+    params: list = []
+    if pharmacy_id is not None:
+        conditions.append("pharmacy_id = ?")
+        params.append(pharmacy_id)
+    if start_date is not None:
+        conditions.append("requested_at >= ?")
+        params.append(start_date.isoformat())
+    if end_date is not None:
+        conditions.append("requested_at < ?")
+        params.append((end_date + timedelta(days=1)).isoformat())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    sources = turn_sources(EXPORT_TURN_COLUMNS, where, params, start_date, end_date, pharmacy_id, include_archived)
+    return export_response("turns", sources, EXPORT_TURN_COLUMNS, format, gzip)
+
+def turn_sources(columns, where: str, params: list, start_date: Optional[date], end_date: Optional[date],
+                 pharmacy_id: Optional[int] = None, include_archived: bool = True) -> list:
+    """(base, sql, params) por shard y mes archivado para leer turnos del rango en streaming"""
+    shards = [shard_router.for_pharmacy(pharmacy_id)] if pharmacy_id is not None else shard_router.shards()
+    sources = []
+    for shard in shards:
+        # Ids públicos: el número de shard va en los bits altos
+        projection = [f"id + {shard.id_offset} AS id" if column == "id" else column for column in columns]
+        sql = f"SELECT {', '.join(projection)} FROM turns {where} ORDER BY id"
+        if include_archived:
+            # Del mes archivado más antiguo a la tabla viva
+            for month in reversed(shard.archive.months_in_range(start_date, end_date)):
+                sources.append((shard.archive.archive_path(month), sql, tuple(params)))
+        sources.append((shard.db_path, sql, tuple(params)))
+    return sources
+
+# Instantáneas columnares para análisis (analytics.py): las consultas no tocan la base
+analytics_store = ColumnarStore()
+
+def snapshot_analytics(day: Optional[date] = None, include_inventory: bool = True) -> dict:
+    """Turnos solicitados en `day` (hoy por defecto) y, opcionalmente, el inventario actual con esa fecha"""
+    day = day or datetime.utcnow().date()
+    where = "WHERE requested_at >= ? AND requested_at < ?"
+    params = [day.isoformat(), (day + timedelta(days=1)).isoformat()]
+    result = {"turns": analytics_store.export_turns(day, turn_sources(TURN_SNAPSHOT_COLUMNS, where, params, day, day))}
+    if include_inventory:
+        sql = f"SELECT {', '.join(INVENTORY_SNAPSHOT_COLUMNS)} FROM inventory ORDER BY pharmacy_id, medication_code"
+        result["inventory"] = analytics_store.export_inventory(day, [(shard.db_path, sql, ()) for shard in shard_router.shards()])
+    return result
+
+def analytics_range(start: Optional[str], end: Optional[str]) -> tuple:
+    end_date = parse_date_param(end, datetime.utcnow().date())
+    start_date = parse_date_param(start, end_date - timedelta(days=29))
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="La fecha inicial es posterior a la final")
+    return start_date, end_date
+
+@app.get("/api/analytics/wait-times")
+async def get_analytics_wait_times(start: Optional[str] = None, end: Optional[str] = None, pharmacy_id: Optional[int] = None):
+    """Espera hasta la atención por farmacia (media y percentiles) desde las instantáneas"""
+    start_date, end_date = analytics_range(start, end)
+    return await run_in_threadpool(analytics_store.wait_times, start_date, end_date, pharmacy_id)
+
+@app.get("/api/analytics/demand")
+async def get_analytics_demand(start: Optional[str] = None, end: Optional[str] = None, pharmacy_id: Optional[int] = None):
+    """Llegadas por hora y tipo de turno, y medicamentos más consumidos, desde las instantáneas"""
+    start_date, end_date = analytics_range(start, end)
+    return await run_in_threadpool(analytics_store.demand, start_date, end_date, pharmacy_id)
+
+@app.get("/api/analytics/throughput")
+async def get_analytics_throughput(start: Optional[str] = None, end: Optional[str] = None, pharmacy_id: Optional[int] = None):
+    """Turnos atendidos por día y por hora, y tasa de cancelación, desde las instantáneas"""
+    start_date, end_date = analytics_range(start, end)
+    return await run_in_threadpool(analytics_store.throughput, start_date, end_date, pharmacy_id)
+
+@app.get("/api/admin/analytics")
+async def get_analytics_stats():
+    """Particiones por tabla y tamaño de las instantáneas columnares"""
+    return analytics_store.stats()
+
+@app.post("/api/admin/analytics/snapshot")
+async def create_analytics_snapshot(date: Optional[str] = None):
+    """Exporta los turnos de un día; el inventario solo se fotografía para hoy"""
+    today = datetime.utcnow().date()
+    day = parse_date_param(date, today)
+    if day > today:
+        raise HTTPException(status_code=400, detail="No se pueden exportar fechas futuras")
+    return await run_in_threadpool(snapshot_analytics, day, day == today)
+
+@app.get("/api/turns/{turn_id}/position")
+async def get_turn_position(turn_id: int):
+    """Posición en la cola y personas por delante, en O(log n)"""
+    position = turn_queue.position(shard_router.canonical_turn_id(turn_id))
+    if position is not None:
+        return {"turn_id": turn_id, "status": "pending", **position}
+    
+    # Fuera de la cola: solo se informa el estado
+    shard = shard_router.for_turn(turn_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Turno no encontrado")
+    conn = read_connection(shard.db_path)
     cursor = conn.cursor()
+    cursor.execute("SELECT pharmacy_id, turn_number, status FROM turns WHERE id = ?", (shard.local_turn_id(turn_id),))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="Turno no encontrado")
     
+    return {
+        "turn_id": turn_id,
+        "status": row[2],
+        "pharmacy_id": row[0],
+        "turn_number": row[1],
+        "position": None,
+        "people_ahead": None,
+        "pending_total": None
+    }
+
+@app.get("/api/dashboard/queues")
+async def get_queue_dashboard():
+    """Pendientes, llamados, atendidos, cancelados y turno actual de todas las farmacias (en memoria)"""
+    snapshot = queue_dashboard.snapshot(sorted(catalog.pharmacy_ids()))
+    for entry in snapshot["pharmacies"]:
+        entry["pharmacy_name"] = (catalog.pharmacy(entry["pharmacy_id"]) or {}).get("name")
+    return snapshot
+
+def set_turn_status(cursor: sqlite3.Cursor, local_turn_id: int, status: str,
+                    allowed_from: Optional[set] = None) -> tuple:
+    """Cambia el estado de un turno y sus rollups; (pharmacy_id, requested_at, estado previo, número)"""
     update_fields = [status]
     update_sql = "UPDATE turns SET status = ?"
     
@@ -408,42 +1719,233 @@ async def update_turn_status(turn_id: int, status: str):
         update_sql += ", called_at = CURRENT_TIMESTAMP"
     elif status == 'attended':
         update_sql += ", attended_at = CURRENT_TIMESTAMP"
+    elif status == 'cancelled':
+        update_sql += ", cancelled_at = CURRENT_TIMESTAMP"
+    
+    update_sql += " WHERE id = ? RETURNING attended_at"
+    update_fields.append(local_turn_id)
     
-    update_sql += " WHERE id = ?"
-    update_fields.append(turn_id)
+    # Estado previo para aplicar el delta a los rollups (en la misma transacción)
+    cursor.execute(
+        "SELECT pharmacy_id, requested_at, status, attended_at, turn_number FROM turns WHERE id = ?",
+        (local_turn_id,)
+    )
+    previous = cursor.fetchone()
+    if not previous:
+        raise HTTPException(status_code=404, detail="Turno no encontrado")
+    pharmacy_id, requested_at, old_status, old_attended_at, turn_number = previous
+    if allowed_from is not None and old_status not in allowed_from:
+        raise HTTPException(status_code=409, detail=f"El turno está {old_status}")
     
     cursor.execute(update_sql, update_fields)
+    new_attended_at = cursor.fetchone()[0]
     
-    if cursor.rowcount == 0:
-        conn.close()
+    record_status_change(
+        cursor, pharmacy_id, requested_at, old_status, status, old_attended_at, new_attended_at
+    )
+    return pharmacy_id, requested_at, old_status, turn_number
+
+@app.put("/api/turns/{turn_id}/status")
+async def update_turn_status(turn_id: int, status: str):
+    if status not in TURN_STATUSES:
+        raise HTTPException(status_code=400, detail="Estado no válido")
+    shard = shard_router.for_turn(turn_id)
+    if shard is None:
         raise HTTPException(status_code=404, detail="Turno no encontrado")
+    local_turn_id = shard.local_turn_id(turn_id)
     
-    conn.commit()
-    conn.close()
+    # Mismas reglas que los cambios en bloque: un turno atendido o cancelado ya no cambia (409)
+    def apply_status(conn: sqlite3.Connection):
+        return set_turn_status(conn.cursor(), local_turn_id, status, allowed_sources(status))
+    
+    pharmacy_id, requested_at, old_status, turn_number = await shard.writer.submit(apply_status)
+    
+    on_turn_transition(turn_id, pharmacy_id, requested_at, turn_number, old_status, status)
     
     return {"success": True}
 
+@app.post("/api/turns/bulk-status")
+async def bulk_update_turn_status(request: BulkStatusRequest):
+    """Cambia el estado de varios turnos (por ids o por farmacia/estado/fecha) en una transacción"""
+    if request.status not in TURN_STATUSES:
+        raise HTTPException(status_code=400, detail="Estado no válido")
+    if any(status not in TURN_STATUSES for status in request.current_status or []):
+        raise HTTPException(status_code=400, detail="Estado actual no válido")
+    if request.turn_ids is None and request.pharmacy_id is None:
+        raise HTTPException(status_code=400, detail="Indique turn_ids o pharmacy_id")
+    if request.turn_ids is not None and not 0 < len(request.turn_ids) <= MAX_BULK_TURN_IDS:
+        raise HTTPException(status_code=400, detail=f"turn_ids debe tener entre 1 y {MAX_BULK_TURN_IDS} elementos")
+    
+    # Por predicado, sin fecha explícita se toman los turnos de hoy
+    default_day = datetime.utcnow().date() if request.turn_ids is None else None
+    day = parse_date_param(request.requested_date, default_day)
+    
+    # Con sharding se aplica una transacción por shard y se suman los resultados
+    if request.turn_ids is not None:
+        # Ids públicos -> ids locales por shard; los de shards inexistentes cuentan como no encontrados
+        targets = {}
+        for turn_id in request.turn_ids:
+            shard = shard_router.for_turn(turn_id)
+            if shard is not None:
+                targets.setdefault(shard, []).append(shard.local_turn_id(turn_id))
+        if request.pharmacy_id is not None:
+            pharmacy_shard = shard_router.for_pharmacy(request.pharmacy_id)
+            targets = {pharmacy_shard: targets[pharmacy_shard]} if pharmacy_shard in targets else {}
+    else:
+        targets = {shard_router.for_pharmacy(request.pharmacy_id): None}
+    
+    result = {"status": request.status, "matched": 0, "updated": 0, "skipped": {}}
+    for shard, turn_ids in targets.items():
+        def apply_bulk(conn: sqlite3.Connection, turn_ids=turn_ids):
+            return transition_turns(
+                conn.cursor(),
+                request.status,
+                turn_ids=turn_ids,
+                pharmacy_id=request.pharmacy_id,
+                current_statuses=request.current_status,
+                requested_from=day.isoformat() if day else None,
+                requested_until=(day + timedelta(days=1)).isoformat() if day else None,
+            )
+        
+        # Una operación del escritor del shard (group commit), no una transacción aparte
+        shard_result, changes = await shard.writer.submit(apply_bulk)
+        on_status_change = shard.status_callback(on_turn_transition)
+        for change in changes:
+            on_status_change(*change)
+        result["matched"] += shard_result["matched"]
+        result["updated"] += shard_result["updated"]
+        for status, count in shard_result["skipped"].items():
+            result["skipped"][status] = result["skipped"].get(status, 0) + count
+    if request.turn_ids is not None:
+        result["not_found"] = len(set(request.turn_ids)) - result["matched"]
+    
+    return {"success": True, **result}
+
+@app.post("/api/terminals/sync")
+async def sync_terminal(batch: TerminalSyncBatch):
+    """Aplica en orden, en una transacción, los eventos acumulados por un terminal sin conexión"""
+    pharmacy_id = batch.pharmacy_id
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    terminal_id = batch.terminal_id.strip()
+    if not terminal_id or len(terminal_id) > 64:
+        raise HTTPException(status_code=400, detail="Identificador de terminal no válido")
+    if len(batch.events) > MAX_SYNC_BATCH:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_SYNC_BATCH} eventos por lote")
+    if any(event.sequence < 1 for event in batch.events):
+        raise HTTPException(status_code=400, detail="Las secuencias empiezan en 1")
+    shard = shard_router.for_pharmacy(pharmacy_id)
+    
+    # Cada handler corre en el SAVEPOINT de su evento; SyncConflict deshace solo ese evento
+    def sync_dispense(cursor: sqlite3.Cursor, event: dict):
+        medication_code = event["medication_code"]
+        if medication_code is None or catalog.medication(medication_code) is None:
+            raise SyncConflict("unknown_medication", "Medicamento no encontrado")
+        if event["quantity"] <= 0:
+            raise SyncConflict("invalid_quantity", "La cantidad debe ser mayor que cero")
+        turn_id = event["turn_id"]
+        local_turn_id = shard.local_turn_id(turn_id) if turn_id is not None and shard_router.for_turn(turn_id) is shard else None
+        try:
+            return dispense_stock(cursor, pharmacy_id, medication_code, event["quantity"], local_turn_id)
+        except HTTPException as e:
+            raise SyncConflict("insufficient_stock", e.detail)
+    
+    def sync_turn_status(cursor: sqlite3.Cursor, event: dict):
+        status = event["status"]
+        if status not in TURN_STATUSES:
+            raise SyncConflict("invalid_status", "Estado no válido")
+        turn_id = event["turn_id"]
+        if turn_id is None or shard_router.for_turn(turn_id) is not shard:
+            raise SyncConflict("unknown_turn", "Turno no encontrado")
+        # Lo que pasó en el servidor mientras tanto (p. ej. cierre del día) gana
+        try:
+            result = set_turn_status(cursor, shard.local_turn_id(turn_id), status, allowed_sources(status))
+        except HTTPException as e:
+            raise SyncConflict("unknown_turn" if e.status_code == 404 else "invalid_transition", e.detail)
+        if result[0] != pharmacy_id:
+            raise SyncConflict("unknown_turn", "El turno es de otra farmacia")
+        return result
+    
+    events = [event.model_dump() for event in batch.events]
+    
+    def apply_sync(conn: sqlite3.Connection):
+        try:
+            return apply_batch(
+                conn.cursor(), terminal_id, pharmacy_id, events,
+                {"dispense": sync_dispense, "turn_status": sync_turn_status}
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    
+    result = await shard.writer.submit(apply_sync)
+    
+    # Índices en memoria y alertas después del commit, en el orden de los eventos
+    for event, outcome in result["applied"]:
+        if event["type"] == "dispense":
+            new_stock, min_threshold, reservation_id = outcome
+            if reservation_id is not None:
+                reservations.forget(shard.number, reservation_id)
+            stock_alerts.evaluate(pharmacy_id, event["medication_code"], new_stock + event["quantity"], new_stock, min_threshold)
+        else:
+            turn_pharmacy_id, requested_at, old_status, turn_number = outcome
+            on_turn_transition(event["turn_id"], turn_pharmacy_id, requested_at, turn_number, old_status, event["status"])
+    
+    return {
+        "terminal_id": terminal_id,
+        "ack": result["ack"],
+        "applied": len(result["applied"]),
+        "duplicates": result["duplicates"],
+        "conflicts": result["conflicts"],
+        # Hueco en las secuencias: el terminal reenvía desde aquí
+        "resend_from": result["missing"]
+    }
+
+@app.get("/api/terminals/{terminal_id}/sync")
+async def get_terminal_sync_state(terminal_id: str, pharmacy_id: int, conflicts_limit: int = 50):
+    """Cursor de un terminal (último evento procesado) y sus conflictos recientes"""
+    if catalog.pharmacy(pharmacy_id) is None:
+        raise HTTPException(status_code=404, detail="Farmacia no encontrada")
+    conn = read_connection(shard_router.for_pharmacy(pharmacy_id).db_path)
+    state = sync_state(conn, terminal_id)
+    conflicts = recent_conflicts(conn, terminal_id, max(1, min(conflicts_limit, 500))) if state else []
+    conn.close()
+    if state is not None and state["pharmacy_id"] != pharmacy_id:
+        raise HTTPException(status_code=409, detail="El terminal está registrado en otra farmacia")
+    
+    return {
+        "terminal_id": terminal_id,
+        "pharmacy_id": pharmacy_id,
+        "ack": state["ack"] if state else 0,
+        "applied_count": state["applied_count"] if state else 0,
+        "conflict_count": state["conflict_count"] if state else 0,
+        "updated_at": state["updated_at"] if state else None,
+        "conflicts": conflicts
+    }
+
 @app.post("/api/turns/{turn_id}/notify")
 async def send_turn_notification(turn_id: int, phone_number: str):
     """Enviar notificación SMS para un turno específico"""
-    conn = sqlite3.connect('farmacia.db')
+    shard = shard_router.for_turn(turn_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Turno no encontrado")
+    conn = read_connection(shard.db_path)
     cursor = conn.cursor()
     
     # Obtener información del turno
     cursor.execute('''
-        SELECT t.turn_number, t.user_name, p.name as pharmacy_name
+        SELECT t.turn_number, t.user_name, t.pharmacy_id
         FROM turns t
-        JOIN pharmacies p ON t.pharmacy_id = p.id
         WHERE t.id = ?
-    ''', (turn_id,))
+    ''', (shard.local_turn_id(turn_id),))
     
     turn_info = cursor.fetchone()
-    if not turn_info:
-        conn.close()
+    conn.close()
+    pharmacy = catalog.pharmacy(turn_info[2]) if turn_info else None
+    if not pharmacy:
         raise HTTPException(status_code=404, detail="Turno no encontrado")
     
-    turn_number, user_name, pharmacy_name = turn_info
-    conn.close()
+    turn_number, user_name, _ = turn_info
+    pharmacy_name = pharmacy["name"]
     
     # Enviar SMS
     sms_result = sms_service.send_turn_notification(
@@ -458,6 +1960,109 @@ async def send_turn_notification(turn_id: int, phone_number: str):
         "sms_sent": sms_result
     }
 
+# Tareas de mantenimiento en segundo plano: fuera del camino de las peticiones
+scheduler = JobScheduler('farmacia.db')
+scheduler_task = None
+
+def close_day_all_shards() -> dict:
+    # Cierre automático del día: cancela los turnos que quedaron pendientes o llamados
+    cutoff = datetime.utcnow()
+    updated = 0
+    for shard in shard_router.shards():
+        result = close_day(shard.db_path, cutoff, on_status_change=shard.status_callback(on_turn_transition))
+        updated += result["updated"]
+    print(f"🌙 Cierre del día: {updated} turnos cancelados")
+    return {"updated": updated}
+
+def rollover_all_shards() -> dict:
+    # Turnos con más de TURNS_RETENTION_DAYS días a los archivos mensuales de cada shard
+    by_shard = {shard.key: shard.archive.rollover()["moved"] for shard in shard_router.shards()}
+    return {"moved": sum(by_shard.values()), "by_shard": by_shard}
+
+def refresh_catalog() -> dict:
+    # Recarga antes de que venza el TTL, así ninguna petición paga la recarga
+    catalog.invalidate()
+    return {"pharmacies": len(catalog.pharmacy_ids()), "medications": len(catalog.medication_codes())}
+
+if os.getenv("TURNS_DAY_CLOSE_ENABLED", "true").lower() in ("1", "true", "yes"):
+    close_hour, close_minute = (int(part) for part in DAY_CLOSE_TIME.split(":"))
+    scheduler.add_job(
+        "day-close", close_day_all_shards, cron=f"{close_minute} {close_hour} * * *",
+        description="Cancela los turnos pendientes o llamados al cierre del día"
+    )
+if os.getenv("TURNS_ARCHIVE_CRON", "30 3 * * *"):
+    scheduler.add_job(
+        "archive-rollover", rollover_all_shards, cron=os.getenv("TURNS_ARCHIVE_CRON", "30 3 * * *"),
+        jitter_seconds=300, lock_seconds=6 * 3600,
+        description="Mueve los turnos antiguos a los archivos mensuales"
+    )
+if os.getenv("ANALYTICS_SNAPSHOT_CRON", "50 23 * * *"):
+    # Después del cierre del día: los turnos de hoy ya tienen su estado final
+    scheduler.add_job(
+        "analytics-snapshot", snapshot_analytics, cron=os.getenv("ANALYTICS_SNAPSHOT_CRON", "50 23 * * *"),
+        jitter_seconds=60, lock_seconds=3 * 3600,
+        description="Exporta los turnos del día y el inventario a las instantáneas columnares"
+    )
+scheduler.add_job(
+    "idempotency-purge", idempotency_store.purge_expired, interval_seconds=3600, jitter_seconds=60,
+    description="Borra las claves Idempotency-Key vencidas"
+)
+scheduler.add_job(
+    "catalog-refresh", refresh_catalog, interval_seconds=max(30, catalog.ttl_seconds / 2), jitter_seconds=5,
+    exclusive=False, description="Recarga la caché de farmacias y medicamentos de este worker"
+)
+scheduler.add_job(
+    "demand-flush", demand_histograms.flush, interval_seconds=DEMAND_FLUSH_SECONDS, jitter_seconds=5,
+    exclusive=False, description="Guarda los histogramas de demanda acumulados en este worker"
+)
+scheduler.add_job(
+    "capacity-estimates", lambda: capacity.refresh(catalog.pharmacy_ids()),
+    interval_seconds=max(30, capacity.refresh_seconds / 2), jitter_seconds=10,
+    exclusive=False, description="Recalcula la tasa de servicio estimada de cada farmacia"
+)
+
+@app.on_event("startup")
+async def start_scheduler():
+    global scheduler_task
+    if scheduler.enabled:
+        scheduler_task = asyncio.create_task(scheduler.run())
+
+@app.on_event("shutdown")
+async def flush_demand_histograms():
+    # Lo acumulado desde el último demand-flush no se pierde al detener el worker
+    await run_in_threadpool(demand_histograms.flush)
+
+@app.get("/api/admin/jobs")
+async def get_jobs():
+    """Tareas programadas: horario, próxima ejecución, última ejecución y bloqueo"""
+    return scheduler.status()
+
+@app.get("/api/admin/jobs/{job_name}/runs")
+async def get_job_runs(job_name: str, limit: int = 50):
+    if job_name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    return {"job": job_name, "runs": scheduler.runs(job_name, max(1, min(limit, 200)))}
+
+@app.post("/api/admin/jobs/{job_name}/run")
+async def run_job_now(job_name: str):
+    """Ejecuta una tarea ahora, respetando el bloqueo entre workers"""
+    result = await scheduler.trigger(job_name)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    return result
+
+# Vencimiento y liberación de reservas de stock (rueda de tiempo, un tick por segundo)
+reservation_expiry_task = None
+
+async def close_shard_reservations(shard_number: int, reservation_ids: List[int], status: str) -> int:
+    shard = next(shard for shard in shard_router.shards() if shard.number == shard_number)
+    return await shard.writer.submit(lambda conn: close_reservations(conn, reservation_ids, status))
+
+@app.on_event("startup")
+async def start_reservation_expiry_job():
+    global reservation_expiry_task
+    reservation_expiry_task = asyncio.create_task(reservations.run_expiry_loop(close_shard_reservations))
+
 if __name__ == "__main__":
     import uvicorn
     import os
@@ -0,0 +1,135 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+# Limitadores en memoria para el control de admisión de turnos.
+# Todo vive en el proceso: con varios workers cada uno aplica sus propios límites.
+
+
+class KeyedTokenBucket:
+    """Token bucket por clave (documento, IP, farmacia) con número acotado de claves."""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = 100_000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        # clave -> [tokens, último_refill]; orden LRU para expulsar claves inactivas
+        self._buckets: "OrderedDict[str, list[float]]" = OrderedDict()
+
+    def _refill(self, key: str, now: float) -> list[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            elapsed = now - bucket[1]
+            if elapsed > 0:
+                bucket[0] = min(self.burst, bucket[0] + elapsed * self.rate)
+                bucket[1] = now
+        return bucket
+
+    def retry_after(self, key: str, now: float) -> float:
+        """Segundos hasta que haya un token disponible (0 si ya lo hay)."""
+        bucket = self._refill(key, now)
+        if bucket[0] >= 1.0:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (1.0 - bucket[0]) / self.rate
+
+    def consume(self, key: str, now: float) -> None:
+        bucket = self._refill(key, now)
+        bucket[0] -= 1.0
+
+
+class ConcurrencyLimiter:
+    """Límite global de peticiones en curso; rechaza en lugar de encolar."""
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.shed_count = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed_count += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+
+class TurnAdmissionController:
+    """Agrupa los límites por documento, IP y farmacia de POST /api/turns/request.
+
+    Solo se consume un token de cada bucket cuando los tres permiten la petición,
+    así un rechazo por IP no gasta el cupo del documento.
+    """
+
+    def __init__(
+        self,
+        user_per_minute: float,
+        user_burst: int,
+        ip_per_minute: float,
+        ip_burst: int,
+        pharmacy_per_minute: float,
+        pharmacy_burst: int,
+        enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self.by_user = KeyedTokenBucket(user_per_minute, user_burst)
+        self.by_ip = KeyedTokenBucket(ip_per_minute, ip_burst)
+        self.by_pharmacy = KeyedTokenBucket(pharmacy_per_minute, pharmacy_burst, max_keys=10_000)
+        self.rejected = {"user": 0, "ip": 0, "pharmacy": 0}
+        self._lock = threading.Lock()
+
+    def admit(self, user_document: str, client_ip: str, pharmacy_id: int, now: Optional[float] = None) -> tuple[bool, float, Optional[str]]:
+        """Devuelve (permitido, retry_after_segundos, límite_que_rechazó)."""
+        if not self.enabled:
+            return True, 0.0, None
+        now = time.monotonic() if now is None else now
+        checks = (
+            ("user", self.by_user, user_document),
+            ("ip", self.by_ip, client_ip),
+            ("pharmacy", self.by_pharmacy, str(pharmacy_id)),
+        )
+        with self._lock:
+            for name, limiter, key in checks:
+                wait = limiter.retry_after(key, now)
+                if wait > 0:
+                    self.rejected[name] += 1
+                    return False, wait, name
+            for _, limiter, key in checks:
+                limiter.consume(key, now)
+        return True, 0.0, None
+
+    @classmethod
+    def from_env(cls) -> "TurnAdmissionController":
+        return cls(
+            user_per_minute=float(os.getenv("TURN_RATE_USER_PER_MIN", "6")),
+            user_burst=int(os.getenv("TURN_RATE_USER_BURST", "3")),
+            ip_per_minute=float(os.getenv("TURN_RATE_IP_PER_MIN", "30")),
+            ip_burst=int(os.getenv("TURN_RATE_IP_BURST", "10")),
+            pharmacy_per_minute=float(os.getenv("TURN_RATE_PHARMACY_PER_MIN", "600")),
+            pharmacy_burst=int(os.getenv("TURN_RATE_PHARMACY_BURST", "100")),
+            enabled=os.getenv("TURN_RATE_LIMIT_ENABLED", "1") != "0",
+        )
+
+
+def retry_after_header(seconds: float) -> dict:
+    # Retry-After solo admite segundos enteros
+    if math.isinf(seconds):
+        seconds = 60
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
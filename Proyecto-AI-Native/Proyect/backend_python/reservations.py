@@ -0,0 +1,315 @@
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Hashable, Optional
+
+
+# Reservas de stock ligadas a turnos.
+# Al pedir un turno para un medicamento se aparta la cantidad en inventory.reserved_stock (en la
+# misma transacción que crea el turno) y las demás dispensaciones solo pueden usar
+# current_stock - reserved_stock. La reserva termina al dispensarla con el turno (fulfilled),
+# al atender o cancelar el turno (released) o al vencer su TTL (expired).
+#
+# Los vencimientos se llevan en memoria con una rueda de tiempo jerárquica: programar, cancelar
+# y vencer una reserva cuesta O(1) (más una bajada de nivel por cada nivel de la rueda), y el
+# vencimiento actualiza las filas por clave primaria, sin recorrer la tabla periódicamente.
+# Al arrancar se cargan las reservas activas de cada shard.
+
+RESERVATION_TTL_SECONDS = float(os.getenv("RESERVATION_TTL_SECONDS", "7200"))
+RESERVATION_TICK_SECONDS = float(os.getenv("RESERVATION_TICK_SECONDS", "1"))
+RESERVATION_EXPIRY_BATCH = int(os.getenv("RESERVATION_EXPIRY_BATCH", "500"))
+
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def init_reservation_schema(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(inventory)")}
+    if "reserved_stock" not in columns:
+        conn.execute("ALTER TABLE inventory ADD COLUMN reserved_stock INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id INTEGER PRIMARY KEY,
+            turn_id INTEGER NOT NULL,
+            pharmacy_id INTEGER NOT NULL,
+            medication_code TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            closed_at TIMESTAMP NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_turn ON stock_reservations (turn_id)")
+    # Solo las activas: la carga al arrancar no recorre el histórico
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_reservations_active ON stock_reservations (expires_at) WHERE status = 'active'"
+    )
+
+
+def to_epoch(timestamp: str) -> float:
+    return datetime.strptime(str(timestamp)[:19], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_epoch(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def reserve_stock(
+    cursor: sqlite3.Cursor,
+    turn_id: int,
+    pharmacy_id: int,
+    medication_code: str,
+    quantity: int,
+    ttl_seconds: float = RESERVATION_TTL_SECONDS,
+) -> Optional[tuple[int, str]]:
+    """Aparta `quantity` del stock disponible; (id, expires_at) o None si no alcanza."""
+    cursor.execute(
+        """
+        UPDATE inventory SET reserved_stock = reserved_stock + ?
+        WHERE pharmacy_id = ? AND medication_code = ? AND current_stock - reserved_stock >= ?
+        """,
+        (quantity, pharmacy_id, medication_code, quantity),
+    )
+    if cursor.rowcount == 0:
+        return None
+    expires_at = from_epoch(math.ceil(time.time() + ttl_seconds))
+    cursor.execute(
+        """
+        INSERT INTO stock_reservations (turn_id, pharmacy_id, medication_code, quantity, expires_at)
+        VALUES (?, ?, ?, ?, ?)
+        RETURNING id
+        """,
+        (turn_id, pharmacy_id, medication_code, quantity, expires_at),
+    )
+    return cursor.fetchone()[0], expires_at
+
+
+def consume_reservation(cursor: sqlite3.Cursor, turn_id: int, pharmacy_id: int, medication_code: str) -> Optional[tuple[int, int]]:
+    """Marca como dispensada la reserva activa del turno; (id, cantidad) o None.
+
+    El llamador descuenta la cantidad de reserved_stock en el mismo UPDATE que baja el stock.
+    """
+    cursor.execute(
+        """
+        UPDATE stock_reservations SET status = 'fulfilled', closed_at = CURRENT_TIMESTAMP
+        WHERE turn_id = ? AND pharmacy_id = ? AND medication_code = ? AND status = 'active'
+        RETURNING id, quantity
+        """,
+        (turn_id, pharmacy_id, medication_code),
+    )
+    return cursor.fetchone()
+
+
+def close_reservations(conn: sqlite3.Connection, reservation_ids: list[int], status: str) -> int:
+    """Cierra reservas activas por id (expired/released) y devuelve su cantidad a disponible."""
+    placeholders = ", ".join("?" for _ in reservation_ids)
+    rows = conn.execute(
+        f"""
+        UPDATE stock_reservations SET status = ?, closed_at = CURRENT_TIMESTAMP
+        WHERE id IN ({placeholders}) AND status = 'active'
+        RETURNING pharmacy_id, medication_code, quantity
+        """,
+        (status, *reservation_ids),
+    ).fetchall()
+    # Las que ya se habían cerrado (p. ej. dispensadas) no devuelven filas
+    conn.executemany(
+        """
+        UPDATE inventory SET reserved_stock = MAX(0, reserved_stock - ?)
+        WHERE pharmacy_id = ? AND medication_code = ?
+        """,
+        ((quantity, pharmacy_id, medication_code) for pharmacy_id, medication_code, quantity in rows),
+    )
+    return len(rows)
+
+
+class TimingWheel:
+    """Rueda de tiempo jerárquica: WHEEL_LEVELS niveles de WHEEL_SLOTS ranuras.
+
+    Una clave con vencimiento en el tick t va al nivel más bajo en el que t y el tick actual
+    solo difieren en ese dígito (base WHEEL_SLOTS); al llegar a su ranura baja de nivel hasta
+    vencer en el nivel 0. Lo que supera el alcance de la rueda espera en `_overflow`.
+    """
+
+    def __init__(self, tick_seconds: float = RESERVATION_TICK_SECONDS, slots: int = WHEEL_SLOTS,
+                 levels: int = WHEEL_LEVELS, now: Optional[float] = None):
+        self.tick_seconds = tick_seconds
+        self.slots = slots
+        self.levels = levels
+        self._current = math.floor((time.time() if now is None else now) / tick_seconds)
+        self._wheels: list[list[dict[Hashable, int]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow: dict[Hashable, int] = {}
+        self._due: dict[Hashable, int] = {}
+        # clave -> diccionario (ranura, overflow o vencidas) que la contiene
+        self._location: dict[Hashable, dict[Hashable, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._location)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._location
+
+    def _place(self, key: Hashable, tick: int) -> None:
+        if tick <= self._current:
+            bucket = self._due
+        else:
+            bucket = self._overflow
+            for level in range(self.levels):
+                span = self.slots ** (level + 1)
+                if tick // span == self._current // span:
+                    bucket = self._wheels[level][(tick // self.slots ** level) % self.slots]
+                    break
+        bucket[key] = tick
+        self._location[key] = bucket
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        self.cancel(key)
+        self._place(key, math.ceil(deadline / self.tick_seconds))
+
+    def cancel(self, key: Hashable) -> bool:
+        bucket = self._location.pop(key, None)
+        if bucket is None:
+            return False
+        del bucket[key]
+        return True
+
+    def expire_now(self, key: Hashable) -> None:
+        """Vence la clave en el próximo advance (si está programada)."""
+        if key in self._location:
+            self.cancel(key)
+            self._place(key, self._current)
+
+    def _cascade(self, bucket: dict[Hashable, int]) -> None:
+        entries = list(bucket.items())
+        bucket.clear()
+        for key, tick in entries:
+            self._place(key, tick)
+
+    def advance(self, now: Optional[float] = None) -> list[Hashable]:
+        """Avanza hasta `now` y devuelve las claves vencidas."""
+        target = math.floor((time.time() if now is None else now) / self.tick_seconds)
+        expired: list[Hashable] = []
+        while self._current < target:
+            self._current += 1
+            # Al entrar en una ranura de un nivel superior, sus claves bajan de nivel
+            for level in range(self.levels - 1, 0, -1):
+                if self._current % self.slots ** level == 0:
+                    self._cascade(self._wheels[level][(self._current // self.slots ** level) % self.slots])
+            if self._current % self.slots ** self.levels == 0:
+                self._cascade(self._overflow)
+            self._cascade(self._wheels[0][self._current % self.slots])
+            if not self._due and len(self._location) == 0:
+                # Rueda vacía: saltar directo al final
+                self._current = target
+        for key in self._due:
+            del self._location[key]
+        expired.extend(self._due)
+        self._due.clear()
+        return expired
+
+
+class ReservationManager:
+    def __init__(self, ttl_seconds: float = RESERVATION_TTL_SECONDS, tick_seconds: float = RESERVATION_TICK_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.tick_seconds = tick_seconds
+        # Claves (número de shard, id de reserva)
+        self._wheel = TimingWheel(tick_seconds)
+        # id público del turno -> clave de su reserva activa, y al revés
+        self._by_turn: dict[int, tuple[int, int]] = {}
+        self._turn_of: dict[tuple[int, int], int] = {}
+        # Reservas liberadas por su turno (attended/cancelled): se cierran como released
+        self._released: set[tuple[int, int]] = set()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.released = 0
+
+    def load(self, conn: sqlite3.Connection, shard_number: int, id_offset: int = 0) -> None:
+        rows = conn.execute(
+            "SELECT id, turn_id, expires_at FROM stock_reservations INDEXED BY idx_reservations_active WHERE status = 'active'"
+        ).fetchall()
+        for reservation_id, turn_id, expires_at in rows:
+            self.track(shard_number, reservation_id, id_offset | turn_id, expires_at)
+
+    def track(self, shard_number: int, reservation_id: int, turn_id: int, expires_at: str) -> None:
+        key = (shard_number, reservation_id)
+        with self._lock:
+            self._wheel.schedule(key, to_epoch(expires_at))
+            self._by_turn[turn_id] = key
+            self._turn_of[key] = turn_id
+
+    def _forget(self, key: tuple[int, int]) -> None:
+        self._wheel.cancel(key)
+        self._released.discard(key)
+        turn_id = self._turn_of.pop(key, None)
+        if turn_id is not None and self._by_turn.get(turn_id) == key:
+            del self._by_turn[turn_id]
+
+    def forget(self, shard_number: int, reservation_id: int) -> None:
+        """La reserva se cerró en la base (dispensada): deja de programarse su vencimiento."""
+        with self._lock:
+            self._forget((shard_number, reservation_id))
+
+    def release_turn(self, turn_id: int) -> bool:
+        """Libera en el próximo tick la reserva del turno, si tiene una activa."""
+        with self._lock:
+            key = self._by_turn.get(turn_id)
+            if key is None:
+                return False
+            self._released.add(key)
+            self._wheel.expire_now(key)
+            return True
+
+    def collect_due(self, now: Optional[float] = None) -> dict[tuple[int, str], list[int]]:
+        """Reservas a cerrar agrupadas por (shard, estado final).
+
+        Siguen asociadas a su turno hasta que el cierre se confirma (forget) o se reintenta.
+        """
+        with self._lock:
+            groups: dict[tuple[int, str], list[int]] = {}
+            for key in self._wheel.advance(now):
+                status = "released" if key in self._released else "expired"
+                groups.setdefault((key[0], status), []).append(key[1])
+        return groups
+
+    def retry(self, shard_number: int, reservation_ids: list[int]) -> None:
+        with self._lock:
+            retry_at = time.time() + self.tick_seconds
+            for reservation_id in reservation_ids:
+                self._wheel.schedule((shard_number, reservation_id), retry_at)
+
+    def stats(self) -> dict:
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "active": len(self._turn_of),
+            "expired": self.expired,
+            "released": self.released,
+        }
+
+    async def run_expiry_loop(self, close: Callable[[int, list[int], str], Awaitable[int]]) -> None:
+        """Cierra cada tick las reservas vencidas o liberadas con `close(shard, ids, estado)`."""
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            for (shard_number, status), reservation_ids in self.collect_due().items():
+                for start in range(0, len(reservation_ids), RESERVATION_EXPIRY_BATCH):
+                    batch = reservation_ids[start:start + RESERVATION_EXPIRY_BATCH]
+                    try:
+                        closed = await close(shard_number, batch, status)
+                    except Exception as e:
+                        print(f"⚠️ Error cerrando reservas ({status}) en shard {shard_number}: {e}")
+                        self.retry(shard_number, batch)
+                        continue
+                    with self._lock:
+                        for reservation_id in batch:
+                            self._forget((shard_number, reservation_id))
+                    if status == "expired":
+                        self.expired += closed
+                    else:
+                        self.released += closed
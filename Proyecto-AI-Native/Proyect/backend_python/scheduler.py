@@ -0,0 +1,383 @@
+import asyncio
+import inspect
+import json
+import os
+import random
+import socket
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
+
+
+# Planificador de tareas de mantenimiento dentro del proceso (asyncio).
+# Cada tarea tiene un horario cron (5 campos, UTC) o un intervalo y un jitter opcional; las
+# funciones síncronas corren en un hilo aparte, así el mantenimiento no ocupa el event loop
+# ni el camino de las peticiones.
+#
+# Con varios workers (uvicorn --workers, varias instancias sobre la misma base) cada uno
+# planifica todas las tareas, pero cada ejecución se reclama en scheduler_locks: el primero que
+# toma la ocurrencia (horario programado) la ejecuta y los demás la saltan. Los intervalos se
+# alinean a múltiplos del intervalo desde la época, así todos los workers calculan las mismas
+# ocurrencias. El bloqueo vence a los `lock_seconds` por si el dueño muere a mitad de la tarea.
+# Cada ejecución queda en scheduler_runs (se conservan las últimas SCHEDULER_HISTORY_LIMIT).
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") != "0"
+SCHEDULER_INSTANCE_ID = os.getenv("SCHEDULER_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SCHEDULER_HISTORY_LIMIT = int(os.getenv("SCHEDULER_HISTORY_LIMIT", "200"))
+# Tope de espera del bucle (también reintenta tareas cuyo bloqueo venció)
+SCHEDULER_MAX_SLEEP_SECONDS = 60
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def init_scheduler_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_locks (
+            job_name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            locked_until TIMESTAMP NOT NULL,
+            last_scheduled_for TIMESTAMP
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_runs (
+            id INTEGER PRIMARY KEY,
+            job_name TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            scheduled_for TIMESTAMP NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            status TEXT NOT NULL,
+            duration_ms REAL,
+            detail TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduler_runs_job ON scheduler_runs (job_name, id)")
+
+
+def _format(moment: datetime) -> str:
+    return moment.strftime(TIMESTAMP_FORMAT)
+
+
+class CronSchedule:
+    """Expresión cron de 5 campos (minuto hora día mes día_semana) en UTC.
+
+    Admite *, listas (1,15), rangos (1-5) y pasos (*/10, 8-18/2). Día de la semana 0-6 con
+    0 (o 7) = domingo; si se restringen día del mes y día de la semana basta con uno de los dos.
+    """
+
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Expresión cron no válida: {expression}")
+        self.expression = expression
+        values = [self._parse_field(part, low, high) for part, (_, low, high) in zip(parts, self.FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> set[int]:
+        values: set[int] = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step_text = item.split("/", 1)
+                step = int(step_text)
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = (int(part) for part in item.split("-", 1))
+            else:
+                start = end = int(item)
+                if step != 1:
+                    end = high
+            if start < low or end > high or start > end or step <= 0:
+                raise ValueError(f"Campo cron fuera de rango: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, after: datetime) -> datetime:
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Se avanza por mes, día u hora completos cuando ese campo no coincide
+        for _ in range(100_000):
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"La expresión cron no tiene próximas ejecuciones: {self.expression}")
+
+    def describe(self) -> str:
+        return f"cron {self.expression}"
+
+
+class IntervalSchedule:
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError("El intervalo debe ser mayor que cero")
+        self.seconds = seconds
+
+    def next_after(self, after: datetime) -> datetime:
+        # Múltiplo siguiente del intervalo desde la época: igual en todos los workers
+        epoch = (after - datetime(1970, 1, 1)).total_seconds()
+        return datetime(1970, 1, 1) + timedelta(seconds=(epoch // self.seconds + 1) * self.seconds)
+
+    def describe(self) -> str:
+        return f"every {self.seconds:g}s"
+
+
+class Job:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        schedule,
+        jitter_seconds: float = 0,
+        lock_seconds: float = 3600,
+        exclusive: bool = True,
+        description: str = "",
+    ):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.jitter_seconds = jitter_seconds
+        self.lock_seconds = lock_seconds
+        # False: corre en cada worker (p. ej. refrescar cachés en memoria del proceso)
+        self.exclusive = exclusive
+        self.description = description
+        self.next_run: Optional[datetime] = None
+        self.run_at: Optional[datetime] = None
+        self.running = False
+        self.last_run: Optional[dict] = None
+
+    def plan(self, after: datetime) -> None:
+        """Próxima ocurrencia y el momento (con jitter) en que se intenta ejecutar."""
+        self.next_run = self.schedule.next_after(after)
+        self.run_at = self.next_run + timedelta(seconds=random.uniform(0, self.jitter_seconds))
+
+
+class JobScheduler:
+    def __init__(self, db_path: str, instance_id: str = SCHEDULER_INSTANCE_ID, enabled: bool = SCHEDULER_ENABLED,
+                 history_limit: int = SCHEDULER_HISTORY_LIMIT):
+        self.db_path = db_path
+        self.instance_id = instance_id
+        self.enabled = enabled
+        self.history_limit = history_limit
+        self.jobs: dict[str, Job] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        cron: Optional[str] = None,
+        interval_seconds: Optional[float] = None,
+        jitter_seconds: float = 0,
+        lock_seconds: float = 3600,
+        exclusive: bool = True,
+        description: str = "",
+    ) -> Job:
+        if (cron is None) == (interval_seconds is None):
+            raise ValueError("Indique cron o interval_seconds")
+        schedule = CronSchedule(cron) if cron is not None else IntervalSchedule(interval_seconds)
+        job = Job(name, func, schedule, jitter_seconds, lock_seconds, exclusive, description)
+        job.plan(datetime.utcnow())
+        self.jobs[name] = job
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _acquire(self, job: Job, scheduled_for: datetime) -> bool:
+        now = datetime.utcnow()
+        conn = self._connect()
+        try:
+            # Se toma si el bloqueo venció y nadie ejecutó ya esta ocurrencia (o una posterior)
+            row = conn.execute(
+                """
+                INSERT INTO scheduler_locks (job_name, owner, locked_until, last_scheduled_for)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (job_name) DO UPDATE SET
+                    owner = excluded.owner,
+                    locked_until = excluded.locked_until,
+                    last_scheduled_for = excluded.last_scheduled_for
+                WHERE scheduler_locks.locked_until <= ?
+                  AND (scheduler_locks.last_scheduled_for IS NULL
+                       OR scheduler_locks.last_scheduled_for < excluded.last_scheduled_for)
+                RETURNING owner
+                """,
+                (job.name, self.instance_id, _format(now + timedelta(seconds=job.lock_seconds)),
+                 _format(scheduled_for), _format(now)),
+            ).fetchone()
+            conn.commit()
+            return row is not None
+        finally:
+            conn.close()
+
+    def _finish(self, job: Job, scheduled_for: datetime, started_at: datetime, status: str,
+                duration_ms: float, detail: Any) -> None:
+        conn = self._connect()
+        try:
+            if job.exclusive:
+                conn.execute(
+                    "UPDATE scheduler_locks SET locked_until = ? WHERE job_name = ? AND owner = ?",
+                    (_format(datetime.utcnow()), job.name, self.instance_id),
+                )
+            conn.execute(
+                """
+                INSERT INTO scheduler_runs (job_name, owner, scheduled_for, started_at, finished_at, status, duration_ms, detail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (job.name, self.instance_id, _format(scheduled_for), _format(started_at), _format(datetime.utcnow()),
+                 status, round(duration_ms, 1), json.dumps(detail, default=str) if detail is not None else None),
+            )
+            conn.execute(
+                """
+                DELETE FROM scheduler_runs WHERE job_name = ? AND id <= (
+                    SELECT id FROM scheduler_runs WHERE job_name = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (job.name, job.name, self.history_limit),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _execute(self, job: Job, scheduled_for: datetime) -> None:
+        if job.running:
+            return
+        job.running = True
+        try:
+            if job.exclusive and not await asyncio.to_thread(self._acquire, job, scheduled_for):
+                # Otro worker ya la ejecutó (o la está ejecutando)
+                job.last_run = {"scheduled_for": _format(scheduled_for), "status": "skipped", "owner": None}
+                return
+            started_at = datetime.utcnow()
+            start = time.perf_counter()
+            try:
+                if inspect.iscoroutinefunction(job.func):
+                    detail = await job.func()
+                else:
+                    detail = await asyncio.to_thread(job.func)
+                status = "ok"
+            except Exception as e:
+                detail = f"{type(e).__name__}: {e}"
+                status = "error"
+                print(f"⚠️ Error en la tarea {job.name}: {e}")
+            duration_ms = (time.perf_counter() - start) * 1000
+            job.last_run = {
+                "scheduled_for": _format(scheduled_for),
+                "started_at": _format(started_at),
+                "status": status,
+                "duration_ms": round(duration_ms, 1),
+                "owner": self.instance_id,
+            }
+            await asyncio.to_thread(self._finish, job, scheduled_for, started_at, status, duration_ms, detail)
+        finally:
+            job.running = False
+
+    def _spawn(self, job: Job, scheduled_for: datetime) -> None:
+        task = asyncio.create_task(self._execute(job, scheduled_for))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run(self) -> None:
+        """Bucle principal: duerme hasta la próxima tarea y lanza las que vencieron."""
+        self._wakeup = asyncio.Event()
+        while True:
+            now = datetime.utcnow()
+            for job in self.jobs.values():
+                if job.run_at is not None and job.run_at <= now:
+                    scheduled_for = job.next_run
+                    job.plan(max(now, scheduled_for))
+                    self._spawn(job, scheduled_for)
+            wake_at = min((job.run_at for job in self.jobs.values() if job.run_at is not None), default=None)
+            timeout = SCHEDULER_MAX_SLEEP_SECONDS
+            if wake_at is not None:
+                timeout = min(timeout, max(0.0, (wake_at - datetime.utcnow()).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def trigger(self, name: str) -> Optional[dict]:
+        """Ejecuta una tarea ahora (fuera de su horario) y devuelve el resultado de la ejecución."""
+        job = self.jobs.get(name)
+        if job is None:
+            return None
+        await self._execute(job, datetime.utcnow().replace(microsecond=0))
+        return job.last_run
+
+    def runs(self, name: Optional[str] = None, limit: int = 50) -> list[dict]:
+        conn = self._connect()
+        try:
+            where = "WHERE job_name = ?" if name else ""
+            rows = conn.execute(
+                f"""
+                SELECT job_name, owner, scheduled_for, started_at, finished_at, status, duration_ms, detail
+                FROM scheduler_runs {where} ORDER BY id DESC LIMIT ?
+                """,
+                ((name,) if name else ()) + (limit,),
+            ).fetchall()
+        finally:
+            conn.close()
+        columns = ("job_name", "owner", "scheduled_for", "started_at", "finished_at", "status", "duration_ms", "detail")
+        runs = []
+        for row in rows:
+            run = dict(zip(columns, row))
+            run["detail"] = json.loads(run["detail"]) if run["detail"] else None
+            runs.append(run)
+        return runs
+
+    def status(self) -> dict:
+        conn = self._connect()
+        try:
+            locks = {
+                row[0]: {"owner": row[1], "locked_until": row[2], "last_scheduled_for": row[3]}
+                for row in conn.execute("SELECT job_name, owner, locked_until, last_scheduled_for FROM scheduler_locks")
+            }
+        finally:
+            conn.close()
+        return {
+            "enabled": self.enabled,
+            "instance_id": self.instance_id,
+            "jobs": [
+                {
+                    "name": job.name,
+                    "description": job.description,
+                    "schedule": job.schedule.describe(),
+                    "jitter_seconds": job.jitter_seconds,
+                    "exclusive": job.exclusive,
+                    "next_run": _format(job.next_run) if job.next_run else None,
+                    "running": job.running,
+                    "last_run": job.last_run,
+                    "lock": locks.get(job.name),
+                }
+                for job in self.jobs.values()
+            ],
+        }
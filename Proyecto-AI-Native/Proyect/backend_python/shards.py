@@ -0,0 +1,363 @@
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import Callable, Iterable, Optional
+
+from archive import DEFAULT_ARCHIVE_DIR, TurnArchive
+from db_writer import GroupCommitWriter, configure_connection
+
+
+# Sharding de los datos operativos (inventario, turnos y sus rollups) en un archivo SQLite
+# por farmacia o por región, cada uno con su propio escritor: una dispensación en una farmacia
+# no compite por el bloqueo de escritura con los turnos de las demás.
+#
+# La base principal (farmacia.db) conserva el catálogo (farmacias, medicamentos, ubicaciones),
+# las claves de idempotencia y la asignación farmacia -> shard, que es fija una vez creada.
+# La base principal es el shard 0: con el sharding desactivado todo sigue en ella.
+#
+# Los ids de turno públicos llevan el número de shard en los bits altos
+# (shard << TURN_ID_SHARD_BITS | id local), así un turno se enruta solo con su id.
+# En el shard 0 el id público es el id local.
+#
+# Al migrar una farmacia sus turnos y citas conservan el id local; los que crea un shard
+# empiezan en SHARD_LOCAL_ID_BASE, así nunca chocan con los migrados desde la base principal.
+# Los ids públicos anteriores a la migración (los que ya tienen los clientes, los SMS y los
+# terminales) siguen enrutándose al shard con la tabla shard_legacy_ids.
+
+SHARDING_MODE = os.getenv("FARMACIA_SHARDING", "off")  # off | pharmacy | region
+SHARDS_DIR = os.getenv("FARMACIA_SHARDS_DIR", "shards")
+SHARDING_MODES = ("off", "pharmacy", "region")
+
+TURN_ID_SHARD_BITS = 32
+LOCAL_TURN_ID_MASK = (1 << TURN_ID_SHARD_BITS) - 1
+SHARD_LOCAL_ID_BASE = 1 << 31
+
+# Tablas con ids públicos (se conservan al migrar); el resto recibe ids nuevos en el shard
+LEGACY_ID_TABLES = {"turns": "turn", "appointments": "appointment"}
+
+# Tablas que se mueven de la base principal al shard al asignar una farmacia
+SHARDED_TABLES = (
+    "inventory", "turns", "turn_stats_hourly", "stock_reservations", "appointments",
+    "terminal_sync_state", "terminal_sync_conflicts", "demand_histograms",
+)
+
+
+def init_shard_schema(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(pharmacies)")}
+    if "region" not in columns:
+        conn.execute("ALTER TABLE pharmacies ADD COLUMN region TEXT")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shards (
+            number INTEGER PRIMARY KEY,
+            shard_key TEXT UNIQUE NOT NULL,
+            db_path TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shard_assignments (
+            pharmacy_id INTEGER PRIMARY KEY,
+            shard_number INTEGER NOT NULL REFERENCES shards(number)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shard_legacy_ids (
+            kind TEXT NOT NULL,
+            legacy_id INTEGER NOT NULL,
+            shard_number INTEGER NOT NULL,
+            PRIMARY KEY (kind, legacy_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def shard_archive_dir(key: str) -> str:
+    return os.path.join(DEFAULT_ARCHIVE_DIR, key)
+
+
+def shard_databases(db_path: str) -> list[tuple[str, TurnArchive]]:
+    """(base, archivo de turnos) de la base principal y de cada shard, para los scripts de mantenimiento."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shards'").fetchone() is None:
+            rows = []
+        else:
+            rows = conn.execute("SELECT shard_key, db_path FROM shards ORDER BY number").fetchall()
+    finally:
+        conn.close()
+    return [(db_path, TurnArchive(db_path))] + [(path, TurnArchive(path, shard_archive_dir(key))) for key, path in rows]
+
+
+def pharmacy_databases(db_path: str) -> dict[int, str]:
+    """Base de cada farmacia ya asignada a un shard (las demás siguen en la principal), para los scripts."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shard_assignments'").fetchone() is None:
+            return {}
+        rows = conn.execute(
+            "SELECT a.pharmacy_id, s.db_path FROM shard_assignments a JOIN shards s ON s.number = a.shard_number"
+        ).fetchall()
+    finally:
+        conn.close()
+    return dict(rows)
+
+
+def split_turn_id(turn_id: int) -> tuple[int, int]:
+    """(número de shard, id local) de un id de turno público."""
+    return turn_id >> TURN_ID_SHARD_BITS, turn_id & LOCAL_TURN_ID_MASK
+
+
+class Shard:
+    def __init__(self, number: int, key: str, db_path: str, writer: GroupCommitWriter, archive: TurnArchive):
+        self.number = number
+        self.key = key
+        self.db_path = db_path
+        self.writer = writer
+        self.archive = archive
+        self.id_offset = number << TURN_ID_SHARD_BITS
+
+    def global_turn_id(self, local_id: int) -> int:
+        return self.id_offset | local_id
+
+    def local_turn_id(self, turn_id: int) -> int:
+        return turn_id & LOCAL_TURN_ID_MASK
+
+    def local_keyset_id(self, turn_id: int) -> int:
+        """Id local equivalente a un id público para paginar con (requested_at, id) < (?, ?).
+
+        Los ids de shards anteriores quedan por debajo de todo el shard y los de shards
+        posteriores por encima.
+        """
+        return min(max(turn_id - self.id_offset, 0), LOCAL_TURN_ID_MASK + 1)
+
+    def status_callback(self, on_status_change: Callable) -> Callable:
+        # bulk_transition informa ids locales; el resto de la app usa ids públicos
+        def callback(turn_id: int, *args) -> None:
+            on_status_change(self.global_turn_id(turn_id), *args)
+        return callback
+
+
+class ShardRouter:
+    def __init__(
+        self,
+        db_path: str,
+        main_writer: GroupCommitWriter,
+        init_schema: Callable[[sqlite3.Connection], None],
+        region_of: Callable[[int], Optional[str]],
+        mode: str = SHARDING_MODE,
+        shards_dir: str = SHARDS_DIR,
+    ):
+        if mode not in SHARDING_MODES:
+            raise ValueError(f"Modo de sharding no válido: {mode}")
+        self.db_path = db_path
+        self.mode = mode
+        self.shards_dir = shards_dir
+        # Crea las tablas de un shard nuevo (el mismo esquema que la base principal)
+        self.init_schema = init_schema
+        self.region_of = region_of
+        self.main = Shard(0, "main", db_path, main_writer, TurnArchive(db_path))
+        self._shards: dict[int, Shard] = {0: self.main}
+        self._assignments: dict[int, int] = {}
+        # Tipo ('turn' | 'appointment') -> id público anterior a la migración -> número de shard
+        self._legacy_ids: dict[str, dict[int, int]] = {kind: {} for kind in LEGACY_ID_TABLES.values()}
+        self._lock = threading.Lock()
+
+    def _init_shard_db(self, db_path: str) -> None:
+        # Crea o pone al día el esquema (tablas añadidas después de crear el shard)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            configure_connection(conn)
+            self.init_schema(conn)
+            # Los ids propios del shard quedan por encima de los migrados desde la base principal
+            for table in LEGACY_ID_TABLES:
+                reserved = conn.execute(
+                    "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (SHARD_LOCAL_ID_BASE - 1, table)
+                ).rowcount
+                if not reserved:
+                    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, SHARD_LOCAL_ID_BASE - 1))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _open_shard(self, number: int, key: str, db_path: str) -> Shard:
+        return Shard(number, key, db_path, GroupCommitWriter(db_path), TurnArchive(db_path, shard_archive_dir(key)))
+
+    def load(self) -> None:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            shards = conn.execute("SELECT number, shard_key, db_path FROM shards").fetchall()
+            assignments = conn.execute("SELECT pharmacy_id, shard_number FROM shard_assignments").fetchall()
+            legacy_ids = conn.execute("SELECT kind, legacy_id, shard_number FROM shard_legacy_ids").fetchall()
+        finally:
+            conn.close()
+        with self._lock:
+            for number, key, db_path in shards:
+                if number not in self._shards:
+                    self._init_shard_db(db_path)
+                    self._shards[number] = self._open_shard(number, key, db_path)
+            self._assignments = dict(assignments)
+            for kind, legacy_id, number in legacy_ids:
+                self._legacy_ids.setdefault(kind, {})[legacy_id] = number
+
+    def shard_key(self, pharmacy_id: int) -> str:
+        if self.mode == "pharmacy":
+            return f"pharmacy-{pharmacy_id}"
+        region = unicodedata.normalize("NFKD", self.region_of(pharmacy_id) or "default").encode("ascii", "ignore").decode()
+        region = re.sub(r"[^a-z0-9]+", "-", region.lower()).strip("-")
+        return f"region-{region or 'default'}"
+
+    def for_pharmacy(self, pharmacy_id: int) -> Shard:
+        # Las asignaciones existentes se respetan aunque luego se desactive el sharding
+        number = self._assignments.get(pharmacy_id)
+        if number is None:
+            if self.mode == "off":
+                return self.main
+            number = self._assign(pharmacy_id)
+        return self._shards[number]
+
+    def _for_public_id(self, kind: str, public_id: int) -> Optional[Shard]:
+        number = split_turn_id(public_id)[0]
+        if number == 0:
+            # Id emitido por la base principal antes de migrar la farmacia a un shard
+            number = self._legacy_ids[kind].get(public_id, 0)
+        return self._shards.get(number)
+
+    def for_turn(self, turn_id: int) -> Optional[Shard]:
+        return self._for_public_id("turn", turn_id)
+
+    def for_appointment(self, appointment_id: int) -> Optional[Shard]:
+        return self._for_public_id("appointment", appointment_id)
+
+    def canonical_turn_id(self, turn_id: int) -> int:
+        """Id público actual de un turno (el de su shard si se migró)."""
+        shard = self.for_turn(turn_id)
+        return shard.global_turn_id(shard.local_turn_id(turn_id)) if shard is not None else turn_id
+
+    def shards(self) -> list[Shard]:
+        return sorted(self._shards.values(), key=lambda shard: shard.number)
+
+    def group_by_shard(self, pharmacy_ids: Iterable[int]) -> dict[Shard, list[int]]:
+        groups: dict[Shard, list[int]] = {}
+        for pharmacy_id in pharmacy_ids:
+            groups.setdefault(self.for_pharmacy(pharmacy_id), []).append(pharmacy_id)
+        return groups
+
+    def assign_all(self, pharmacy_ids: Iterable[int]) -> None:
+        """Asigna (y migra) al arrancar las farmacias que aún no tienen shard."""
+        if self.mode == "off":
+            return
+        for pharmacy_id in sorted(pharmacy_ids):
+            if pharmacy_id not in self._assignments:
+                self._assign(pharmacy_id)
+
+    def _assign(self, pharmacy_id: int) -> int:
+        with self._lock:
+            # Otro hilo pudo asignarla mientras esperábamos el lock
+            if pharmacy_id in self._assignments:
+                return self._assignments[pharmacy_id]
+            key = self.shard_key(pharmacy_id)
+            shard = next((s for s in self._shards.values() if s.key == key), None)
+            if shard is None:
+                shard = self._create_shard(key)
+            self._migrate(pharmacy_id, shard)
+
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO shard_assignments (pharmacy_id, shard_number) VALUES (?, ?)",
+                    (pharmacy_id, shard.number),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            assignments = dict(self._assignments)
+            assignments[pharmacy_id] = shard.number
+            self._assignments = assignments
+            return shard.number
+
+    def _create_shard(self, key: str) -> Shard:
+        os.makedirs(self.shards_dir, exist_ok=True)
+        db_path = os.path.join(self.shards_dir, f"{key}.db")
+        self._init_shard_db(db_path)
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            number = conn.execute(
+                "INSERT INTO shards (number, shard_key, db_path) "
+                "VALUES ((SELECT COALESCE(MAX(number), 0) + 1 FROM shards), ?, ?) RETURNING number",
+                (key, db_path),
+            ).fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+        shard = self._open_shard(number, key, db_path)
+        self._shards = {**self._shards, number: shard}
+        return shard
+
+    def _migrate(self, pharmacy_id: int, shard: Shard) -> None:
+        # Copia y luego borra: si se interrumpe, repetir es seguro (se descarta la copia parcial)
+        legacy_ids: list[tuple[str, int]] = []
+        conn = sqlite3.connect(shard.db_path, timeout=30)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (self.db_path,))
+            for table in SHARDED_TABLES:
+                conn.execute(f"DELETE FROM main.{table} WHERE pharmacy_id = ?", (pharmacy_id,))
+                columns = [row[1] for row in conn.execute(f"PRAGMA source.table_info({table})")]
+                if table in LEGACY_ID_TABLES:
+                    taken = conn.execute(
+                        f"SELECT COUNT(*) FROM main.{table} WHERE id IN (SELECT id FROM source.{table} WHERE pharmacy_id = ?)",
+                        (pharmacy_id,),
+                    ).fetchone()[0]
+                    if taken:
+                        raise RuntimeError(f"{shard.db_path}: {taken} ids de {table} de la farmacia {pharmacy_id} ya están en uso")
+                    kind = LEGACY_ID_TABLES[table]
+                    ids = [row[0] for row in conn.execute(f"SELECT id FROM source.{table} WHERE pharmacy_id = ?", (pharmacy_id,))]
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO source.shard_legacy_ids (kind, legacy_id, shard_number) VALUES (?, ?, ?)",
+                        [(kind, legacy_id, shard.number) for legacy_id in ids],
+                    )
+                    legacy_ids.extend((kind, legacy_id) for legacy_id in ids)
+                elif "id" in columns:
+                    # Ids internos: el shard asigna los suyos
+                    columns.remove("id")
+                column_list = ", ".join(columns)
+                conn.execute(
+                    f"INSERT INTO main.{table} ({column_list}) "
+                    f"SELECT {column_list} FROM source.{table} WHERE pharmacy_id = ?",
+                    (pharmacy_id,),
+                )
+            conn.commit()
+            for table in SHARDED_TABLES:
+                conn.execute(f"DELETE FROM source.{table} WHERE pharmacy_id = ?", (pharmacy_id,))
+            conn.commit()
+            conn.execute("DETACH DATABASE source")
+        finally:
+            conn.close()
+        for kind, legacy_id in legacy_ids:
+            self._legacy_ids[kind][legacy_id] = shard.number
+        # Sus meses archivados pasan a los archivos del shard (historial, exportaciones y backfills)
+        self.main.archive.move_pharmacy(pharmacy_id, shard.archive)
+
+    def stats(self) -> dict:
+        pharmacies_by_shard: dict[int, int] = {}
+        for number in self._assignments.values():
+            pharmacies_by_shard[number] = pharmacies_by_shard.get(number, 0) + 1
+        return {
+            "mode": self.mode,
+            "shards": [
+                {
+                    "number": shard.number,
+                    "key": shard.key,
+                    "db_path": shard.db_path,
+                    "pharmacies": pharmacies_by_shard.get(shard.number, 0),
+                    "writer": shard.writer.stats(),
+                }
+                for shard in self.shards()
+            ],
+        }
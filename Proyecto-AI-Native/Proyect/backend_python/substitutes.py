@@ -0,0 +1,142 @@
+import math
+import re
+import threading
+import unicodedata
+from typing import Optional
+
+
+# Sugerencia de medicamentos sustitutos.
+# Los nombres del catálogo siguen el formato "<principio activo> <concentración> (<forma>)",
+# p. ej. "Paracetamol 500mg (tabletas)" o "Salbutamol 100mcg"; la concentración y la forma son
+# opcionales ("Insulina NPH"). Un medicamento sustituye a otro si comparte el principio
+# activo. El grafo de sustitución (código -> sustitutos ordenados por cercanía) se calcula una
+# vez por versión del catálogo en memoria, así una consulta solo cruza la lista ya ordenada con
+# el stock vivo.
+#
+# Puntaje (menor es mejor): 0 si coinciden concentración y forma (mismo producto con otro
+# código), +1 si cambia la forma y |log2| de la razón entre concentraciones si cambia la dosis
+# (+2 si las concentraciones no son comparables, p. ej. una sin dosis o mg frente a ml).
+
+NAME_RE = re.compile(
+    r"^\s*(?P<ingredient>.+?)"
+    r"(?:\s+(?P<value>\d+(?:[.,]\d+)?)\s*(?P<unit>mcg|µg|mg|g|ml|ui|%))?"
+    r"\s*(?:\((?P<form>[^)]*)\))?\s*$",
+    re.IGNORECASE,
+)
+
+# Factores a mg (mcg y g); el resto de unidades solo se compara consigo misma
+UNIT_FACTORS = {"mcg": 0.001, "µg": 0.001, "mg": 1.0, "g": 1000.0}
+
+MATCH_EQUIVALENT = "equivalent"
+MATCH_STRENGTH = "strength"
+MATCH_FORM = "form"
+
+# Tope de sustitutos precalculados por medicamento
+MAX_SUBSTITUTES = 50
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return " ".join(text.lower().split())
+
+
+def parse_medication_name(name: str) -> dict:
+    """Principio activo, concentración y forma de un nombre del catálogo."""
+    match = NAME_RE.match(name or "")
+    if match is None or not match.group("ingredient").strip():
+        return {"ingredient": _normalize(name or ""), "strength": None, "unit": None, "form": None}
+    value = match.group("value")
+    unit = match.group("unit").lower() if match.group("unit") else None
+    form = match.group("form")
+    return {
+        "ingredient": _normalize(match.group("ingredient")),
+        "strength": float(value.replace(",", ".")) if value else None,
+        "unit": "mcg" if unit == "µg" else unit,
+        "form": (_normalize(form) or None) if form else None,
+    }
+
+
+def _strength_mg(parsed: dict) -> Optional[tuple[float, str]]:
+    # (valor, unidad comparable): mcg/mg/g se llevan a mg
+    if parsed["strength"] is None:
+        return None
+    factor = UNIT_FACTORS.get(parsed["unit"])
+    if factor is None:
+        return parsed["strength"], parsed["unit"]
+    return parsed["strength"] * factor, "mg"
+
+
+def substitution_score(original: dict, candidate: dict) -> tuple[float, str]:
+    """(puntaje, tipo de coincidencia) de un candidato con el mismo principio activo."""
+    score = 0.0
+    same_form = original["form"] == candidate["form"]
+    if not same_form:
+        score += 1.0
+    original_strength = _strength_mg(original)
+    candidate_strength = _strength_mg(candidate)
+    if original_strength == candidate_strength:
+        same_strength = True
+    elif (original_strength is None or candidate_strength is None
+          or original_strength[1] != candidate_strength[1]
+          or original_strength[0] <= 0 or candidate_strength[0] <= 0):
+        # Concentraciones no comparables
+        same_strength = False
+        score += 2.0
+    else:
+        same_strength = False
+        score += abs(math.log2(candidate_strength[0] / original_strength[0]))
+    if same_strength and same_form:
+        return score, MATCH_EQUIVALENT
+    return round(score, 3), MATCH_STRENGTH if same_form else MATCH_FORM
+
+
+class SubstitutionIndex:
+    def __init__(self, max_substitutes: int = MAX_SUBSTITUTES):
+        self.max_substitutes = max_substitutes
+        # (catálogo del que se construyó, nombres interpretados, grafo); el caché del catálogo
+        # reemplaza su dict en cada cambio, así la identidad basta para detectar cambios.
+        # Grafo: código -> [(puntaje, código sustituto, tipo)] ordenado
+        self._state: tuple[Optional[dict], dict[str, dict], dict[str, list[tuple[float, str, str]]]] = (None, {}, {})
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def build(self, medications: dict[str, dict]) -> None:
+        parsed = {code: parse_medication_name(medication["name"]) for code, medication in medications.items()}
+        groups: dict[str, list[str]] = {}
+        for code, info in parsed.items():
+            groups.setdefault(info["ingredient"], []).append(code)
+
+        graph = {}
+        for codes in groups.values():
+            for code in codes:
+                ranked = sorted(
+                    (*substitution_score(parsed[code], parsed[other]), other)
+                    for other in codes if other != code
+                )
+                graph[code] = [(score, other, match) for score, match, other in ranked[:self.max_substitutes]]
+        # Reemplazo atómico, igual que el catálogo
+        self._state = (medications, parsed, graph)
+        self.builds += 1
+
+    def sync(self, medications: dict[str, dict]) -> None:
+        """Reconstruye el grafo si el catálogo cambió desde la última vez."""
+        if medications is self._state[0]:
+            return
+        with self._lock:
+            if medications is not self._state[0]:
+                self.build(medications)
+
+    def parsed(self, code: str) -> Optional[dict]:
+        return self._state[1].get(code)
+
+    def substitutes(self, code: str) -> list[tuple[float, str, str]]:
+        return self._state[2].get(code, [])
+
+    def stats(self) -> dict:
+        _, parsed, graph = self._state
+        return {
+            "medications": len(parsed),
+            "ingredients": len({info["ingredient"] for info in parsed.values()}),
+            "edges": sum(len(edges) for edges in graph.values()),
+            "builds": self.builds,
+        }
@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+from typing import Any, Callable, Optional
+
+
+# Sincronización por lotes de los terminales de mostrador que trabajan sin conexión.
+# Cada terminal numera sus eventos (dispensaciones, cambios de estado de turnos) con una
+# secuencia propia que empieza en 1 y no tiene huecos. Al reconectarse envía los pendientes
+# en lotes; el servidor los aplica en orden dentro de una sola transacción del escritor del
+# shard de la farmacia y guarda en terminal_sync_state la última secuencia procesada, que
+# vuelve al terminal como cursor de confirmación (ack).
+#
+# - Secuencias <= ack son reenvíos: se ignoran (deduplicación sin guardar cada evento).
+# - Si falta una secuencia, se procesa hasta el hueco y el terminal reenvía desde ack + 1.
+# - Un evento que ya no se puede aplicar (stock insuficiente, turno cerrado...) es un
+#   conflicto: se deshace solo ese evento (SAVEPOINT), se registra en terminal_sync_conflicts
+#   para revisión y el cursor avanza igual, así un conflicto no bloquea al terminal.
+
+MAX_SYNC_BATCH = int(os.getenv("TERMINAL_SYNC_MAX_BATCH", "500"))
+
+SYNC_EVENT_TYPES = ("dispense", "turn_status")
+
+
+class SyncConflict(Exception):
+    def __init__(self, reason: str, detail: str):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+
+
+def init_terminal_sync_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS terminal_sync_state (
+            terminal_id TEXT PRIMARY KEY,
+            pharmacy_id INTEGER NOT NULL,
+            last_sequence INTEGER NOT NULL DEFAULT 0,
+            applied_count INTEGER NOT NULL DEFAULT 0,
+            conflict_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS terminal_sync_conflicts (
+            id INTEGER PRIMARY KEY,
+            terminal_id TEXT NOT NULL,
+            pharmacy_id INTEGER NOT NULL,
+            sequence INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            detail TEXT,
+            payload TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_terminal_conflicts ON terminal_sync_conflicts (terminal_id, sequence)"
+    )
+
+
+def sync_state(conn: sqlite3.Connection, terminal_id: str) -> Optional[dict]:
+    row = conn.execute(
+        """
+        SELECT pharmacy_id, last_sequence, applied_count, conflict_count, updated_at
+        FROM terminal_sync_state WHERE terminal_id = ?
+        """,
+        (terminal_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(("pharmacy_id", "ack", "applied_count", "conflict_count", "updated_at"), row))
+
+
+def recent_conflicts(conn: sqlite3.Connection, terminal_id: str, limit: int = 50) -> list[dict]:
+    rows = conn.execute(
+        """
+        SELECT sequence, event_type, reason, detail, payload, created_at
+        FROM terminal_sync_conflicts WHERE terminal_id = ?
+        ORDER BY sequence DESC LIMIT ?
+        """,
+        (terminal_id, limit),
+    ).fetchall()
+    return [
+        {
+            "sequence": sequence,
+            "type": event_type,
+            "reason": reason,
+            "detail": detail,
+            "event": json.loads(payload) if payload else None,
+            "created_at": created_at,
+        }
+        for sequence, event_type, reason, detail, payload, created_at in rows
+    ]
+
+
+def apply_batch(
+    cursor: sqlite3.Cursor,
+    terminal_id: str,
+    pharmacy_id: int,
+    events: list[dict],
+    handlers: dict[str, Callable[[sqlite3.Cursor, dict], Any]],
+) -> dict:
+    """Aplica en orden los eventos nuevos de un terminal dentro de la transacción del llamador.
+
+    Cada handler recibe (cursor, evento) y lanza SyncConflict si el evento no se puede aplicar.
+    Devuelve el nuevo ack, los eventos aplicados con el resultado de su handler (para los
+    efectos en memoria después del commit), los conflictos, los duplicados y, si hubo un
+    hueco, la primera secuencia que falta.
+    """
+    cursor.execute(
+        "SELECT pharmacy_id, last_sequence FROM terminal_sync_state WHERE terminal_id = ?", (terminal_id,)
+    )
+    state = cursor.fetchone()
+    if state is not None and state[0] != pharmacy_id:
+        raise ValueError("El terminal está registrado en otra farmacia")
+    ack = state[1] if state is not None else 0
+
+    applied: list[tuple[dict, Any]] = []
+    conflicts: list[dict] = []
+    duplicates = 0
+    missing = None
+    for event in sorted(events, key=lambda event: event["sequence"]):
+        sequence = event["sequence"]
+        if sequence <= ack:
+            duplicates += 1
+            continue
+        if sequence != ack + 1:
+            missing = ack + 1
+            break
+        handler = handlers.get(event["type"])
+        cursor.execute("SAVEPOINT sync_event")
+        try:
+            if handler is None:
+                raise SyncConflict("unknown_type", f"Tipo de evento desconocido: {event['type']}")
+            applied.append((event, handler(cursor, event)))
+            cursor.execute("RELEASE sync_event")
+        except SyncConflict as conflict:
+            cursor.execute("ROLLBACK TO sync_event")
+            cursor.execute("RELEASE sync_event")
+            cursor.execute(
+                """
+                INSERT INTO terminal_sync_conflicts (terminal_id, pharmacy_id, sequence, event_type, reason, detail, payload)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (terminal_id, pharmacy_id, sequence, event["type"], conflict.reason, conflict.detail,
+                 json.dumps(event, separators=(",", ":"))),
+            )
+            conflicts.append({"sequence": sequence, "reason": conflict.reason, "detail": conflict.detail})
+        ack = sequence
+
+    cursor.execute(
+        """
+        INSERT INTO terminal_sync_state (terminal_id, pharmacy_id, last_sequence, applied_count, conflict_count, updated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (terminal_id) DO UPDATE SET
+            last_sequence = excluded.last_sequence,
+            applied_count = applied_count + excluded.applied_count,
+            conflict_count = conflict_count + excluded.conflict_count,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        (terminal_id, pharmacy_id, ack, len(applied), len(conflicts)),
+    )
+    return {"ack": ack, "applied": applied, "conflicts": conflicts, "duplicates": duplicates, "missing": missing}
@@ -0,0 +1,263 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+
+# Trazas por petición: un span raíz por request HTTP y spans hijos para conexiones, cada
+# sentencia SQL, BEGIN/COMMIT del escritor y el envío de SMS. El contexto viaja en un
+# ContextVar, así que sigue a la petición en el threadpool y en el hilo escritor
+# (db_writer copia el contexto al encolar).
+#
+# Solo se registran las trazas muestreadas (TRACE_SAMPLE_RATE o un traceparent entrante con
+# el flag de muestreo); sin muestreo el costo es leer el ContextVar. Cada traza completa se
+# escribe como una línea OTLP-JSON (ExportTraceServiceRequest) en un archivo rotativo desde un
+# hilo aparte, legible por el file receiver del OpenTelemetry Collector y visores locales.
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", os.path.join("traces", "traces.otlp.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "5"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "farmacia-api")
+
+# SpanKind de OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+MAX_STATEMENT_LENGTH = 500
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: dict) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+
+# (traza, span_id del span actual); None fuera de una traza muestreada
+_current: contextvars.ContextVar[Optional[tuple[Trace, str]]] = contextvars.ContextVar("farmacia_trace", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return f"{random.getrandbits(nbytes * 8):0{nbytes * 2}x}"
+
+
+def _attribute_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace: Trace, span_id: str, parent_id: Optional[str], name: str, kind: int,
+               start_ns: int, end_ns: int, attributes: dict, error: Optional[str]) -> dict:
+    span = {
+        "traceId": trace.trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [
+            {"key": key, "value": _attribute_value(value)} for key, value in attributes.items() if value is not None
+        ],
+        "status": {"code": STATUS_ERROR, "message": error} if error else {"code": STATUS_OK},
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    return span
+
+
+class TraceExporter:
+    """Escribe cada traza como una línea OTLP-JSON en un archivo rotativo (hilo aparte)."""
+
+    def __init__(self, path: str = TRACE_EXPORT_PATH, max_bytes: int = TRACE_MAX_BYTES, backup_count: int = TRACE_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._start_lock = threading.Lock()
+        self.exported = 0
+
+    def _ensure_started(self) -> logging.Logger:
+        if self._logger is not None:
+            return self._logger
+        with self._start_lock:
+            if self._logger is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(
+                    self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8"
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+                self._listener = logging.handlers.QueueListener(records, handler)
+                self._listener.start()
+                logger = logging.getLogger("farmacia.traces")
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                logger.addHandler(logging.handlers.QueueHandler(records))
+                self._logger = logger
+        return self._logger
+
+    def export(self, trace: Trace) -> None:
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "farmacia.tracing"}, "spans": trace.spans}],
+            }]
+        }
+        self._ensure_started().info(json.dumps(payload, separators=(",", ":")))
+        self.exported += 1
+
+    def flush(self) -> None:
+        # Vacía la cola y cierra el archivo (p. ej. al apagar o en scripts)
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.start()
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, exporter: Optional[TraceExporter] = None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter or TraceExporter()
+        self.traces_started = 0
+
+    def current_trace_id(self) -> Optional[str]:
+        current = _current.get()
+        return current[0].trace_id if current else None
+
+    @contextmanager
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes) -> Iterator[Optional[dict]]:
+        """Span raíz de una petición; exporta la traza al terminar si quedó muestreada."""
+        trace_id = parent_id = None
+        sampled = False
+        match = TRACEPARENT_RE.match(traceparent or "")
+        if match:
+            trace_id, parent_id = match.group(1), match.group(2)
+            sampled = int(match.group(3), 16) & 1 == 1
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            sampled = True
+        if not sampled:
+            yield None
+            return
+
+        trace = Trace(trace_id or _new_id(16))
+        self.traces_started += 1
+        with self._span(trace, parent_id, name, SPAN_KIND_SERVER, attributes) as span_attributes:
+            yield span_attributes
+        self.exporter.export(trace)
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Iterator[Optional[dict]]:
+        """Span hijo del actual; no hace nada fuera de una traza muestreada.
+
+        Devuelve el diccionario de atributos para completarlo dentro del bloque.
+        """
+        current = _current.get()
+        if current is None:
+            yield None
+            return
+        trace, parent_id = current
+        with self._span(trace, parent_id, name, kind, attributes) as span_attributes:
+            yield span_attributes
+
+    @contextmanager
+    def _span(self, trace: Trace, parent_id: Optional[str], name: str, kind: int, attributes: dict) -> Iterator[dict]:
+        span_id = _new_id(8)
+        token = _current.set((trace, span_id))
+        start_ns = time.time_ns()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            trace.add(_otlp_span(trace, span_id, parent_id, name, kind, start_ns, time.time_ns(), attributes, error))
+
+    def record_span(self, name: str, start_ns: int, end_ns: int, kind: int = SPAN_KIND_INTERNAL, **attributes) -> None:
+        """Agrega un span ya medido (p. ej. un commit compartido por varias peticiones)."""
+        current = _current.get()
+        if current is None:
+            return
+        trace, parent_id = current
+        trace.add(_otlp_span(trace, _new_id(8), parent_id, name, kind, start_ns, end_ns, attributes, None))
+
+
+tracer = Tracer()
+
+
+# --- SQLite -------------------------------------------------------------------------
+
+def _statement(sql: str) -> str:
+    return " ".join(sql.split())[:MAX_STATEMENT_LENGTH]
+
+
+def _operation(statement: str) -> str:
+    return statement.split(" ", 1)[0].upper() if statement else "SQL"
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if _current.get() is None:
+            return super().execute(sql, parameters)
+        statement = _statement(sql)
+        with tracer.span(f"sqlite {_operation(statement)}", SPAN_KIND_CLIENT, **{"db.system": "sqlite", "db.statement": statement}):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if _current.get() is None:
+            return super().executemany(sql, seq_of_parameters)
+        statement = _statement(sql)
+        with tracer.span(f"sqlite {_operation(statement)}", SPAN_KIND_CLIENT, **{"db.system": "sqlite", "db.statement": statement, "db.executemany": True}):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class TracedConnection(sqlite3.Connection):
+    # Connection.execute no pasa por cursor(): se redefinen ambos
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if _current.get() is None:
+            return super().commit()
+        with tracer.span("sqlite COMMIT", SPAN_KIND_CLIENT, **{"db.system": "sqlite"}):
+            return super().commit()
+
+
+def traced_connect(db_path: str, **kwargs) -> sqlite3.Connection:
+    """sqlite3.connect con spans por conexión, sentencia y commit."""
+    with tracer.span("sqlite connect", SPAN_KIND_CLIENT, **{"db.system": "sqlite", "db.name": db_path}):
+        return sqlite3.connect(db_path, factory=TracedConnection, **kwargs)
@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+from typing import Optional
+
+
+# Posición en la cola en O(log n): por farmacia y día se mantiene un árbol de Fenwick
+# indexado por número de turno con un 1 por cada turno pendiente. Los turnos por delante
+# de un número son la suma de prefijo anterior a él.
+
+
+class FenwickTree:
+    def __init__(self, size: int = 64):
+        self._tree = [0] * (size + 1)
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def _grow(self, index: int) -> None:
+        size = len(self)
+        while size < index:
+            size *= 2
+        values = [self.prefix_sum(i) - self.prefix_sum(i - 1) for i in range(1, len(self) + 1)]
+        self._tree = [0] * (size + 1)
+        # Reconstrucción lineal del árbol; el tamaño se duplica, así que el costo es amortizado
+        for i, value in enumerate(values, start=1):
+            self._tree[i] += value
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+
+    def add(self, index: int, delta: int) -> None:
+        """Suma `delta` en la posición `index` (1-based)."""
+        if index > len(self):
+            self._grow(index)
+        while index <= len(self):
+            self._tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index: int) -> int:
+        """Suma de las posiciones 1..index."""
+        index = min(index, len(self))
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+
+class TurnQueueIndex:
+    def __init__(self):
+        # (pharmacy_id, día) -> Fenwick de turnos pendientes por número
+        self._queues: dict[tuple[int, str], FenwickTree] = {}
+        self._pending_counts: dict[tuple[int, str], int] = {}
+        # turn_id -> (pharmacy_id, día, turn_number) de los turnos pendientes
+        self._pending: dict[int, tuple[int, str, int]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn: sqlite3.Connection, id_offset: int = 0) -> None:
+        with self._lock:
+            self._queues = {}
+            self._pending_counts = {}
+            self._pending = {}
+        self.extend(conn, id_offset)
+
+    def extend(self, conn: sqlite3.Connection, id_offset: int = 0) -> None:
+        """Agrega los turnos pendientes de otra base (un shard); `id_offset` da los ids públicos."""
+        rows = conn.execute(
+            "SELECT id, pharmacy_id, requested_at, turn_number FROM turns WHERE status = 'pending'"
+        ).fetchall()
+        with self._lock:
+            for turn_id, pharmacy_id, requested_at, turn_number in rows:
+                self._add(id_offset | turn_id, pharmacy_id, str(requested_at)[:10], turn_number)
+
+    def _add(self, turn_id: int, pharmacy_id: int, day: str, turn_number: int) -> None:
+        if turn_id in self._pending:
+            return
+        key = (pharmacy_id, day)
+        self._queues.setdefault(key, FenwickTree()).add(turn_number, 1)
+        self._pending_counts[key] = self._pending_counts.get(key, 0) + 1
+        self._pending[turn_id] = (pharmacy_id, day, turn_number)
+
+    def _remove(self, turn_id: int) -> None:
+        entry = self._pending.pop(turn_id, None)
+        if entry is None:
+            return
+        pharmacy_id, day, turn_number = entry
+        key = (pharmacy_id, day)
+        self._queues[key].add(turn_number, -1)
+        self._pending_counts[key] -= 1
+        if self._pending_counts[key] == 0:
+            # Cola vacía (p. ej. tras el cierre del día): se libera
+            del self._queues[key]
+            del self._pending_counts[key]
+
+    def apply(
+        self,
+        turn_id: int,
+        pharmacy_id: int,
+        requested_at: str,
+        turn_number: int,
+        old_status: Optional[str],
+        new_status: str,
+    ) -> None:
+        """Refleja una transición (old_status None = turno nuevo)."""
+        if (old_status == "pending") == (new_status == "pending"):
+            return
+        with self._lock:
+            if new_status == "pending":
+                self._add(turn_id, pharmacy_id, str(requested_at)[:10], turn_number)
+            else:
+                self._remove(turn_id)
+
+    def position(self, turn_id: int) -> Optional[dict]:
+        """Posición de un turno pendiente, o None si no está en la cola."""
+        with self._lock:
+            entry = self._pending.get(turn_id)
+            if entry is None:
+                return None
+            pharmacy_id, day, turn_number = entry
+            key = (pharmacy_id, day)
+            ahead = self._queues[key].prefix_sum(turn_number - 1)
+            pending_total = self._pending_counts[key]
+        return {
+            "pharmacy_id": pharmacy_id,
+            "turn_number": turn_number,
+            "position": ahead + 1,
+            "people_ahead": ahead,
+            "pending_total": pending_total,
+        }
@@ -0,0 +1,270 @@
+import argparse
+import sqlite3
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from archive import TurnArchive
+from shards import shard_databases
+
+
+# Rollups incrementales de turnos por (farmacia, fecha, hora de solicitud).
+# Se actualizan dentro de la misma transacción que escribe el turno, así las
+# estadísticas no necesitan recorrer `turns` (equivalente a la vista daily_turn_statistics).
+
+
+def init_turn_stats_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS turn_stats_hourly (
+            pharmacy_id INTEGER NOT NULL,
+            stat_date TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            total_turns INTEGER NOT NULL DEFAULT 0,
+            digital_turns INTEGER NOT NULL DEFAULT 0,
+            physical_turns INTEGER NOT NULL DEFAULT 0,
+            attended_turns INTEGER NOT NULL DEFAULT 0,
+            cancelled_turns INTEGER NOT NULL DEFAULT 0,
+            wait_seconds_sum REAL NOT NULL DEFAULT 0,
+            wait_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (pharmacy_id, stat_date, hour)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+UPSERT_SQL = """
+    INSERT INTO turn_stats_hourly (
+        pharmacy_id, stat_date, hour, total_turns, digital_turns, physical_turns,
+        attended_turns, cancelled_turns, wait_seconds_sum, wait_count
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (pharmacy_id, stat_date, hour) DO UPDATE SET
+        total_turns = total_turns + excluded.total_turns,
+        digital_turns = digital_turns + excluded.digital_turns,
+        physical_turns = physical_turns + excluded.physical_turns,
+        attended_turns = attended_turns + excluded.attended_turns,
+        cancelled_turns = cancelled_turns + excluded.cancelled_turns,
+        wait_seconds_sum = wait_seconds_sum + excluded.wait_seconds_sum,
+        wait_count = wait_count + excluded.wait_count
+"""
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromisoformat(str(value))
+
+
+def _wait_seconds(requested_at: Optional[str], attended_at: Optional[str]) -> Optional[float]:
+    requested = _parse_timestamp(requested_at)
+    attended = _parse_timestamp(attended_at)
+    if requested is None or attended is None:
+        return None
+    return (attended - requested).total_seconds()
+
+
+def record_turn_created(cursor: sqlite3.Cursor, pharmacy_id: int, requested_at: str, request_type: str) -> None:
+    requested = _parse_timestamp(requested_at)
+    cursor.execute(
+        UPSERT_SQL,
+        (
+            pharmacy_id,
+            requested.date().isoformat(),
+            requested.hour,
+            1,
+            1 if request_type == "digital" else 0,
+            1 if request_type == "physical" else 0,
+            0,
+            0,
+            0.0,
+            0,
+        ),
+    )
+
+
+def _status_change_delta(
+    requested_at: str,
+    old_status: str,
+    new_status: str,
+    old_attended_at: Optional[str],
+    new_attended_at: Optional[str],
+) -> Optional[tuple]:
+    """Delta (bucket + contadores) de una transición old -> new, o None si no cambia nada."""
+    attended_delta = int(new_status == "attended") - int(old_status == "attended")
+    cancelled_delta = int(new_status == "cancelled") - int(old_status == "cancelled")
+
+    wait_delta = 0.0
+    wait_count_delta = 0
+    if old_status == "attended":
+        old_wait = _wait_seconds(requested_at, old_attended_at)
+        if old_wait is not None:
+            wait_delta -= old_wait
+            wait_count_delta -= 1
+    if new_status == "attended":
+        new_wait = _wait_seconds(requested_at, new_attended_at)
+        if new_wait is not None:
+            wait_delta += new_wait
+            wait_count_delta += 1
+
+    if not (attended_delta or cancelled_delta or wait_delta or wait_count_delta):
+        return None
+
+    requested = _parse_timestamp(requested_at)
+    return (
+        requested.date().isoformat(),
+        requested.hour,
+        attended_delta,
+        cancelled_delta,
+        wait_delta,
+        wait_count_delta,
+    )
+
+
+def record_status_change(
+    cursor: sqlite3.Cursor,
+    pharmacy_id: int,
+    requested_at: str,
+    old_status: str,
+    new_status: str,
+    old_attended_at: Optional[str],
+    new_attended_at: Optional[str],
+) -> None:
+    """Aplica el delta de una transición (old -> new) al bucket de la hora de solicitud."""
+    record_status_changes(
+        cursor, [(pharmacy_id, requested_at, old_status, new_status, old_attended_at, new_attended_at)]
+    )
+
+
+def record_status_changes(cursor: sqlite3.Cursor, changes: list[tuple]) -> None:
+    """Igual que record_status_change para muchas transiciones: un UPSERT por bucket, no por turno.
+
+    Cada cambio es (pharmacy_id, requested_at, old_status, new_status, old_attended_at, new_attended_at).
+    """
+    buckets: dict[tuple, list] = {}
+    for pharmacy_id, requested_at, old_status, new_status, old_attended_at, new_attended_at in changes:
+        delta = _status_change_delta(requested_at, old_status, new_status, old_attended_at, new_attended_at)
+        if delta is None:
+            continue
+        stat_date, hour, attended, cancelled, wait_sum, wait_count = delta
+        totals = buckets.setdefault((pharmacy_id, stat_date, hour), [0, 0, 0.0, 0])
+        totals[0] += attended
+        totals[1] += cancelled
+        totals[2] += wait_sum
+        totals[3] += wait_count
+
+    cursor.executemany(
+        UPSERT_SQL,
+        [
+            (pharmacy_id, stat_date, hour, 0, 0, 0, attended, cancelled, wait_sum, wait_count)
+            for (pharmacy_id, stat_date, hour), (attended, cancelled, wait_sum, wait_count) in buckets.items()
+        ],
+    )
+
+
+def query_stats(conn: sqlite3.Connection, pharmacy_id: int, start: date, end: date, granularity: str = "day") -> list[dict]:
+    if granularity == "hour":
+        group_columns = "stat_date, hour"
+    else:
+        group_columns = "stat_date"
+    rows = conn.execute(
+        f"""
+        SELECT {group_columns},
+               SUM(total_turns), SUM(digital_turns), SUM(physical_turns),
+               SUM(attended_turns), SUM(cancelled_turns), SUM(wait_seconds_sum), SUM(wait_count)
+        FROM turn_stats_hourly
+        WHERE pharmacy_id = ? AND stat_date BETWEEN ? AND ?
+        GROUP BY {group_columns}
+        ORDER BY {group_columns}
+        """,
+        (pharmacy_id, start.isoformat(), end.isoformat()),
+    ).fetchall()
+
+    results = []
+    for row in rows:
+        if granularity == "hour":
+            key = {"date": row[0], "hour": row[1]}
+            values = row[2:]
+        else:
+            key = {"date": row[0]}
+            values = row[1:]
+        total, digital, physical, attended, cancelled, wait_sum, wait_count = values
+        results.append({
+            **key,
+            "total_turns": total,
+            "digital_turns": digital,
+            "physical_turns": physical,
+            "attended_turns": attended,
+            "cancelled_turns": cancelled,
+            "avg_wait_time_minutes": round(wait_sum / wait_count / 60, 1) if wait_count else None,
+        })
+    return results
+
+
+def backfill(db_path: str, start: Optional[date] = None, end: Optional[date] = None, archive: Optional[TurnArchive] = None) -> int:
+    """Recalcula los rollups del rango desde `turns` y los archivos mensuales."""
+    archive = archive or TurnArchive(db_path)
+    conditions = []
+    params: list = []
+    if start is not None:
+        conditions.append("requested_at >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append("requested_at < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = sqlite3.connect(db_path)
+    try:
+        init_turn_stats_schema(conn)
+        conn.commit()
+        # Bloqueo de escritura durante el recálculo: ningún turno nuevo queda fuera del rollup
+        conn.execute("BEGIN IMMEDIATE")
+        # Las agregaciones agrupan por fecha: los grupos de archivos no se solapan
+        rows = archive.query(
+            f"""
+            SELECT pharmacy_id, DATE(requested_at), CAST(strftime('%H', requested_at) AS INTEGER),
+                   COUNT(*),
+                   SUM(CASE WHEN request_type = 'digital' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN request_type = 'physical' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN status = 'attended' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END),
+                   COALESCE(SUM(CASE WHEN status = 'attended' AND attended_at IS NOT NULL
+                       THEN (julianday(attended_at) - julianday(requested_at)) * 86400 END), 0),
+                   SUM(CASE WHEN status = 'attended' AND attended_at IS NOT NULL THEN 1 ELSE 0 END)
+            FROM turns_history
+            {where}
+            GROUP BY 1, 2, 3
+            """,
+            tuple(params),
+            start,
+            end,
+        )
+
+        delete_conditions = []
+        delete_params: list = []
+        if start is not None:
+            delete_conditions.append("stat_date >= ?")
+            delete_params.append(start.isoformat())
+        if end is not None:
+            delete_conditions.append("stat_date <= ?")
+            delete_params.append(end.isoformat())
+        delete_where = f"WHERE {' AND '.join(delete_conditions)}" if delete_conditions else ""
+        conn.execute(f"DELETE FROM turn_stats_hourly {delete_where}", delete_params)
+        conn.executemany(UPSERT_SQL, rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruye los rollups turn_stats_hourly desde los turnos existentes")
+    parser.add_argument("--db", default="farmacia.db", help="Base principal; también se recorren sus shards")
+    parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD (por defecto: todo el historial)")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    args = parser.parse_args()
+
+    # Cada shard guarda los turnos, archivos y rollups de sus farmacias
+    for db_path, archive in shard_databases(args.db):
+        buckets = backfill(db_path, args.start, args.end, archive)
+        print(f"{db_path}: {buckets} buckets recalculados (farmacia, fecha, hora)")
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Optional
+
+from turn_stats import record_status_changes
+
+
+# Transiciones de estado de turnos en bloque (un UPDATE y una transacción para todo el lote)
+# y cierre automático del día, que cancela los turnos que quedaron pendientes o llamados.
+
+TURN_STATUSES = ("pending", "called", "attended", "cancelled")
+
+# Estado actual -> estados permitidos; attended y cancelled son finales
+ALLOWED_TRANSITIONS = {
+    "pending": {"called", "attended", "cancelled"},
+    "called": {"pending", "attended", "cancelled"},
+    "attended": set(),
+    "cancelled": set(),
+}
+
+TIMESTAMP_COLUMNS = {"called": "called_at", "attended": "attended_at", "cancelled": "cancelled_at"}
+
+MAX_BULK_TURN_IDS = 1000
+
+# Hora (UTC, HH:MM) del cierre diario
+DAY_CLOSE_TIME = os.getenv("TURNS_DAY_CLOSE_TIME", "23:00")
+
+
+def init_turn_transitions_schema(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(turns)")}
+    if "cancelled_at" not in columns:
+        conn.execute("ALTER TABLE turns ADD COLUMN cancelled_at TIMESTAMP NULL")
+
+
+def allowed_sources(new_status: str) -> set[str]:
+    """Estados desde los que se puede pasar a `new_status`."""
+    return {status for status, targets in ALLOWED_TRANSITIONS.items() if new_status in targets}
+
+
+def transition_turns(
+    cursor: sqlite3.Cursor,
+    new_status: str,
+    turn_ids: Optional[list[int]] = None,
+    pharmacy_id: Optional[int] = None,
+    current_statuses: Optional[list[str]] = None,
+    requested_from: Optional[str] = None,
+    requested_until: Optional[str] = None,
+) -> tuple[dict, list[tuple]]:
+    """Pasa a `new_status` los turnos seleccionados, dentro de la transacción del llamador
+    (p. ej. una operación del escritor del shard).
+
+    Los turnos cuyo estado actual no admite la transición se omiten y se cuentan en `skipped`.
+    Devuelve el resultado y los cambios (turn_id, pharmacy_id, requested_at, turn_number, old, new)
+    para notificarlos después del commit.
+    """
+    if new_status not in TURN_STATUSES:
+        raise ValueError(f"Estado no válido: {new_status}")
+    sources = sorted(allowed_sources(new_status))
+
+    conditions = []
+    params: list = []
+    if turn_ids is not None:
+        conditions.append(f"id IN ({', '.join('?' for _ in turn_ids)})")
+        params.extend(turn_ids)
+    if pharmacy_id is not None:
+        conditions.append("pharmacy_id = ?")
+        params.append(pharmacy_id)
+    if current_statuses:
+        conditions.append(f"status IN ({', '.join('?' for _ in current_statuses)})")
+        params.extend(current_statuses)
+    if requested_from is not None:
+        conditions.append("requested_at >= ?")
+        params.append(requested_from)
+    if requested_until is not None:
+        conditions.append("requested_at < ?")
+        params.append(requested_until)
+    where = " AND ".join(conditions) or "1"
+
+    set_clause = "status = ?"
+    if new_status in TIMESTAMP_COLUMNS:
+        set_clause += f", {TIMESTAMP_COLUMNS[new_status]} = CURRENT_TIMESTAMP"
+    source_placeholders = ", ".join("?" for _ in sources)
+
+    matched = cursor.execute(
+        f"SELECT id, pharmacy_id, requested_at, status, attended_at, turn_number FROM turns WHERE {where}",
+        params,
+    ).fetchall()
+    allowed = [row for row in matched if row[3] in sources]
+    skipped = Counter(row[3] for row in matched if row[3] not in sources)
+
+    if allowed:
+        new_attended_at = dict(cursor.execute(
+            f"UPDATE turns SET {set_clause} WHERE {where} AND status IN ({source_placeholders}) "
+            f"RETURNING id, attended_at",
+            [new_status, *params, *sources],
+        ).fetchall())
+        record_status_changes(cursor, [
+            (row[1], row[2], row[3], new_status, row[4], new_attended_at.get(row[0]))
+            for row in allowed
+        ])
+
+    result = {
+        "status": new_status,
+        "matched": len(matched),
+        "updated": len(allowed),
+        "skipped": dict(skipped),
+    }
+    if turn_ids is not None:
+        result["not_found"] = len(set(turn_ids)) - len(matched)
+    changes = [(row[0], row[1], row[2], row[5], row[3], new_status) for row in allowed]
+    return result, changes
+
+
+def bulk_transition(
+    conn: sqlite3.Connection,
+    new_status: str,
+    turn_ids: Optional[list[int]] = None,
+    pharmacy_id: Optional[int] = None,
+    current_statuses: Optional[list[str]] = None,
+    requested_from: Optional[str] = None,
+    requested_until: Optional[str] = None,
+    on_status_change: Optional[Callable[[int, int, str, int, str, str], None]] = None,
+) -> dict:
+    """transition_turns en su propia transacción (scripts y tareas sin escritor).
+
+    `on_status_change` recibe (turn_id, pharmacy_id, requested_at, turn_number, old, new)
+    por cada turno actualizado, después del commit.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        result, changes = transition_turns(
+            cursor, new_status, turn_ids, pharmacy_id, current_statuses, requested_from, requested_until
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if on_status_change is not None:
+        for change in changes:
+            on_status_change(*change)
+    return result
+
+
+def close_day(
+    db_path: str,
+    cutoff: Optional[datetime] = None,
+    pharmacy_id: Optional[int] = None,
+    on_status_change: Optional[Callable[[int, int, str, int, str, str], None]] = None,
+) -> dict:
+    """Cancela los turnos pendientes o llamados solicitados antes de `cutoff` (por defecto, ahora)."""
+    cutoff = cutoff or datetime.utcnow()
+    conn = sqlite3.connect(db_path)
+    try:
+        return bulk_transition(
+            conn,
+            "cancelled",
+            pharmacy_id=pharmacy_id,
+            current_statuses=["pending", "called"],
+            requested_until=cutoff.strftime("%Y-%m-%d %H:%M:%S"),
+            on_status_change=on_status_change,
+        )
+    finally:
+        conn.close()